@@ -195,7 +195,7 @@ class Diarizer(object):
 
             gmm_f.write("Cluster " + str(cluster_count) + "\n")
             means = gmm.components.means
-            covars = gmm.components.covars
+            variances = gmm.components.variances()
             weights = gmm.components.weights
 
             gmm_f.write("Number of Gaussians: "+ str(gmm.M) + "\n")
@@ -203,8 +203,7 @@ class Diarizer(object):
             gmm_count = 0
             for g in range(0, gmm.M):
                 g_means = means[gmm_count]
-                g_covar_full = covars[gmm_count]
-                g_covar = np.diag(g_covar_full)
+                g_covar = variances[gmm_count]
                 g_weight = weights[gmm_count]
 
                 gmm_f.write("Gaussian: " + str(gmm_count) + "\n")
@@ -230,7 +229,7 @@ class Diarizer(object):
 
 
 
-    def segment_majority_vote(self, interval_size, em_iters):
+    def segment_majority_vote(self, interval_size, em_iters, mode='soft'):
         
         num_clusters = len(self.gmm_list)
 
@@ -271,7 +270,7 @@ class Diarizer(object):
             for d in data_list[1:]:
                 cluster_data = np.concatenate((cluster_data, d))
 
-            g.train(cluster_data, max_em_iters=em_iters)
+            g.train(cluster_data, max_em_iters=em_iters, mode=mode)
 
             iter_bic_list.append((g,cluster_data))
             iter_bic_dict[p] = cluster_data
@@ -286,15 +285,16 @@ class Diarizer(object):
 
         # ----------- Uniform Initialization -----------
         # Get the events, divide them into an initial k clusters and train each GMM on a cluster
+        # The initial rounds only need rough models, so they use hard-assignment EM
         per_cluster = self.N/self.init_num_clusters
         init_training = zip(self.gmm_list,np.vsplit(self.X, range(per_cluster, self.N, per_cluster)))
         
         for g, x in init_training:
-            g.train(x, max_em_iters=em_iters)
+            g.train(x, max_em_iters=em_iters, mode='hard')
 
         # ----------- First majority vote segmentation loop ---------
         for segment_iter in range(0,NUM_SEG_LOOPS_INIT):
-            iter_bic_dict, iter_bic_list, most_likely = self.segment_majority_vote(seg_length, em_iters)
+            iter_bic_dict, iter_bic_list, most_likely = self.segment_majority_vote(seg_length, em_iters, mode='hard')
 
 
         # ----------- Main Clustering Loop using BIC ------------
@@ -37,7 +37,7 @@ class Plotter(object):
         gmm = GMM(M, self.D, cvtype=cvtype)
         likelihood = gmm.train(self.X)
         means = gmm.components.means.reshape((M, self.D))
-        covars = gmm.components.covars.reshape((M, self.D, self.D))
+        covars = gmm.components.expanded_covars()
         Y = gmm.predict(self.X)
         self.results[' '.join(['ASP',cvtype,str(self.D),str(M),str(self.N)])] = (str(self.plot_base+plot_id), copy.deepcopy(means), copy.deepcopy(covars), copy.deepcopy(Y))
         return likelihood
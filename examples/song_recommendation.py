@@ -179,29 +179,24 @@ if __name__ == '__main__':
     total_ubm_features = np.array(pickle.load(p))
     p.close()
 
-    # train the UBM on 30% of the total features from all songs
-    training_ubm_features = np.array(rnd.sample(total_ubm_features, int(len(total_ubm_features)*0.3)))
-
     print "--- Collecting ubm features time:\t", time.time() - st, " -----"
-    print "INFO: total ubm features: ", total_ubm_features.shape, " 30%: ", training_ubm_features.shape
+    print "INFO: total ubm features: ", total_ubm_features.shape
 
-    # train UBM on features
+    # train UBM on a 30% coreset of the total features from all songs, refined with one full-data EM pass
     D = total_ubm_features.shape[1]
     ubm = GMM(M,D,cvtype='diag')
     
     train_st = time.time()
-    ubm.train(training_ubm_features)
+    ubm_lkld, ubm_gap = ubm.train_on_coreset(total_ubm_features, coreset_fraction=0.3, refine_em_iters=1, seed=42)
     train_total = time.time() - train_st
     print "--- UBM training time:\t", train_total, " -----"
+    print "INFO: UBM full-data minus coreset likelihood: ", ubm_gap
     
-    # train positive GMM on features
-    D = total_features.shape[1]
-    gmm = GMM(M, D, means=np.array(ubm.components.means), covars=np.array(ubm.components.covars), weights=np.array(ubm.components.weights), cvtype='diag')
-    
+    # adapt the positive GMM from the UBM with a single E-step over the tag's features
     train_st = time.time()
-    gmm.train(total_features)
+    gmm = GMM.map_adapt(ubm, total_features, relevance_factor=16.0, adapt=('means',))
     train_total = time.time() - train_st
-    print "--- GMM training time:\t", train_total, " -----"
+    print "--- GMM adaptation time:\t", train_total, " -----"
 
     print "--- Testing Labeled Examples ---"
 
@@ -210,32 +205,27 @@ if __name__ == '__main__':
     labeled_songs = {}
     unlabeled_songs = {}
 
-    for test_song in testing_song_keys:
-        test_feats = songs_with_tag[test_song]['segments_timbre']
-        all_lklds = gmm.score(test_feats)
-        all_ubm_lklds = ubm.score(test_feats)
-        
-        avg_lkld = np.average(all_lklds)
-        avg_ubm_lkld = np.average(all_ubm_lklds)
-        sum_lkld = np.sum(all_lklds)
+    test_feats = [songs_with_tag[test_song]['segments_timbre'] for test_song in testing_song_keys]
+    offsets = np.cumsum([0] + [f.shape[0] for f in test_feats])
+    avg_lklds = score_ragged([gmm, ubm], np.ascontiguousarray(np.concatenate(test_feats), dtype=np.float32), offsets, reduce='mean')
+
+    for s, test_song in enumerate(testing_song_keys):
+        avg_lkld = avg_lklds[0][s]
+        avg_ubm_lkld = avg_lklds[1][s]
     
         labeled_songs[str(songs_with_tag[test_song]['artist_name']+ " - "+songs_with_tag[test_song]['title'])] = (avg_lkld, avg_ubm_lkld, avg_lkld - avg_ubm_lkld)
     
     print "--- Testing Unlabeled Examples ---"
     test_st = time.time()
 
-    count = 0
     # testing the unlabeled test files
-    for test_song in negative_song_keys:
-        count+=1
-        print count
-        test_feats = songs_without_tag[test_song]['segments_timbre']
-
-        all_lklds = gmm.score(test_feats)
-        all_ubm_lklds = ubm.score(test_feats)
-        avg_lkld = np.average(all_lklds)
-        avg_ubm_lkld = np.average(all_ubm_lklds)
-        sum_lkld = np.sum(all_lklds)
+    test_feats = [songs_without_tag[test_song]['segments_timbre'] for test_song in negative_song_keys]
+    offsets = np.cumsum([0] + [f.shape[0] for f in test_feats])
+    avg_lklds = score_ragged([gmm, ubm], np.ascontiguousarray(np.concatenate(test_feats), dtype=np.float32), offsets, reduce='mean')
+
+    for s, test_song in enumerate(negative_song_keys):
+        avg_lkld = avg_lklds[0][s]
+        avg_ubm_lkld = avg_lklds[1][s]
         
         unlabeled_songs[str(songs_without_tag[test_song]['artist_name'] + " - " + songs_without_tag[test_song]['title'])] = (avg_lkld, avg_ubm_lkld, avg_lkld - avg_ubm_lkld)
 
@@ -1,28 +1,126 @@
 import numpy as np
 from numpy.random import random
 from numpy import s_
-from asp.config import PlatformDetector, ConfigReader
-import asp.codegen.templating.template as AspTemplate
-import asp.jit.asp_module as asp_module
-from codepy.cgen import *
-from codepy.cuda import CudaModule
+import json
 import math
+import os
+import struct
 import sys
+import threading
+import time
 from imp import find_module
+from thread import get_ident
 from os.path import join
 
+#Mirrors of the constants in em_base_helper_funcs.mako, used by the numpy backend
+COVARIANCE_DYNAMIC_RANGE = 1E6
+MINVALUEFORMINUSLOG = -1000.0
+
+#asp and codepy are only imported once a GMM needs the platform features or a compiled backend
+PLATFORM_CACHE_FILE = join(os.path.expanduser('~'), '.cache', 'gmm_specializer', 'platform.json')
+PLATFORM_CACHE_TTL = 24*60*60
+
+def covars_shape(cvtype, M, D):
+    """
+    Shape of the covars (and Rinv) storage for a cvtype: a single variance per component for 'spherical', the
+    per-dimension variances of each component for 'diag', one matrix shared by all components for 'tied', the
+    packed upper triangle of each component's matrix (see pack_covars) for 'full'.
+    """
+    if cvtype == 'spherical':
+        return (M,)
+    if cvtype == 'diag':
+        return (M, D)
+    if cvtype == 'tied':
+        return (D, D)
+    return (M, D*(D+1)//2)
+
+def pack_covars(matrices):
+    """
+    The upper triangles of a stack of symmetric D x D matrices, row by row, as ... x D(D+1)/2.
+    """
+    rows, cols = np.triu_indices(matrices.shape[-1])
+    return matrices[..., rows, cols]
+
+def unpack_covars(packed, D):
+    """
+    The symmetric D x D matrices whose upper triangles were packed by pack_covars.
+    """
+    rows, cols = np.triu_indices(D)
+    matrices = np.empty(packed.shape[:-1] + (D, D), dtype=packed.dtype)
+    matrices[..., rows, cols] = packed
+    matrices[..., cols, rows] = packed
+    return matrices
+
+def native_array(a, ndim=None, dtypes=(np.float32,), contiguous=True):
+    """
+    a itself if it is an ndarray of one of dtypes (C-contiguous if contiguous) that the native code can use in place,
+    otherwise a C-contiguous copy as dtypes[0], counted in GMM.input_copies.
+    """
+    if ndim is not None and np.ndim(a) != ndim:
+        raise RuntimeError("Expected a %d-dimensional array, got %d dimensions" % (ndim, np.ndim(a)))
+    if isinstance(a, np.ndarray) and a.dtype in dtypes and (a.flags.c_contiguous or not contiguous):
+        return a
+    GMM.input_copies += 1
+    return np.ascontiguousarray(a, dtype=dtypes[0])
+
+def compact_covars(covars, cvtype, M, D):
+    """
+    Convert M x D x D covariance matrices to the storage of a diag or full model.
+    """
+    covars = np.reshape(covars, (M, D, D))
+    if cvtype == 'diag':
+        return np.ascontiguousarray(np.diagonal(covars, axis1=1, axis2=2), dtype=np.float32)
+    return np.ascontiguousarray(pack_covars(covars), dtype=np.float32)
+
 class GMMComponents(object):
     """
     The Python interface to the components of a GMM.
+    Assigning weights, means or covars bumps version, which invalidates the cached scoring constants (Rinv and
+    constant). Call touch() after editing one of those arrays in place.
+    covars and Rinv are laid out as covars_shape(cvtype, M, D); expanded_covars() gives the M x D x D view.
+    Full matrices passed as the covars of a diag or full model are converted with compact_covars.
     """
     
-    def __init__(self, M, D, weights = None, means = None, covars = None):
+    def __init__(self, M, D, weights = None, means = None, covars = None, Rinv = None, constant = None, cvtype = 'diag'):
         self.M = M
         self.D = D
+        self.cvtype = cvtype
+        self.version = 0
+        covars_size = int(np.prod(covars_shape(cvtype, M, D)))
+        if cvtype in ['diag', 'full'] and covars is not None and np.size(covars) == M*D*D and D > 1:
+            covars = compact_covars(covars, cvtype, M, D)
         self.weights = weights if weights is not None else np.empty(M, dtype=np.float32)
         self.means = means if means is not None else  np.empty(M*D, dtype=np.float32)
-        self.covars = covars if covars is not None else  np.empty(M*D*D, dtype=np.float32)
+        self.covars = covars if covars is not None else  np.empty(covars_size, dtype=np.float32)
         self.comp_probs = np.empty(M, dtype=np.float32)
+        # Scoring constants (inverse covariances and log normalizers), filled in by the native code or a loaded model
+        self.Rinv = Rinv if Rinv is not None else np.empty(covars_size, dtype=np.float32)
+        self.constant = constant if constant is not None else np.empty(M, dtype=np.float32)
+        self.constants_version = -1
+        if Rinv is not None and constant is not None:
+            self.comp_probs[:] = 2.0*self.constant
+            self.mark_constants_valid()
+
+    def _set_param(name):
+        def setter(self, value):
+            # The native code reads and writes these arrays in place
+            setattr(self, '_'+name, native_array(value))
+            self.touch()
+        return property(lambda self: getattr(self, '_'+name), setter)
+    weights = _set_param('weights')
+    means = _set_param('means')
+    covars = _set_param('covars')
+    del _set_param
+
+    def touch(self):
+        self.version += 1
+
+    @property
+    def constants_valid(self):
+        return self.constants_version == self.version
+
+    def mark_constants_valid(self):
+        self.constants_version = self.version
         
     def init_random_weights(self):
         self.weights = random((self.M))
@@ -31,72 +129,419 @@ class GMMComponents(object):
         self.means = random((self.M,self.D))
 
     def init_random_covars(self):
-        self.covars = random((self.M, self.D, self.D))
+        self.covars = random(covars_shape(self.cvtype, self.M, self.D))
 
     def shrink_components(self, new_M):
+        self.M = new_M
+        covars_size = int(np.prod(covars_shape(self.cvtype, new_M, self.D)))
         self.weights = np.resize(self.weights, new_M)
         self.means = np.resize(self.means, new_M*self.D)
-        self.covars = np.resize(self.covars, new_M*self.D*self.D)
+        self.covars = np.resize(self.covars, covars_size)
+        self.Rinv = np.resize(self.Rinv, covars_size)
+        self.constant = np.resize(self.constant, new_M)
+        self.comp_probs = np.resize(self.comp_probs, new_M)
+
+    def expanded_covars(self):
+        """
+        The covariances as an M x D x D array, whatever the cvtype.
+        """
+        covars = np.asarray(self.covars, dtype=np.float64).reshape(covars_shape(self.cvtype, self.M, self.D))
+        if self.cvtype == 'spherical':
+            return covars[:, np.newaxis, np.newaxis]*np.eye(self.D)
+        if self.cvtype == 'diag':
+            return covars[:, :, np.newaxis]*np.eye(self.D)
+        if self.cvtype == 'tied':
+            return np.tile(covars, (self.M, 1, 1))
+        return unpack_covars(covars, self.D)
+
+    def variances(self):
+        """
+        The per-dimension variances of each component as a contiguous M x D float32 array.
+        """
+        if self.cvtype == 'diag':
+            return np.ascontiguousarray(self.covars, dtype=np.float32).reshape(self.M, self.D)
+        return np.ascontiguousarray(np.diagonal(self.expanded_covars(), axis1=1, axis2=2), dtype=np.float32)
+
+    def compute_scoring_constants(self):
+        """
+        Compute Rinv and constant from the covariances on the host, matching the native constants step.
+        """
+        M, D = self.M, self.D
+        covars = np.asarray(self.covars, dtype=np.float64).reshape(covars_shape(self.cvtype, M, D))
+        if self.cvtype == 'spherical':
+            constant = -D*0.5*np.log(2*np.pi) - 0.5*D*np.log(covars)
+            return (1.0/covars).astype(np.float32), constant.astype(np.float32)
+        if self.cvtype == 'diag':
+            constant = -D*0.5*np.log(2*np.pi) - 0.5*np.sum(np.log(covars), axis=1)
+            return (1.0/covars).astype(np.float32), constant.astype(np.float32)
+        if self.cvtype == 'tied':
+            sign, log_determinant = np.linalg.slogdet(covars)
+            constant = np.empty(M, dtype=np.float32)
+            constant[:] = -D*0.5*np.log(2*np.pi) - 0.5*log_determinant
+            return np.linalg.inv(covars).astype(np.float32), constant
+        covars = unpack_covars(covars, D)
+        sign, log_determinant = np.linalg.slogdet(covars)
+        constant = -D*0.5*np.log(2*np.pi) - 0.5*log_determinant
+        return pack_covars(np.linalg.inv(covars)).astype(np.float32), constant.astype(np.float32)
             
 class GMMEvalData(object):
     """
     The Python interface to the evaluation data generated by scoring a GMM.
+    memberships and loglikelihoods are views into buffers that grow geometrically and are reused while they
+    are large enough, so they are overwritten by the next evaluation.
     """
 
     def __init__(self, N, M):
         self.N = N
         self.M = M
-        self.memberships = np.zeros((M,N), dtype=np.float32)
-        self.loglikelihoods = np.zeros(N, dtype=np.float32)
+        self.N_capacity = N
+        self.M_capacity = M
+        self.memberships_buffer = np.zeros(M*N, dtype=np.float32)
+        self.loglikelihoods_buffer = np.zeros(N, dtype=np.float32)
+        self.memberships = self.memberships_buffer.reshape((M,N))
+        self.loglikelihoods = self.loglikelihoods_buffer
         self.likelihood = 0.0
+        self.iters = 0 # EM iterations run by the last train call
+        self.sparse_fallbacks = 0 # iterations of the last sparse train that needed the exact M-step
+        self.restart_likelihoods = [] # likelihood of each restart of the last train with n_init > 1
+        self.coreset_likelihood = 0.0 # weighted coreset objective of the final model of the last train_on_coreset
 
     def resize(self, N, M):
-        self.memberships.resize((M,N))
-        self.memberships = np.ascontiguousarray(self.memberships)
-        self.loglikelihoods.resize(N, refcheck=False)
-        self.loglikelihoods = np.ascontiguousarray(self.loglikelihoods)
+        """
+        Returns True if the buffers had to be reallocated.
+        """
+        grown = N > self.N_capacity or M > self.M_capacity
+        if grown:
+            if N > self.N_capacity: self.N_capacity = max(N, 2*self.N_capacity)
+            if M > self.M_capacity: self.M_capacity = max(M, 2*self.M_capacity)
+            self.memberships_buffer = np.zeros(self.M_capacity*self.N_capacity, dtype=np.float32)
+            self.loglikelihoods_buffer = np.zeros(self.N_capacity, dtype=np.float32)
+        self.memberships = self.memberships_buffer[:M*N].reshape((M,N))
+        self.loglikelihoods = self.loglikelihoods_buffer[:N]
         self.M = M
         self.N = N
+        return grown
+
+class GMMGaussianSelection(object):
+    """
+    Gaussian selection state built by GMM.build_gaussian_selection: a VQ codebook of the component means (in
+    units of the average standard deviation, scale) and a shortlist of component indexes per codeword.
+    version is the components version it was built for.
+    """
+
+    def __init__(self, codewords, shortlists, scale, version):
+        self.codewords = codewords   # K x D
+        self.shortlists = shortlists # K x S
+        self.scale = scale           # D
+        self.version = version
+
+class GMMStreamState(object):
+    """
+    Running sufficient statistics of GMM.partial_fit, as per-event averages: the posterior mass of each component
+    (counts), its posterior-weighted events (first) and second moments (second, M x D for 'diag' and 'spherical',
+    M x D x D for 'full' and one D x D sum over the components for 'tied'). step counts the chunks seen.
+    """
+
+    def __init__(self, M, D, cvtype):
+        self.step = 0
+        self.counts = np.zeros(M)
+        self.first = np.zeros((M, D))
+        if cvtype in ['diag', 'spherical']:
+            self.second = np.zeros((M, D))
+        elif cvtype == 'tied':
+            self.second = np.zeros((D, D))
+        else:
+            self.second = np.zeros((M, D, D))
+
+class GMMCostModel(object):
+    """
+    Predicts the run time of a train or eval call on each backend as overhead + rate*work, where work counts the
+    per-event, per-component arithmetic for the problem shape (N, M, D, cvtype). Each (backend, call, cvtype)
+    starts from a rough prior and is refit by least squares from the measured times of past calls, with older
+    measurements decayed.
+    """
+
+    # (overhead in seconds, seconds per unit of work)
+    priors = { 'numpy':  (5e-5, 2e-9),
+               'openmp': (2e-5, 4e-10),
+               'tbb':    (3e-5, 4e-10),
+               'cilk':   (3e-5, 4e-10),
+               'cuda':   (1e-3, 1e-11) }
+
+    def __init__(self, decay=0.95):
+        self.decay = decay
+        self.stats = {} # (backend, call, cvtype) -> decayed [count, sum w, sum t, sum w*w, sum w*t]
+
+    def work(self, call, N, M, D, cvtype, iters=1):
+        if cvtype == 'full':
+            per_event = M*D*D
+        elif cvtype == 'tied':
+            per_event = D*D + M*D # whitening, then diagonal distances
+        else:
+            per_event = M*D
+        if call == 'train':
+            return 3.0*N*per_event*max(iters, 1) # E-step plus the mean and covariance passes
+        return float(N*per_event)
+
+    def coefficients(self, backend, call, cvtype):
+        prior = self.priors.get(backend, (1e-4, 1e-9))
+        stats = self.stats.get((backend, call, cvtype))
+        if stats is None:
+            return prior
+        n, sw, st, sww, swt = stats
+        mean_w, mean_t = sw/n, st/n
+        var_w = sww/n - mean_w*mean_w
+        if var_w > 1e-6*mean_w*mean_w:
+            rate = (swt/n - mean_w*mean_t)/var_w
+            overhead = mean_t - rate*mean_w
+            if rate > 0 and overhead >= 0:
+                return overhead, rate
+        # Not enough spread in the observed sizes for a fit: scale the prior to match the observations
+        scale = mean_t/(prior[0] + prior[1]*mean_w)
+        return prior[0]*scale, prior[1]*scale
+
+    def predict(self, backend, call, N, M, D, cvtype, iters=1):
+        overhead, rate = self.coefficients(backend, call, cvtype)
+        return overhead + rate*self.work(call, N, M, D, cvtype, iters)
+
+    def choose(self, backends, call, N, M, D, cvtype, iters=1):
+        return min(backends, key=lambda b: self.predict(b, call, N, M, D, cvtype, iters))
+
+    def record(self, backend, call, N, M, D, cvtype, seconds, iters=1):
+        w = self.work(call, N, M, D, cvtype, iters)
+        stats = self.stats.setdefault((backend, call, cvtype), [0.0]*5)
+        for i, x in enumerate((1.0, w, seconds, w*w, w*seconds)):
+            stats[i] = stats[i]*self.decay + x
+
+class GMMNativeThreadRelease(object):
+    """
+    Frees one backend's native buffers for the thread that created it. Each thread's GMMNativeState holds one, and
+    Python drops a thread's thread-local state as the thread exits, so its buffers are freed then.
+    """
+
+    def __init__(self, backend_name):
+        self.backend_name = backend_name
+        self.thread_id = get_ident()
+
+    def release(self):
+        asp_mod = GMM.asp_mods.get(self.backend_name)
+        if asp_mod is None: return
+        asp_mod.dealloc_thread_state_on_CPU()
+        if self.backend_name == 'cuda':
+            asp_mod.dealloc_thread_state_on_GPU()
+        GMM.native_state_releases += 1
+
+    def __del__(self):
+        # Another thread's buffers are out of reach, and at interpreter exit the module may be gone
+        if GMM is None or get_ident() != self.thread_id: return
+        self.release()
+
+class GMMNativeState(threading.local):
+    """
+    Tracks which event, component and eval data the native side of one backend currently points at.
+    The native state is thread local, so this is too: each Python thread allocates its own copies, which are freed
+    when the thread exits (see GMMNativeThreadRelease) or earlier by release_native_state.
+    """
+
+    def __init__(self, backend_name):
+        self.reset()
+        self.thread_release = GMMNativeThreadRelease(backend_name)
+
+    def reset(self):
+        self.event_data_gpu_copy = None
+        self.event_data_cpu_copy = None
+        self.event_data_gpu_capacity = 0
+        self.component_data_gpu_copy = None
+        self.component_data_cpu_copy = None
+        self.component_data_version = None
+        self.eval_data_gpu_copy = None
+        self.eval_data_cpu_copy = None
+        self.eval_data_buffer = None
+        self.eval_data_redirected = False
+        self.index_list_data_gpu_copy = None
+        self.index_list_data_cpu_copy = None
+
+    def release(self):
+        self.thread_release.release()
+        self.reset()
+
+class GMMPlatformProbe(object):
+    """
+    Compiler, CUDA device and CPU queries made through asp's PlatformDetector, cached in a JSON file so that
+    new processes can skip them. Cached results older than ttl seconds are discarded; a ttl of 0 disables the
+    cache. detector_factory makes the detector on the first cache miss; by default it imports asp's
+    PlatformDetector then.
+    """
+
+    def __init__(self, path=PLATFORM_CACHE_FILE, ttl=PLATFORM_CACHE_TTL, detector_factory=None):
+        self.path = path
+        self.ttl = ttl
+        self.detector_factory = detector_factory or GMMPlatformProbe.asp_detector
+        self.detector = None
+        self.probes = 0 # queries that missed the cache
+        self.results = {}
+        if ttl > 0:
+            try:
+                with open(path) as f:
+                    cached = json.load(f)
+                if 0 <= time.time() - cached['time'] < ttl:
+                    self.results = cached
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                pass
+        self.results.setdefault('time', time.time())
+
+    def query(self, key, probe):
+        if key not in self.results:
+            if self.detector is None:
+                self.detector = self.detector_factory()
+            self.results[key] = probe(self.detector)
+            self.probes += 1
+            self.save()
+        return self.results[key]
+
+    @staticmethod
+    def asp_detector():
+        from asp.config import PlatformDetector
+        return PlatformDetector()
+
+    def save(self):
+        if self.ttl <= 0: return
+        # Write then rename, so a concurrent reader never sees a partial file; the cache is only an optimization
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp_path = "%s.%d" % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self.results, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError, TypeError, ValueError):
+            pass
+
+    def get_compilers(self):
+        return self.query('compilers', lambda detector: list(detector.get_compilers()))
+
+    def get_num_cuda_devices(self):
+        return self.query('num_cuda_devices', lambda detector: detector.get_num_cuda_devices())
+
+    def get_cuda_info(self, device_id):
+        def probe(detector):
+            detector.set_cuda_device(device_id)
+            return detector.get_cuda_info()
+        return self.query('cuda_info_%s' % device_id, probe)
+
+    def get_cpu_info(self):
+        return self.query('cpu_info', lambda detector: detector.get_cpu_info())
+
+class GMMPlatform(type):
+    """
+    Metaclass of GMM. The specializer configuration (GMM.config, GMM.autotune, ...) and platform features
+    (GMM.platform_info, GMM.native_backends, ...) are looked up the first time one of them is used, instead of
+    when this module is imported. The asp_config.yml options platform_cache_ttl and platform_cache_file
+    control the probe cache.
+    """
+
+    platform_lock = threading.Lock()
+    platform_state = None
+
+    def detect_platform(cls):
+        if GMMPlatform.platform_state is not None: return GMMPlatform.platform_state
+        with GMMPlatform.platform_lock:
+            if GMMPlatform.platform_state is not None: return GMMPlatform.platform_state
+            from asp.config import ConfigReader
+            #TODO: We track this stuff in singleton variables because this specializer only supports using one backend device for all GMM instances running from the same config file.
+            config = ConfigReader('GMM')
+            ttl = config.get_option('platform_cache_ttl')
+            probe = GMMPlatformProbe(config.get_option('platform_cache_file') or PLATFORM_CACHE_FILE,
+                                     PLATFORM_CACHE_TTL if ttl is None else ttl)
+            cuda_device_id = config.get_option('cuda_device_id')
+            #name_of_backend_to_use may name several backends, e.g. "tbb, cuda"; each train/eval call is dispatched to one of them
+            names_of_backends_to_use = config.get_option('name_of_backend_to_use')
+            if isinstance(names_of_backends_to_use, basestring):
+                names_of_backends_to_use = [name.strip() for name in names_of_backends_to_use.split(',')]
+            platform_info = {}
+            if 'cuda' in names_of_backends_to_use:
+                if 'nvcc' in probe.get_compilers() and probe.get_num_cuda_devices() > 0:
+                    platform_info['cuda'] = probe.get_cuda_info(cuda_device_id)
+                else: print "WARNING: You asked for a CUDA backend but no compiler was found or no cuda device are detected by the CUDA driver."
+            if 'cilk' in names_of_backends_to_use:
+                if 'icc' in probe.get_compilers():
+                    platform_info['cilk'] = probe.get_cpu_info()
+                else: print "WARNING: You asked for a Cilk backend but no compiler was found."
+            if 'tbb' in names_of_backends_to_use:
+                if 'gcc' in probe.get_compilers():
+                    platform_info['tbb'] = probe.get_cpu_info()
+                else: print "WARNING: You asked for a TBB backend but no compiler was found."
+            if 'openmp' in names_of_backends_to_use:
+                if 'gcc' in probe.get_compilers():
+                    platform_info['openmp'] = probe.get_cpu_info()
+                else: print "WARNING: You asked for an OpenMP backend but no compiler was found."
+
+            #Compiled backends in the configured order, plus the pure numpy backend, which is always available
+            native_backends = filter(lambda name, info=platform_info: name in info, names_of_backends_to_use)
+            GMMPlatform.platform_state = {
+                'platform': probe,
+                'config': config,
+                'cuda_device_id': cuda_device_id,
+                'autotune': config.get_option('autotune'),
+                'names_of_backends_to_use': names_of_backends_to_use,
+                'use_cuda': 'cuda' in platform_info,
+                'use_cilk': 'cilk' in platform_info,
+                'use_tbb': 'tbb' in platform_info,
+                'use_openmp': 'openmp' in platform_info,
+                'platform_info': platform_info,
+                'native_backends': native_backends,
+                'available_backends': native_backends + ['numpy'],
+                'default_native_backend': native_backends[0] if native_backends else None }
+            return GMMPlatform.platform_state
+
+    def _platform_attr(name):
+        return property(lambda cls: cls.detect_platform()[name])
+    platform = _platform_attr('platform')
+    config = _platform_attr('config')
+    cuda_device_id = _platform_attr('cuda_device_id')
+    autotune = _platform_attr('autotune')
+    names_of_backends_to_use = _platform_attr('names_of_backends_to_use')
+    use_cuda = _platform_attr('use_cuda')
+    use_cilk = _platform_attr('use_cilk')
+    use_tbb = _platform_attr('use_tbb')
+    use_openmp = _platform_attr('use_openmp')
+    platform_info = _platform_attr('platform_info')
+    native_backends = _platform_attr('native_backends')
+    available_backends = _platform_attr('available_backends')
+    default_native_backend = _platform_attr('default_native_backend')
+    del _platform_attr
 
 class GMM(object):
     """
     The specialized GMM abstraction.
     """
 
-    #Checking specializer configuration, compiler availability and platform features.
-    #TODO: We track this stuff in singleton variables because this specializer only supports using one backend device for all GMM instances running from the same config file.
-    platform = PlatformDetector()
-    config = ConfigReader('GMM')
-    cuda_device_id = config.get_option('cuda_device_id')
-    autotune = config.get_option('autotune')
-    names_of_backends_to_use = [config.get_option('name_of_backend_to_use')] #TODO: how to specify multiple backends in config file?
-    use_cuda = False
-    use_cilk = False
-    use_tbb  = False
-    platform_info = {}
-    if 'cuda' in names_of_backends_to_use:
-        if 'nvcc' in platform.get_compilers() and platform.get_num_cuda_devices() > 0:
-            use_cuda = True
-            platform.set_cuda_device(cuda_device_id)
-            platform_info['cuda'] = platform.get_cuda_info()
-        else: print "WARNING: You asked for a CUDA backend but no compiler was found or no cuda device are detected by the CUDA driver."
-    if 'cilk' in names_of_backends_to_use:
-        if 'icc' in platform.get_compilers():
-            use_cilk = True
-            platform_info['cilk'] = platform.get_cpu_info()
-        else: print "WARNING: You asked for a Cilk backend but no compiler was found."
-    if 'tbb' in names_of_backends_to_use:
-        if 'gcc' in platform.get_compilers():
-            use_tbb = True
-            platform_info['tbb'] = platform.get_cpu_info()
-        else: print "WARNING: You asked for a TBB backend but no compiler was found."
-
-    #Singleton ASP module shared by all instances of GMM. This tracks all the internal representation of specialized functions.
-    asp_mod = None    
-    def get_asp_mod(self): return GMM.asp_mod or self.initialize_asp_mod()
+    __metaclass__ = GMMPlatform
+
+    #Every backend name a GMM can be pinned to; which of them are usable depends on the platform
+    backend_names = ['cuda', 'cilk', 'tbb', 'openmp', 'numpy']
+
+    #One ASP module per compiled backend, shared by all instances of GMM and built the first time a call is dispatched to that backend.
+    #asp_mod is the module currently being built.
+    asp_mods = {}
+    asp_mod = None
+    asp_mod_lock = threading.Lock()
+    def get_asp_mod(self, backend_name=None):
+        backend_name = backend_name or self.active_backend
+        return GMM.asp_mods.get(backend_name) or self.initialize_asp_mod(backend_name)
+
+    #Predicts which backend is fastest for each call
+    cost_model = GMMCostModel()
+    warm_backends = set()
 
     #Internal defaults for the specializer. Application writes shouldn't have to know about these, but changing them might affect the API.
-    cvtype_name_list = ['diag','full'] #Types of covariance matrix
+    cvtype_name_list = ['diag','full','spherical','tied'] #Types of covariance matrix
+    #Backends that only implement some of the cvtypes
+    backend_cvtypes = { 'cuda': ['diag','full'] }
+    #Backends whose train kernels also run the sparse M-step and classification EM; on the others train drives
+    #them from Python
+    train_option_backends = ['tbb', 'openmp', 'cilk']
     variant_param_default = { 'c++': {'dummy': ['1']},
         'cuda': {
             'num_blocks_estep': ['16'],
@@ -109,7 +554,10 @@ class GMM(object):
             'max_num_components_covar_v3': ['81'],
             'covar_version_name': ['V1'] },
         'cilk': {'dummy': ['1']},
-        'tbb': {'dummy': ['1']}
+        'tbb': {'dummy': ['1']},
+        'openmp': {
+            'schedule': ['static'],
+            'chunk_size': ['0'] } # 0 leaves the chunk size to the OpenMP runtime
     }
     variant_param_autotune = { 'c++': {'dummy': ['1']},
         'cuda': {
@@ -123,9 +571,15 @@ class GMM(object):
             'max_num_components_covar_v3': ['81'],
             'covar_version_name': ['V1','V2A','V2B','V3'] },
         'cilk': {'dummy': ['1']},
-        'tbb': {'dummy': ['1']}
+        'tbb': {'dummy': ['1']},
+        'openmp': {
+            'schedule': ['static','dynamic','guided'],
+            'chunk_size': ['0','64','1024'] }
     }
 
+    #ASP has no OpenMP backend of its own, so that code is compiled into the c++ module with -fopenmp
+    asp_backend_names = { 'openmp': 'c++' }
+
     #Functions used to evaluate whether a particular code variant can be compiled or successfully run a particular input
 
     def cuda_compilable_limits(param_dict, gpu_info):
@@ -166,6 +620,7 @@ class GMM(object):
         'c++':  lambda param_dict, device: True,
         'cilk': lambda param_dict, device: True,
         'tbb': lambda param_dict, device: True,
+        'openmp': lambda param_dict, device: True,
         'cuda': cuda_compilable_limits
     }
 
@@ -206,12 +661,15 @@ class GMM(object):
         'c++':  lambda param_dict, device: lambda *args, **kwargs: True,
         'cilk': lambda param_dict, device: lambda *args, **kwargs: True,
         'tbb': lambda param_dict, device: lambda *args, **kwargs: True,
+        'openmp': lambda param_dict, device: lambda *args, **kwargs: True,
         'cuda': cuda_runable_limits
     }
 
     #Functions used in the template rendering process, specific to particular backends
 
     def cuda_backend_render_func(self, param_dict, vals):
+        import asp.codegen.templating.template as AspTemplate
+        from codepy.cgen import Line
         param_dict['supports_float32_atomic_add'] = GMM.platform_info['cuda']['supports_float32_atomic_add']
         cu_kern_tpl = AspTemplate.Template(filename="templates/em_cuda_kernels.mako")
         cu_kern_rend = cu_kern_tpl.render( param_val_list = vals, **param_dict)
@@ -221,6 +679,8 @@ class GMM(object):
         GMM.asp_mod.add_to_preamble(c_decl_rend,'c++') #TODO: <4.1 hack
         
     def cilk_backend_render_func(self, param_dict, vals):
+        import asp.codegen.templating.template as AspTemplate
+        from codepy.cgen import Line
         cilk_kern_tpl = AspTemplate.Template(filename="templates/em_cilk_kernels.mako")
         cilk_kern_rend = cilk_kern_tpl.render( param_val_list = vals, **param_dict)
         GMM.asp_mod.add_to_module([Line(cilk_kern_rend)],'cilk')
@@ -229,6 +689,8 @@ class GMM(object):
         #GMM.asp_mod.add_to_preamble(c_decl_rend,'cilk')
 
     def tbb_backend_render_func(self, param_dict, vals):
+        import asp.codegen.templating.template as AspTemplate
+        from codepy.cgen import Line
         tbb_kern_tpl = AspTemplate.Template(filename="templates/em_tbb_kernels.mako")
         tbb_kern_rend = tbb_kern_tpl.render( param_val_list = vals, **param_dict)
         GMM.asp_mod.add_to_module([Line(tbb_kern_rend)],'tbb')
@@ -236,138 +698,195 @@ class GMM(object):
         c_decl_rend  = c_decl_tpl.render( param_val_list = vals, **param_dict)
         #GMM.asp_mod.add_to_preamble(c_decl_rend,'tbb')
 
+    def openmp_backend_render_func(self, param_dict, vals):
+        import asp.codegen.templating.template as AspTemplate
+        from codepy.cgen import Line
+        openmp_kern_tpl = AspTemplate.Template(filename="templates/em_openmp_kernels.mako")
+        openmp_kern_rend = openmp_kern_tpl.render( param_val_list = vals, **param_dict)
+        GMM.asp_mod.add_to_module([Line(openmp_kern_rend)],'c++')
+
     backend_specific_render_funcs = {
         'c++': lambda param_dict, vals: None,
         'cilk': cilk_backend_render_func,
         'tbb': tbb_backend_render_func,
+        'openmp': openmp_backend_render_func,
         'cuda': cuda_backend_render_func
     }
 
-    #Flags to keep track of memory allocations, singletons
-    event_data_gpu_copy = None
-    event_data_cpu_copy = None
-    component_data_gpu_copy = None
-    component_data_cpu_copy = None
-    eval_data_gpu_copy = None
-    eval_data_cpu_copy = None
-    index_list_data_gpu_copy = None
-    index_list_data_cpu_copy = None
-    log_table_allocated = None
+    #Flags to keep track of memory allocations, one set per compiled backend
+    native_states = {}
+    log_table_allocated = set()
+
+    @property
+    def native_state(self):
+        state = GMM.native_states.get(self.active_backend)
+        if state is None:
+            state = GMM.native_states.setdefault(self.active_backend, GMMNativeState(self.active_backend))
+        return state
+
+    #Counters of how often the event and eval buffers had to grow
+    event_data_reallocs = 0
+    eval_data_reallocs = 0
+    #Counters of input copies: made in Python for arrays the native code cannot read as they are, and made by the
+    #native code for event data that is not C-contiguous float32 (the transposed layout is built in the same pass)
+    input_copies = 0
+    event_data_copies = 0
+    #Counter of per-thread native states freed, by release_native_state or at thread exit
+    native_state_releases = 0
     
     #Internal functions to allocate and deallocate component and event data on the CPU and GPU
     def internal_alloc_event_data(self, X):
-        #if not np.array_equal(GMM.event_data_cpu_copy, X) and X is not None:
-        if GMM.event_data_cpu_copy is not None:
-            self.internal_free_event_data()
-        self.get_asp_mod().alloc_events_on_CPU(X)
-        GMM.event_data_cpu_copy = X
-        if GMM.use_cuda:
-            self.get_asp_mod().alloc_events_on_GPU(X.shape[0], X.shape[1])
+        #if not np.array_equal(self.native_state.event_data_cpu_copy, X) and X is not None:
+        X = native_array(X, ndim=2, dtypes=(np.float32, np.float64), contiguous=False)
+        reallocated, converted = self.get_asp_mod().alloc_events_on_CPU(X)
+        if reallocated:
+            GMM.event_data_reallocs += 1
+        if converted:
+            GMM.event_data_copies += 1
+        # The native side may point straight into X, so keep it alive while it is loaded
+        self.native_state.event_data_cpu_copy = X
+        if self.active_backend == 'cuda':
+            size = X.shape[0]*X.shape[1]
+            if self.native_state.event_data_gpu_copy is None or size > self.native_state.event_data_gpu_capacity:
+                if self.native_state.event_data_gpu_copy is not None:
+                    self.get_asp_mod().dealloc_events_on_GPU()
+                self.native_state.event_data_gpu_capacity = max(size, 2*self.native_state.event_data_gpu_capacity)
+                self.get_asp_mod().alloc_events_on_GPU(self.native_state.event_data_gpu_capacity, 1)
+                GMM.event_data_reallocs += 1
             self.get_asp_mod().copy_event_data_CPU_to_GPU(X.shape[0], X.shape[1])
-            GMM.event_data_gpu_copy = X
+            self.native_state.event_data_gpu_copy = X
 
     def internal_free_event_data(self):
         if GMM is None: return
-        if GMM.event_data_cpu_copy is not None:
+        if self.native_state.event_data_cpu_copy is not None:
             self.get_asp_mod().dealloc_events_on_CPU()
-            GMM.event_data_cpu_copy = None
-        if GMM.event_data_gpu_copy is not None:
+            self.native_state.event_data_cpu_copy = None
+        if self.native_state.event_data_gpu_copy is not None:
             self.get_asp_mod().dealloc_events_on_GPU()
-            GMM.event_data_gpu_copy = None
+            self.native_state.event_data_gpu_copy = None
+            self.native_state.event_data_gpu_capacity = 0
 
     def internal_alloc_event_data_from_index(self, X, I):
-        #if not np.array_equal(GMM.event_data_gpu_copy, X) and X is not None:
-        if GMM.event_data_cpu_copy is not None:
+        #if not np.array_equal(self.native_state.event_data_gpu_copy, X) and X is not None:
+        if self.native_state.event_data_cpu_copy is not None:
             self.internal_free_event_data()
+        X = native_array(X, ndim=2)
+        I = native_array(I, ndim=1, dtypes=(np.int32,))
         self.get_asp_mod().alloc_events_from_index_on_CPU(X, I, I.shape[0], X.shape[1])
-        GMM.event_data_cpu_copy = X
-        if GMM.use_cuda:
+        self.native_state.event_data_cpu_copy = X
+        if self.active_backend == 'cuda':
             self.get_asp_mod().alloc_events_from_index_on_GPU(I.shape[0], X.shape[1])
             self.get_asp_mod().copy_events_from_index_CPU_to_GPU(I.shape[0], X.shape[1])
-            GMM.event_data_gpu_copy = X
+            self.native_state.event_data_gpu_copy = X
             
     def internal_alloc_index_list_data(self, X):
         # allocate index list for accessing subset of events
-        if not np.array_equal(GMM.index_list_data_cpu_copy, X) and X is not None:
-            if GMM.index_list_data_cpu_copy is not None:
+        if not np.array_equal(self.native_state.index_list_data_cpu_copy, X) and X is not None:
+            if self.native_state.index_list_data_cpu_copy is not None:
                 self.internal_free_index_list_data()
             self.get_asp_mod().alloc_index_list_on_CPU(X)
-            GMM.index_list_data_cpu_copy = X
-            if GMM.use_cuda:
+            self.native_state.index_list_data_cpu_copy = X
+            if self.active_backend == 'cuda':
                 self.get_asp_mod().alloc_index_list_on_GPU(X.shape[0])
                 self.get_asp_mod().copy_index_list_data_CPU_to_GPU(X.shape[0])
-                GMM.index_list_data_gpu_copy = X
+                self.native_state.index_list_data_gpu_copy = X
                 
     def internal_free_index_list_data(self):
         if GMM is None: return
-        if GMM.index_list_data_gpu_copy is not None:
+        if self.native_state.index_list_data_gpu_copy is not None:
             self.get_asp_mod().dealloc_index_list_on_GPU()
-            GMM.index_list_data_gpu_copy = None
-        if GMM.index_list_data_cpu_copy is not None:
+            self.native_state.index_list_data_gpu_copy = None
+        if self.native_state.index_list_data_cpu_copy is not None:
             self.get_asp_mod().dealloc_index_list_on_CPU()
-            GMM.index_list_data_cpu_copy = None
+            self.native_state.index_list_data_cpu_copy = None
                 
     def internal_alloc_component_data(self):
-        if GMM.component_data_cpu_copy != self.components:
-            if GMM.component_data_cpu_copy:
+        if self.native_state.component_data_cpu_copy != self.components:
+            if self.native_state.component_data_cpu_copy:
                 self.internal_free_component_data()
-            self.get_asp_mod().alloc_components_on_CPU(self.M, self.D, self.components.weights, self.components.means, self.components.covars, self.components.comp_probs)
-            GMM.component_data_cpu_copy = self.components
-            if GMM.use_cuda:
+            self.get_asp_mod().alloc_components_on_CPU(self.M, self.D, self.components.weights, self.components.means, self.components.covars, self.components.comp_probs, self.components.Rinv, self.components.constant)
+            self.native_state.component_data_cpu_copy = self.components
+            if self.active_backend == 'cuda':
                 self.get_asp_mod().alloc_components_on_GPU(self.M, self.D)
-                self.get_asp_mod().copy_component_data_CPU_to_GPU(self.M, self.D)
-                GMM.component_data_gpu_copy = self.components
+                self.get_asp_mod().copy_component_data_CPU_to_GPU(self.M, self.D, int(self.cvtype == 'diag'))
+                self.native_state.component_data_gpu_copy = self.components
+        elif self.native_state.component_data_version != self.components.version:
+            # Parameters were edited since the native side last saw them
+            self.get_asp_mod().relink_components_on_CPU(self.components.weights, self.components.means, self.components.covars, self.components.comp_probs, self.components.Rinv, self.components.constant)
+            if self.active_backend == 'cuda':
+                self.get_asp_mod().copy_component_data_CPU_to_GPU(self.M, self.D, int(self.cvtype == 'diag'))
+        self.native_state.component_data_version = self.components.version
             
     def internal_free_component_data(self):
         if GMM is None: return
-        if GMM.component_data_cpu_copy is not None:
+        if self.native_state.component_data_cpu_copy is not None:
             self.get_asp_mod().dealloc_components_on_CPU()
-            GMM.component_data_cpu_copy = None
-        if GMM.component_data_gpu_copy is not None:
+            self.native_state.component_data_cpu_copy = None
+        if self.native_state.component_data_gpu_copy is not None:
             self.get_asp_mod().dealloc_components_on_GPU()
-            GMM.component_data_gpu_copy = None
+            self.native_state.component_data_gpu_copy = None
 
     def internal_alloc_eval_data(self, X):
         if X is not None:
-            if self.eval_data.M != self.M or self.eval_data.N != X.shape[0] or GMM.eval_data_cpu_copy != self.eval_data:
-                if GMM.eval_data_cpu_copy is not None:
+            if self.eval_data.resize(X.shape[0], self.M):
+                GMM.eval_data_reallocs += 1
+            # Rebind whenever the buffers were reallocated, here or by another backend since this one last saw them
+            if self.native_state.eval_data_cpu_copy != self.eval_data or self.native_state.eval_data_buffer is not self.eval_data.memberships_buffer:
+                if self.native_state.eval_data_cpu_copy is not None:
                     self.internal_free_eval_data()
-                self.eval_data.resize(X.shape[0], self.M)
-                self.get_asp_mod().alloc_evals_on_CPU(self.eval_data.memberships, self.eval_data.loglikelihoods)
-                GMM.eval_data_cpu_copy = self.eval_data
-                if GMM.use_cuda:
-                    self.get_asp_mod().alloc_evals_on_GPU(X.shape[0], self.M)
-                    GMM.eval_data_gpu_copy = self.eval_data
+                self.get_asp_mod().alloc_evals_on_CPU(self.eval_data.memberships_buffer, self.eval_data.loglikelihoods_buffer)
+                self.native_state.eval_data_cpu_copy = self.eval_data
+                self.native_state.eval_data_buffer = self.eval_data.memberships_buffer
+                if self.active_backend == 'cuda':
+                    self.get_asp_mod().alloc_evals_on_GPU(self.eval_data.N_capacity, self.eval_data.M_capacity)
+                    self.native_state.eval_data_gpu_copy = self.eval_data
+            elif self.native_state.eval_data_redirected:
+                # The last eval wrote into caller-supplied arrays; only the host pointers need to come back
+                self.get_asp_mod().alloc_evals_on_CPU(self.eval_data.memberships_buffer, self.eval_data.loglikelihoods_buffer)
+            self.native_state.eval_data_redirected = False
+
+    def internal_redirect_eval_data(self, logprob_out, posterior_out):
+        # Point the native eval outputs at caller-supplied arrays for one call; internal_alloc_eval_data points them back
+        memberships = posterior_out if posterior_out is not None else self.eval_data.memberships_buffer
+        loglikelihoods = logprob_out if logprob_out is not None else self.eval_data.loglikelihoods_buffer
+        self.get_asp_mod().alloc_evals_on_CPU(memberships, loglikelihoods)
+        self.native_state.eval_data_redirected = True
 
     def internal_alloc_eval_data_from_index(self, X, length):
         if X is not None:
-            if GMM.eval_data_gpu_copy is not None:
+            if self.native_state.eval_data_gpu_copy is not None:
                 self.internal_free_eval_data()
-            self.eval_data.resize(X.shape[0], self.M)
-            self.get_asp_mod().alloc_evals_on_CPU(self.eval_data.memberships, self.eval_data.loglikelihoods)
-            GMM.eval_data_cpu_copy = self.eval_data
-            if GMM.use_cuda:
-                self.get_asp_mod().alloc_evals_on_GPU(length, self.M)
-                GMM.eval_data_gpu_copy = self.eval_data
+            if self.eval_data.resize(X.shape[0], self.M):
+                GMM.eval_data_reallocs += 1
+            self.get_asp_mod().alloc_evals_on_CPU(self.eval_data.memberships_buffer, self.eval_data.loglikelihoods_buffer)
+            self.native_state.eval_data_cpu_copy = self.eval_data
+            self.native_state.eval_data_buffer = self.eval_data.memberships_buffer
+            if self.active_backend == 'cuda':
+                self.get_asp_mod().alloc_evals_on_GPU(max(length, self.eval_data.N_capacity), self.eval_data.M_capacity)
+                self.native_state.eval_data_gpu_copy = self.eval_data
 
     def internal_free_eval_data(self):
         if GMM is None: return
-        if GMM.eval_data_cpu_copy is not None:
+        if self.native_state.eval_data_cpu_copy is not None:
             self.get_asp_mod().dealloc_evals_on_CPU()
-            GMM.eval_data_cpu_copy = None
-        if GMM.eval_data_gpu_copy is not None:
+            self.native_state.eval_data_cpu_copy = None
+            self.native_state.eval_data_buffer = None
+            self.native_state.eval_data_redirected = False
+        if self.native_state.eval_data_gpu_copy is not None:
             self.get_asp_mod().dealloc_evals_on_GPU()
-            GMM.eval_data_gpu_copy = None
+            self.native_state.eval_data_gpu_copy = None
 
     def internal_seed_data(self, X, D, N):
         getattr(self.get_asp_mod(),'seed_components_'+self.cvtype)(self.M, D, N)
         self.components_seeded = True
-        if GMM.use_cuda:
-            self.get_asp_mod().copy_component_data_GPU_to_CPU(self.M, D)
+        if self.active_backend == 'cuda':
+            self.get_asp_mod().copy_component_data_GPU_to_CPU(self.M, D, int(self.cvtype == 'diag'))
 
-    def __init__(self, M, D, means=None, covars=None, weights=None, cvtype='diag'): 
+    def __init__(self, M, D, means=None, covars=None, weights=None, cvtype='diag', backend=None): 
         """
-        cvtype must be one of 'diag' or 'full'. Uninitialized components will be seeded.
+        cvtype must be one of 'diag', 'full', 'spherical' (one variance per component) or 'tied' (one full covariance
+        shared by all components). Uninitialized components will be seeded.
+        backend pins train and eval to one of GMM.available_backends; by default the cost model picks one per call.
         """
         self.M = M
         self.D = D
@@ -375,11 +894,17 @@ class GMM(object):
             self.cvtype = cvtype 
         else:
             raise RuntimeError("Specified cvtype is not allowed, try one of " + str(GMM.cvtype_name_list))
-
-        self.variant_param_spaces = GMM.variant_param_autotune if GMM.autotune else GMM.variant_param_default
-        self.names_of_backends_to_use = GMM.names_of_backends_to_use
-        self.components = GMMComponents(M, D, weights, means, covars)
+        if backend is not None and backend not in GMM.backend_names:
+            raise RuntimeError("Specified backend is not allowed, try one of " + str(GMM.backend_names))
+        # Whether a pinned backend is actually available is only checked at its first use, which is also when the platform is probed
+        self.backend = backend
+        self.active_backend = backend if backend != 'numpy' else None
+        self.selected_backend = backend
+
+        self.components = GMMComponents(M, D, weights, means, covars, cvtype=cvtype)
         self.eval_data = GMMEvalData(1, M)
+        self.gaussian_selection = None
+        self.stream_state = None
         self.clf = None # pure python mirror module
 
         if means is None and covars is None and weights is None:
@@ -388,39 +913,54 @@ class GMM(object):
             self.components_seeded = True
 
     #Called the first time a GMM instance tries to use a specialized function
-    def initialize_asp_mod(self):
-        # Create ASP module
-        GMM.asp_mod = asp_module.ASPModule(use_cuda=GMM.use_cuda, use_cilk=GMM.use_cilk, use_tbb=GMM.use_tbb)
-
-        if GMM.use_cuda:
-            self.insert_base_code_into_listed_modules(['c++'])
-            self.insert_non_rendered_code_into_cuda_module()
-            self.insert_rendered_code_into_module('cuda')
-            GMM.asp_mod.backends['cuda'].toolchain.cflags.extend(["-Xcompiler","-fPIC","-arch=sm_%s%s" % GMM.platform_info['cuda']['capability'] ])
-            GMM.asp_mod.backends['c++'].compilable = False # TODO: For now, must force ONLY cuda backend to compile
-
-        if GMM.use_cilk:
-            self.insert_base_code_into_listed_modules(['cilk'])
-            self.insert_non_rendered_code_into_cilk_module()
-            self.insert_rendered_code_into_module('cilk')
-            GMM.asp_mod.backends['cilk'].toolchain.cc = 'icc'
-            GMM.asp_mod.backends['cilk'].toolchain.cflags = ['-O2','-gcc', '-ip','-fPIC']
-
-        if GMM.use_tbb:
-            self.insert_base_code_into_listed_modules(['tbb'])
-            self.insert_non_rendered_code_into_tbb_module()
-            self.insert_rendered_code_into_module('tbb')
-
-        # Setup toolchain
-	from codepy.libraries import add_numpy, add_boost_python, add_cuda
-        for name, mod in GMM.asp_mod.backends.iteritems():
-            add_numpy(mod.toolchain)
-            add_boost_python(mod.toolchain)
-            if name in ['cuda']:
-                add_cuda(mod.toolchain) 
-        return GMM.asp_mod
+    def initialize_asp_mod(self, backend_name):
+        import asp.jit.asp_module as asp_module
+        with GMM.asp_mod_lock:
+            if backend_name in GMM.asp_mods: return GMM.asp_mods[backend_name]
+            if backend_name not in GMM.native_backends:
+                raise RuntimeError("No compiled backend available for %s, try one of %s" % (backend_name, str(GMM.native_backends)))
+            # Create ASP module
+            GMM.asp_mod = asp_module.ASPModule(use_cuda=(backend_name == 'cuda'), use_cilk=(backend_name == 'cilk'), use_tbb=(backend_name == 'tbb'))
+
+            if backend_name == 'cuda':
+                self.insert_base_code_into_listed_modules(['c++'])
+                self.insert_non_rendered_code_into_cuda_module()
+                self.insert_rendered_code_into_module('cuda')
+                GMM.asp_mod.backends['cuda'].toolchain.cflags.extend(["-Xcompiler","-fPIC","-arch=sm_%s%s" % tuple(GMM.platform_info['cuda']['capability']) ])
+                GMM.asp_mod.backends['c++'].compilable = False # TODO: For now, must force ONLY cuda backend to compile
+
+            if backend_name == 'cilk':
+                self.insert_base_code_into_listed_modules(['cilk'])
+                self.insert_non_rendered_code_into_cilk_module()
+                self.insert_rendered_code_into_module('cilk')
+                GMM.asp_mod.backends['cilk'].toolchain.cc = 'icc'
+                GMM.asp_mod.backends['cilk'].toolchain.cflags = ['-O2','-gcc', '-ip','-fPIC']
+
+            if backend_name == 'tbb':
+                self.insert_base_code_into_listed_modules(['tbb'])
+                self.insert_non_rendered_code_into_tbb_module()
+                self.insert_rendered_code_into_module('tbb')
+
+            if backend_name == 'openmp':
+                self.insert_base_code_into_listed_modules(['c++'])
+                self.insert_non_rendered_code_into_openmp_module()
+                self.insert_rendered_code_into_module('openmp')
+                GMM.asp_mod.backends['c++'].toolchain.cflags.append('-fopenmp')
+                GMM.asp_mod.backends['c++'].toolchain.ldflags.append('-fopenmp')
+
+            # Setup toolchain
+            from codepy.libraries import add_numpy, add_boost_python, add_cuda
+            for name, mod in GMM.asp_mod.backends.iteritems():
+                add_numpy(mod.toolchain)
+                add_boost_python(mod.toolchain)
+                if name in ['cuda']:
+                    add_cuda(mod.toolchain) 
+            GMM.asp_mods[backend_name] = GMM.asp_mod
+        return GMM.asp_mods[backend_name]
 
     def insert_base_code_into_listed_modules(self, names_of_backends):
+        import asp.codegen.templating.template as AspTemplate
+        from codepy.cgen import Line, Include
         #Add code to all backends that is used by all backends
         c_base_tpl = AspTemplate.Template(filename="templates/em_base_helper_funcs.mako")
         c_base_rend = c_base_tpl.render()
@@ -432,11 +972,11 @@ class GMM(object):
                 float* constant; // Normalizing constant [M]
                 float* avgvar;    // average variance [M]
                 float* means;   // Spectral mean for the component: [M*D]
-                float* R;      // Covariance matrix: [M*D*D]
-                float* Rinv;   // Inverse of covariance matrix: [M*D*D]
+                float* R;      // Covariances, laid out as covars_shape(cvtype, M, D)
+                float* Rinv;   // Inverse covariances, laid out like R
             } components_t;"""
 
-        base_system_header_names = [ 'stdlib.h', 'stdio.h', 'string.h', 'math.h', 'time.h', 'numpy/arrayobject.h']
+        base_system_header_names = [ 'stdlib.h', 'stdio.h', 'string.h', 'math.h', 'time.h', 'numpy/arrayobject.h', 'vector', 'queue', 'functional', 'algorithm']
         for b_name in names_of_backends:
             for header in base_system_header_names: 
                 GMM.asp_mod.add_to_preamble([Include(header, True)], b_name)
@@ -444,15 +984,12 @@ class GMM(object):
             GMM.asp_mod.add_to_init("import_array();", b_name)
             GMM.asp_mod.add_to_init("""boost::python::class_<components_struct>("GMMComponents");
                 boost::python::scope().attr("components") = boost::python::object(boost::python::ptr(&components));""", b_name)
-            GMM.asp_mod.add_to_init("""
-                 boost::python::class_<return_component_container>("ReturnClusterContainer")
-                 .def_readwrite("new_component", &return_component_container::component)
-                 .def_readwrite("distance", &return_component_container::distance);
-                 boost::python::scope().attr("component_distance") = boost::python::object(boost::python::ptr(&ret));""", b_name)
             GMM.asp_mod.add_to_module([Line(c_base_rend)],b_name)
             GMM.asp_mod.add_to_preamble(component_t_decl, b_name)
 
     def insert_non_rendered_code_into_cuda_module(self):
+        import asp.codegen.templating.template as AspTemplate
+        from codepy.cgen import Line
         #Add C/CUDA source code that is not based on code variant parameters
 
         #Add decls to preamble necessary for linking to compiled CUDA sources
@@ -464,13 +1001,13 @@ class GMM(object):
                 float* constant; // Normalizing constant [M]
                 float* avgvar;    // average variance [M]
                 float* means;   // Spectral mean for the component: [M*D]
-                float* R;      // Covariance matrix: [M*D*D]
-                float* Rinv;   // Inverse of covariance matrix: [M*D*D]
+                float* R;      // Covariances, laid out as covars_shape(cvtype, M, D)
+                float* Rinv;   // Inverse covariances, laid out like R
             } components_t;"""
         GMM.asp_mod.add_to_preamble(component_t_decl,'cuda')
 
         #TODO: Move this back into insert_base_code_into_listed_modules for cuda 4.1
-        names_of_helper_funcs = ["alloc_events_on_CPU", "alloc_components_on_CPU", "alloc_evals_on_CPU", "dealloc_events_on_CPU", "dealloc_components_on_CPU", "dealloc_temp_components_on_CPU", "dealloc_evals_on_CPU", "relink_components_on_CPU", "compute_distance_rissanen", "merge_components", "create_lut_log_table", "compute_KL_distance"]
+        names_of_helper_funcs = ["alloc_events_on_CPU", "alloc_components_on_CPU", "alloc_evals_on_CPU", "dealloc_events_on_CPU", "dealloc_components_on_CPU", "dealloc_temp_components_on_CPU", "dealloc_evals_on_CPU", "dealloc_index_list_on_CPU", "dealloc_thread_state_on_CPU", "relink_components_on_CPU", "compute_distance_rissanen", "merge_components", "reduce_components", "supervector_statistics", "score_shortlist", "create_lut_log_table", "compute_KL_distance"]
         for fname in names_of_helper_funcs:
             GMM.asp_mod.add_helper_function(fname, "", 'cuda')
 
@@ -482,11 +1019,13 @@ class GMM(object):
         cu_base_rend = cu_base_tpl.render()
         GMM.asp_mod.add_to_module([Line(cu_base_rend)],'cuda')
         #Add Boost interface links for helper functions
-        names_of_cuda_helper_funcs = ["alloc_events_on_GPU","alloc_index_list_on_GPU", "alloc_events_from_index_on_GPU", "alloc_components_on_GPU","alloc_evals_on_GPU","copy_event_data_CPU_to_GPU", "copy_index_list_data_CPU_to_GPU", "copy_events_from_index_CPU_to_GPU", "copy_component_data_CPU_to_GPU", "copy_component_data_GPU_to_CPU", "copy_evals_CPU_to_GPU", "copy_evals_data_GPU_to_CPU","dealloc_events_on_GPU","dealloc_components_on_GPU", "dealloc_evals_on_GPU", "dealloc_index_list_on_GPU"] 
+        names_of_cuda_helper_funcs = ["alloc_events_on_GPU","alloc_index_list_on_GPU", "alloc_events_from_index_on_GPU", "alloc_components_on_GPU","alloc_evals_on_GPU","copy_event_data_CPU_to_GPU", "copy_index_list_data_CPU_to_GPU", "copy_events_from_index_CPU_to_GPU", "copy_component_data_CPU_to_GPU", "copy_component_data_GPU_to_CPU", "copy_evals_CPU_to_GPU", "copy_evals_data_GPU_to_CPU","dealloc_events_on_GPU","dealloc_components_on_GPU", "dealloc_evals_on_GPU", "dealloc_index_list_on_GPU", "dealloc_thread_state_on_GPU"] 
         for fname in names_of_cuda_helper_funcs:
             GMM.asp_mod.add_helper_function(fname,"",'cuda')
 
     def insert_non_rendered_code_into_cilk_module(self):
+        import asp.codegen.templating.template as AspTemplate
+        from codepy.cgen import Line, Include
         component_t_decl =""" 
             typedef struct components_struct {
                 float* N;        // expected # of pixels in component: [M]
@@ -495,13 +1034,13 @@ class GMM(object):
                 float* constant; // Normalizing constant [M]
                 float* avgvar;    // average variance [M]
                 float* means;   // Spectral mean for the component: [M*D]
-                float* R;      // Covariance matrix: [M*D*D]
-                float* Rinv;   // Inverse of covariance matrix: [M*D*D]
+                float* R;      // Covariances, laid out as covars_shape(cvtype, M, D)
+                float* Rinv;   // Inverse covariances, laid out like R
             } components_t;"""
         #GMM.asp_mod.add_to_preamble(component_t_decl,'cilk')
 
         #TODO: Move this back into insert_base_code_into_listed_modules for cuda 4.1
-        names_of_helper_funcs = ["alloc_events_on_CPU", "alloc_components_on_CPU", "alloc_evals_on_CPU", "dealloc_events_on_CPU", "dealloc_components_on_CPU", "dealloc_temp_components_on_CPU", "dealloc_evals_on_CPU", "relink_components_on_CPU", "compute_distance_rissanen", "merge_components", "create_lut_log_table", "compute_KL_distance"]
+        names_of_helper_funcs = ["alloc_events_on_CPU", "alloc_components_on_CPU", "alloc_evals_on_CPU", "dealloc_events_on_CPU", "dealloc_components_on_CPU", "dealloc_temp_components_on_CPU", "dealloc_evals_on_CPU", "dealloc_index_list_on_CPU", "dealloc_thread_state_on_CPU", "relink_components_on_CPU", "compute_distance_rissanen", "merge_components", "reduce_components", "supervector_statistics", "score_shortlist", "create_lut_log_table", "compute_KL_distance"]
         for fname in names_of_helper_funcs:
             GMM.asp_mod.add_helper_function(fname, "", 'cilk')
 
@@ -515,6 +1054,8 @@ class GMM(object):
             GMM.asp_mod.add_to_preamble([Include(x, True)],'cilk')
 
     def insert_non_rendered_code_into_tbb_module(self):
+        import asp.codegen.templating.template as AspTemplate
+        from codepy.cgen import Line, Include
         component_t_decl =""" 
             typedef struct components_struct {
                 float* N;        // expected # of pixels in component: [M]
@@ -523,13 +1064,13 @@ class GMM(object):
                 float* constant; // Normalizing constant [M]
                 float* avgvar;    // average variance [M]
                 float* means;   // Spectral mean for the component: [M*D]
-                float* R;      // Covariance matrix: [M*D*D]
-                float* Rinv;   // Inverse of covariance matrix: [M*D*D]
+                float* R;      // Covariances, laid out as covars_shape(cvtype, M, D)
+                float* Rinv;   // Inverse covariances, laid out like R
             } components_t;"""
         #GMM.asp_mod.add_to_preamble(component_t_decl,'tbb')
 
         #TODO: Move this back into insert_base_code_into_listed_modules for cuda 4.1
-        names_of_helper_funcs = ["alloc_events_on_CPU", "alloc_components_on_CPU", "alloc_evals_on_CPU", "dealloc_events_on_CPU", "dealloc_components_on_CPU", "dealloc_temp_components_on_CPU", "dealloc_evals_on_CPU", "relink_components_on_CPU", "compute_distance_rissanen", "merge_components", "create_lut_log_table", "compute_KL_distance"]
+        names_of_helper_funcs = ["alloc_events_on_CPU", "alloc_components_on_CPU", "alloc_evals_on_CPU", "dealloc_events_on_CPU", "dealloc_components_on_CPU", "dealloc_temp_components_on_CPU", "dealloc_evals_on_CPU", "dealloc_index_list_on_CPU", "dealloc_thread_state_on_CPU", "relink_components_on_CPU", "compute_distance_rissanen", "merge_components", "reduce_components", "supervector_statistics", "score_shortlist", "create_lut_log_table", "compute_KL_distance"]
         for fname in names_of_helper_funcs:
             GMM.asp_mod.add_helper_function(fname, "", 'tbb')
 
@@ -543,7 +1084,16 @@ class GMM(object):
         for x in system_header_names: 
             GMM.asp_mod.add_to_preamble([Include(x, True)],'tbb')
 
+    def insert_non_rendered_code_into_openmp_module(self):
+        from codepy.cgen import Include
+        names_of_helper_funcs = ["alloc_events_on_CPU", "alloc_components_on_CPU", "alloc_evals_on_CPU", "dealloc_events_on_CPU", "dealloc_components_on_CPU", "dealloc_temp_components_on_CPU", "dealloc_evals_on_CPU", "dealloc_index_list_on_CPU", "dealloc_thread_state_on_CPU", "relink_components_on_CPU", "compute_distance_rissanen", "merge_components", "reduce_components", "supervector_statistics", "score_shortlist", "create_lut_log_table", "compute_KL_distance"]
+        for fname in names_of_helper_funcs:
+            GMM.asp_mod.add_helper_function(fname, "", 'c++')
+
+        GMM.asp_mod.add_to_preamble([Include('omp.h', True)],'c++')
+
     def render_func_variant( self, param_dict, param_val_list, can_be_compiled, backend_name, func_name):
+        import asp.codegen.templating.template as AspTemplate
         #Render a single variant from a template
         def var_name_generator(base):
             return '_'.join(['em',backend_name,base]+param_val_list)
@@ -583,7 +1133,7 @@ class GMM(object):
         #Render all the variant-specific code
         import hashlib
         key_func = lambda *args, **kwargs: hashlib.md5(str([args[0],args[1],math.floor(math.log10(args[2]))])+str(kwargs)).hexdigest()
-        for cvtype in GMM.cvtype_name_list:
+        for cvtype in GMM.backend_cvtypes.get(backend_name, GMM.cvtype_name_list):
             func_names = ['train', 'eval', 'seed_components']
             all_variants = {}
             self.generate_permutations( self.variant_param_spaces[backend_name].keys(),
@@ -601,12 +1151,202 @@ class GMM(object):
                                             variant_names = names,
                                             run_check_funcs = checks,
                                             key_function = key_func,
-                                            backend = backend_name)
+                                            backend = GMM.asp_backend_names.get(backend_name, backend_name))
 
     def __del__(self):
-        self.internal_free_event_data()
-        self.internal_free_component_data()
-        self.internal_free_eval_data()
+        if GMM is None: return
+        # Only release what belongs to this instance; the event buffer is shared and reused by the next call
+        for backend_name in GMM.asp_mods.keys():
+            self.active_backend = backend_name
+            if self.native_state.component_data_cpu_copy is self.components:
+                self.internal_free_component_data()
+            if self.native_state.eval_data_cpu_copy is self.eval_data:
+                self.internal_free_eval_data()
+
+    #Backend dispatch
+
+    @property
+    def variant_param_spaces(self):
+        return GMM.variant_param_autotune if GMM.autotune else GMM.variant_param_default
+
+    def internal_select_backend(self, call, N, iters=1):
+        # Pick the backend for this call, from the pinned backend or the cost model, and make it the active one
+        if self.backend is not None:
+            if self.backend not in GMM.available_backends:
+                raise RuntimeError("Specified backend is not available, try one of " + str(GMM.available_backends))
+            if not self.internal_backends_for_cvtype([self.backend]):
+                raise RuntimeError("The %s backend does not implement the %s cvtype" % (self.backend, self.cvtype))
+            backend_name = self.backend
+        else:
+            backend_name = GMM.cost_model.choose(self.internal_backends_for_cvtype(GMM.available_backends), call, N, self.M, self.D, self.cvtype, iters)
+        self.selected_backend = backend_name
+        if backend_name != 'numpy':
+            self.active_backend = backend_name
+        return backend_name
+
+    def internal_backends_for_cvtype(self, backend_names):
+        return filter(lambda name: self.cvtype in GMM.backend_cvtypes.get(name, GMM.cvtype_name_list), backend_names)
+
+    def internal_select_native_backend(self):
+        # For the operations only the compiled backends implement, which work on per-component full matrices
+        if self.cvtype not in ['diag', 'full']:
+            raise RuntimeError("This operation is only implemented for the diag and full cvtypes")
+        backend_name = self.backend if self.backend in GMM.native_backends else GMM.default_native_backend
+        if backend_name is None:
+            raise RuntimeError("This operation needs a compiled backend, none of " + str(GMM.names_of_backends_to_use) + " is available")
+        self.active_backend = backend_name
+        return backend_name
+
+    def internal_record_time(self, backend_name, call, N, seconds, iters=1):
+        # The first call on a compiled backend includes building it, so it is not used as a measurement
+        if backend_name not in GMM.warm_backends:
+            GMM.warm_backends.add(backend_name)
+            if backend_name != 'numpy': return
+        GMM.cost_model.record(backend_name, call, N, self.M, self.D, self.cvtype, seconds, iters)
+
+    #Pure numpy backend, mirroring the native seed, E-step and M-step kernels
+
+    def internal_numpy_constants(self):
+        # Same as the native constants step: invert the covariances, compute the constants and normalize the weights
+        Rinv, constant = self.components.compute_scoring_constants()
+        np.copyto(self.components.Rinv, Rinv.reshape(self.components.Rinv.shape))
+        np.copyto(self.components.constant, constant)
+        self.components.comp_probs[:] = 2.0*constant
+        weights = self.components.weights
+        weights /= weights.sum()
+        self.components.mark_constants_valid()
+
+    def internal_numpy_estep1(self, X, indices=None):
+        # Per-component joint log-likelihoods, M x N, and their log-sum per event; only the listed components if indices is given
+        M, D = self.M, self.D
+        weights = np.asarray(self.components.weights, dtype=np.float64)
+        means = np.asarray(self.components.means, dtype=np.float64).reshape(M, D)
+        Rinv = np.asarray(self.components.Rinv, dtype=np.float64).reshape(covars_shape(self.cvtype, M, D))
+        constant = np.asarray(self.components.constant, dtype=np.float64)
+        if indices is not None:
+            M = len(indices)
+            weights, means, constant = weights[indices], means[indices], constant[indices]
+            if self.cvtype != 'tied':
+                Rinv = Rinv[indices]
+        log_joint = np.empty((M, X.shape[0]))
+        if self.cvtype == 'tied':
+            # Whiten with the Cholesky factor of the shared inverse covariance; the distances are then unit-diagonal
+            L = np.linalg.cholesky(Rinv)
+            X = np.dot(X, L)
+            means = np.dot(means, L)
+        if self.cvtype != 'full':
+            if self.cvtype == 'diag':
+                precisions = Rinv
+            elif self.cvtype == 'spherical':
+                precisions = np.repeat(Rinv[:, np.newaxis], D, axis=1)
+            else:
+                precisions = np.ones((M, D))
+            log_joint[:] = -0.5*(np.dot(X*X, precisions.T) - 2.0*np.dot(X, (means*precisions).T) + np.sum(means*means*precisions, axis=1)).T
+        else:
+            Rinv = unpack_covars(Rinv, D)
+            for m in range(M):
+                diff = X - means[m]
+                log_joint[m] = -0.5*np.sum(np.dot(diff, Rinv[m])*diff, axis=1)
+        with np.errstate(divide='ignore'):
+            log_joint += (constant + np.log(weights))[:, np.newaxis]
+        log_joint[weights <= 0] = MINVALUEFORMINUSLOG
+        return log_joint, np.logaddexp.reduce(log_joint, axis=0)
+
+    def internal_numpy_seed(self, X):
+        N = X.shape[0]
+        M, D = self.M, self.D
+        mean = X.mean(axis=0)
+        variances = (np.sum(X*X, axis=0) - N*mean*mean)/(N-1)/M
+        means = self.components.means.reshape(M, D)
+        covars = self.components.covars.reshape(covars_shape(self.cvtype, M, D))
+        seed = (N/M) if M > 1 else 0
+        means[0] = mean
+        means[1:] = X[[int(c*seed) for c in range(1, M)]]
+        if self.cvtype == 'spherical':
+            covars[:] = np.mean(variances)
+        elif self.cvtype == 'diag':
+            covars[:] = variances
+        elif self.cvtype == 'tied':
+            covars[:] = np.diag(variances)
+        else:
+            covars[:] = pack_covars(np.diag(variances))
+        self.components.weights[:] = 1.0/M
+        self.components.touch()
+        self.components_seeded = True
+
+    def internal_numpy_train(self, X, min_em_iters, max_em_iters):
+        X = np.asarray(X, dtype=np.float64)
+        N = X.shape[0]
+        M, D = self.M, self.D
+        if not self.components_seeded:
+            self.internal_numpy_seed(X)
+        self.internal_numpy_constants()
+        avgvar = (np.mean(np.mean(X*X, axis=0) - X.mean(axis=0)**2))/COVARIANCE_DYNAMIC_RANGE
+
+        epsilon = (1+D+0.5*(D+1)*D)*math.log(float(N)*D)*0.0001
+        likelihood = -100000.0
+        change = epsilon*2
+        iters = 0
+        means = self.components.means.reshape(M, D)
+        covars = self.components.covars.reshape(covars_shape(self.cvtype, M, D))
+        while iters < min_em_iters or (abs(change) > epsilon and iters < max_em_iters):
+            old_likelihood = likelihood
+            log_joint, logprob = self.internal_numpy_estep1(X)
+            likelihood = np.sum(logprob)
+            posteriors = np.exp(log_joint - logprob)
+
+            Nm = posteriors.sum(axis=1)
+            self.components.weights[:] = Nm
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means[:] = np.dot(posteriors, X)/Nm[:, np.newaxis]
+            if self.cvtype == 'tied':
+                scatter = np.zeros((D, D))
+                for m in range(M):
+                    diff = X - means[m]
+                    scatter += np.dot((posteriors[m][:, np.newaxis]*diff).T, diff)
+                covars[:] = scatter/Nm.sum() + avgvar*np.eye(D)
+            elif self.cvtype == 'spherical':
+                for m in range(M):
+                    variance = 0.0
+                    if Nm[m] >= 1.0:
+                        diff = X - means[m]
+                        variance = np.dot(posteriors[m], np.sum(diff*diff, axis=1))/(Nm[m]*D)
+                    covars[m] = variance + avgvar
+            elif self.cvtype == 'diag':
+                for m in range(M):
+                    variance = np.zeros(D)
+                    if Nm[m] >= 1.0:
+                        diff = X - means[m]
+                        variance = np.dot(posteriors[m], diff*diff)/Nm[m]
+                    covars[m] = variance + avgvar
+            else:
+                for m in range(M):
+                    if Nm[m] >= 1.0:
+                        diff = X - means[m]
+                        covar = np.dot((posteriors[m][:, np.newaxis]*diff).T, diff)/Nm[m]
+                    else:
+                        covar = np.zeros((D, D))
+                    covars[m] = pack_covars(covar + avgvar*np.eye(D))
+            self.components.touch()
+            self.internal_numpy_constants()
+            change = likelihood - old_likelihood
+            iters += 1
+
+        log_joint, logprob = self.internal_numpy_estep1(X)
+        if self.eval_data.resize(N, M):
+            GMM.eval_data_reallocs += 1
+        self.eval_data.memberships[:] = np.exp(log_joint - logprob)
+        self.eval_data.loglikelihoods[:] = logprob
+        return float(np.sum(logprob)), iters
+
+    def internal_numpy_eval(self, X, logprob_out=None, posterior_out=None):
+        if not self.components.constants_valid:
+            self.internal_numpy_constants()
+        log_joint, logprob = self.internal_numpy_estep1(np.asarray(X, dtype=np.float64))
+        if self.eval_data.resize(X.shape[0], self.M):
+            GMM.eval_data_reallocs += 1
+        (posterior_out if posterior_out is not None else self.eval_data.memberships)[:] = log_joint
+        (logprob_out if logprob_out is not None else self.eval_data.loglikelihoods)[:] = logprob
     
     def train_using_python(self, input_data, iters=10):
         from sklearn import mixture
@@ -624,24 +1364,65 @@ class GMM(object):
             return self.clf.predict(obs_data)
         else: return []
 
-    def train(self, input_data, min_em_iters=1, max_em_iters=10):
+    def train(self, input_data, min_em_iters=1, max_em_iters=10, accelerate=False, mode='soft', sparse_threshold=None, sparse_tolerance=1e-3, n_init=1, seed=None, sample_weights=None):
         """
         Train the GMM on the data. Optinally specify max and min iterations.
+        With accelerate, the EM steps are extrapolated with SQUAREM (see internal_squarem_train); the iteration
+        limits then count EM steps, and self.eval_data.iters reports how many were run.
+        mode='hard' runs classification EM instead (in the train kernels, or internal_hard_train on the backends
+        without that option).
+        With sparse_threshold, the M-step skips responsibilities at or below it unless they add up to more than
+        sparse_tolerance of the data (in the train kernels, or internal_sparse_train on the backends without that
+        option); self.eval_data.sparse_fallbacks counts the iterations that had to use all of them.
+        n_init > 1 trains that many independently initialized copies concurrently and keeps the most likely one
+        (see internal_train_restarts); seed makes their initializations reproducible.
+        sample_weights gives each event a weight, as if it occurred that many times (see internal_weighted_train);
+        the returned likelihood is then weighted too.
         """
+        if n_init > 1:
+            return self.internal_train_restarts(input_data, n_init, seed, min_em_iters=min_em_iters, max_em_iters=max_em_iters,
+                                                accelerate=accelerate, mode=mode, sparse_threshold=sparse_threshold, sparse_tolerance=sparse_tolerance,
+                                                sample_weights=sample_weights)
         N = input_data.shape[0] 
         if input_data.shape[1] != self.D:
             print "Error: Data has %d features, model expects %d features." % (input_data.shape[1], self.D)
-        self.internal_alloc_event_data(input_data)
-        self.internal_alloc_eval_data(input_data)
-        self.internal_alloc_component_data()
-        
-        if not self.components_seeded:
-            self.internal_seed_data(input_data, input_data.shape[1], input_data.shape[0])
-
-        self.eval_data.likelihood = getattr(self.get_asp_mod(),'train_'+self.cvtype)(self.M, self.D, N, min_em_iters, max_em_iters)[0]
+        if mode not in ('soft', 'hard'):
+            raise RuntimeError("mode must be 'soft' or 'hard', got %r" % (mode,))
+        if (mode == 'hard') + bool(accelerate) + (sparse_threshold is not None) + (sample_weights is not None) > 1:
+            raise RuntimeError("accelerate, mode='hard', sparse_threshold and sample_weights cannot be combined")
+        if sample_weights is not None and np.shape(sample_weights) != (N,):
+            raise RuntimeError("sample_weights must have one weight per event, got shape %s" % (np.shape(sample_weights),))
+        backend_name = self.internal_select_backend('train', N, max_em_iters)
+        start = time.time()
+        if backend_name != 'numpy':
+            self.internal_alloc_event_data(input_data)
+            self.internal_alloc_eval_data(input_data)
+            self.internal_alloc_component_data()
+
+            if not self.components_seeded:
+                self.internal_seed_data(input_data, input_data.shape[1], input_data.shape[0])
+
+        if mode == 'hard' and backend_name not in GMM.train_option_backends:
+            self.eval_data.likelihood, iters = self.internal_hard_train(input_data, min_em_iters, max_em_iters)
+        elif sparse_threshold is not None and backend_name not in GMM.train_option_backends:
+            self.eval_data.likelihood, iters = self.internal_sparse_train(input_data, min_em_iters, max_em_iters, sparse_threshold, sparse_tolerance)
+        elif sample_weights is not None and backend_name not in GMM.train_option_backends:
+            self.eval_data.likelihood, iters = self.internal_weighted_train(input_data, sample_weights, min_em_iters, max_em_iters)
+        elif accelerate:
+            self.eval_data.likelihood, iters = self.internal_squarem_train(input_data, backend_name, min_em_iters, max_em_iters)
+        elif backend_name == 'numpy':
+            self.eval_data.likelihood, iters = self.internal_numpy_train(input_data, min_em_iters, max_em_iters)
+        else:
+            self.eval_data.likelihood, iters, self.eval_data.sparse_fallbacks = self.internal_native_train(N, min_em_iters, max_em_iters, sparse_threshold, sparse_tolerance, mode == 'hard', sample_weights=sample_weights)
+        self.eval_data.iters = iters
+        self.internal_record_time(backend_name, 'train', N, time.time() - start, iters)
 
         self.components.means = self.components.means.reshape(self.M, self.D)
-        self.components.covars = self.components.covars.reshape(self.M, self.D, self.D)
+        self.components.covars = self.components.covars.reshape(covars_shape(self.cvtype, self.M, self.D))
+        self.components.Rinv = self.components.Rinv.reshape(covars_shape(self.cvtype, self.M, self.D))
+        self.components.mark_constants_valid()
+        if backend_name != 'numpy':
+            self.native_state.component_data_version = self.components.version
         
         return self.eval_data.likelihood
 
@@ -657,6 +1438,7 @@ class GMM(object):
         
         if input_data.shape[1] != self.D:
             print "Error: Data has %d features, model expects %d features." % (input_data.shape[1], self.D)
+        self.internal_select_native_backend()
         self.internal_alloc_event_data(input_data)
         self.internal_alloc_index_list_data(index_list)
         self.internal_alloc_eval_data(input_data)
@@ -679,6 +1461,7 @@ class GMM(object):
         if input_data.shape[1] != self.D:
             print "Error: Data has %d features, model expects %d features." % (input_data.shape[1], self.D)
             
+        self.internal_select_native_backend()
         self.internal_alloc_event_data_from_index(input_data, index_list)
         self.internal_alloc_eval_data(input_data)
         self.internal_alloc_component_data()
@@ -688,57 +1471,743 @@ class GMM(object):
 
         self.eval_data.likelihood = self.get_asp_mod().train(self.M, self.D, K)[0]
         return self
-            
-    
-    def eval(self, obs_data):
+
+    def internal_native_train(self, N, min_em_iters, max_em_iters, sparse_threshold=None, sparse_tolerance=0.0, hard=False, resume=0, sample_weights=None):
+        # The active backend's train kernel on the loaded data; returns (likelihood, iters, sparse_fallbacks).
+        # A sparse_threshold is passed on to the kernels that take it, as -1 when there is none, and so are hard,
+        # resume (1: the average variance of these events is already loaded, 2: so are the posteriors of the
+        # current parameters) and the sample_weights, which the kernels apply to the posteriors
+        train = getattr(self.get_asp_mod(),'train_'+self.cvtype)
+        if self.active_backend not in GMM.train_option_backends:
+            return tuple(train(self.M, self.D, N, min_em_iters, max_em_iters)) + (0,)
+        threshold = -1.0 if sparse_threshold is None else sparse_threshold
+        weights = None if sample_weights is None else np.ascontiguousarray(sample_weights, dtype=np.float32)
+        return tuple(train(self.M, self.D, N, min_em_iters, max_em_iters, threshold, sparse_tolerance, int(hard), resume, weights))
+
+    def internal_hard_train(self, X, min_em_iters, max_em_iters):
+        # Classification EM: the E-step (estep1 on the selected backend) assigns each event to its most likely
+        # component, and the M-step only accumulates each event into that component, so it costs O(N*D) (O(N*D^2)
+        # for full and tied) instead of O(N*M*D). Stops once the assignments no longer change; returns the
+        # classification log-likelihood. This is the version for the backends outside GMM.train_option_backends,
+        # whose train kernels do the same (see estep_hard).
+        X64 = self.internal_prepare_python_train(X)
+        N = X64.shape[0]
+        avgvar = (np.mean(np.mean(X64*X64, axis=0) - X64.mean(axis=0)**2))/COVARIANCE_DYNAMIC_RANGE
+        assignments = None
+        iters = 0
+        while True:
+            logprob, log_joint = self.internal_eval_loaded_events(X64 if self.selected_backend == 'numpy' else X)
+            new_assignments = log_joint.argmax(axis=0)
+            likelihood = float(np.sum(log_joint[new_assignments, np.arange(N)], dtype=np.float64))
+            converged = assignments is not None and np.array_equal(new_assignments, assignments)
+            if iters >= max_em_iters or (converged and iters >= min_em_iters):
+                break
+            assignments = new_assignments
+
+            # One responsibility of 1 per event, grouped by component
+            order = np.argsort(assignments, kind='mergesort')
+            indptr = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=self.M))))
+            self.internal_csr_mstep(X64, indptr, order, np.ones(N), avgvar)
+            iters += 1
+
+        # Leave hard posteriors behind, as a soft train leaves its posteriors
+        log_joint[:] = 0.0
+        log_joint[new_assignments, np.arange(N)] = 1.0
+        return likelihood, iters
+
+    def internal_sparse_train(self, X, min_em_iters, max_em_iters, threshold, tolerance):
+        # Soft EM whose M-step only visits the responsibilities above threshold, stored per component in CSR form
+        # (indptr, event indexes, values). If the dropped responsibilities exceed tolerance of the total mass, that
+        # iteration keeps all of them, which is the exact M-step. This is the version for the backends outside
+        # GMM.train_option_backends, whose train kernels do the same (see sparsify_memberships).
+        X64 = self.internal_prepare_python_train(X)
+        N, D = X64.shape
+        avgvar = (np.mean(np.mean(X64*X64, axis=0) - X64.mean(axis=0)**2))/COVARIANCE_DYNAMIC_RANGE
+        epsilon = (1+D+0.5*(D+1)*D)*math.log(float(N)*D)*0.0001
+        likelihood = -100000.0
+        change = epsilon*2
+        iters = 0
+        self.eval_data.sparse_fallbacks = 0
+        while iters < min_em_iters or (abs(change) > epsilon and iters < max_em_iters):
+            old_likelihood = likelihood
+            logprob, log_joint = self.internal_eval_loaded_events(X64 if self.selected_backend == 'numpy' else X)
+            likelihood = float(np.sum(logprob, dtype=np.float64))
+            posteriors = np.exp(log_joint - logprob)
+
+            keep = posteriors > threshold
+            if np.sum(posteriors[~keep]) > tolerance*N:
+                keep[:] = True
+                self.eval_data.sparse_fallbacks += 1
+            rows, indices = np.nonzero(keep)
+            indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=self.M))))
+            self.internal_csr_mstep(X64, indptr, indices, posteriors[rows, indices], avgvar)
+            change = likelihood - old_likelihood
+            iters += 1
+
+        logprob, log_joint = self.internal_eval_loaded_events(X64 if self.selected_backend == 'numpy' else X)
+        log_joint[:] = np.exp(log_joint - logprob)
+        return float(np.sum(logprob, dtype=np.float64)), iters
+
+    def internal_weighted_train(self, X, sample_weights, min_em_iters, max_em_iters):
+        # Soft EM in which event n counts sample_weights[n] times: the E-step runs on the selected backend and the
+        # M-step is internal_csr_mstep over every responsibility, scaled by the weight of its event. Returns the
+        # weighted log-likelihood. This is the version for the backends outside GMM.train_option_backends, whose
+        # train kernels scale the posteriors themselves (see weight_memberships).
+        X64 = self.internal_prepare_python_train(X)
+        N, D = X64.shape
+        sample_weights = np.asarray(sample_weights, dtype=np.float64)
+        avgvar = (np.mean(np.mean(X64*X64, axis=0) - X64.mean(axis=0)**2))/COVARIANCE_DYNAMIC_RANGE
+        epsilon = (1+D+0.5*(D+1)*D)*math.log(float(N)*D)*0.0001
+        indptr = np.arange(self.M+1)*N
+        likelihood = -100000.0
+        change = epsilon*2
+        iters = 0
+        while iters < min_em_iters or (abs(change) > epsilon and iters < max_em_iters):
+            old_likelihood = likelihood
+            logprob, log_joint = self.internal_eval_loaded_events(X64 if self.selected_backend == 'numpy' else X)
+            likelihood = float(np.dot(sample_weights, logprob))
+            self.internal_csr_mstep(X64, indptr, None, (np.exp(log_joint - logprob)*sample_weights).ravel(), avgvar)
+            change = likelihood - old_likelihood
+            iters += 1
+
+        logprob, log_joint = self.internal_eval_loaded_events(X64 if self.selected_backend == 'numpy' else X)
+        log_joint[:] = np.exp(log_joint - logprob)
+        return float(np.dot(sample_weights, logprob)), iters
+
+    def internal_prepare_python_train(self, X):
+        # Seed for the numpy backend (the native backends were seeded by train) and return the events as float64
+        X64 = np.asarray(X, dtype=np.float64)
+        if self.selected_backend == 'numpy' and not self.components_seeded:
+            self.internal_numpy_seed(X64)
+        return X64
+
+    def internal_csr_mstep(self, X, indptr, indices, data, avgvar):
+        # M-step from the responsibilities of component m, data[indptr[m]:indptr[m+1]] for the events
+        # indices[indptr[m]:indptr[m+1]], or for every event when indices is None. Components without any keep
+        # their parameters and get weight 0.
+        M, D = self.M, self.D
+        means = self.components.means.reshape(M, D)
+        covars = self.components.covars.reshape(covars_shape(self.cvtype, M, D))
+        counts = np.zeros(M)
+        scatter = np.zeros((D, D))
+        for m in range(M):
+            events = X if indices is None else X[indices[indptr[m]:indptr[m+1]]]
+            weights = data[indptr[m]:indptr[m+1]]
+            counts[m] = weights.sum()
+            if counts[m] <= 0: continue
+            means[m] = np.dot(weights, events)/counts[m]
+            diff = events - means[m]
+            if self.cvtype == 'diag':
+                covars[m] = np.dot(weights, diff*diff)/counts[m] + avgvar
+            elif self.cvtype == 'spherical':
+                covars[m] = np.dot(weights, np.sum(diff*diff, axis=1))/(counts[m]*D) + avgvar
+            elif self.cvtype == 'full':
+                covars[m] = pack_covars(np.dot((weights[:, np.newaxis]*diff).T, diff)/counts[m] + avgvar*np.eye(D))
+            else:
+                scatter += np.dot((weights[:, np.newaxis]*diff).T, diff)
+        if self.cvtype == 'tied':
+            covars[:] = scatter/counts.sum() + avgvar*np.eye(D)
+        self.components.weights[:] = counts/counts.sum()
+        self.components.touch()
+
+    def internal_train_restarts(self, X, n_init, seed, **train_args):
+        # Restart 0 starts from the current parameters (or the usual seeding), the others from random events as
+        # means. Each restart is its own GMM, trained on a pool thread; the native state is per thread and the train
+        # kernels release the GIL, so the restarts run in parallel. The pool threads' native buffers are freed as
+        # they exit. The best one's components replace ours.
+        from multiprocessing import cpu_count
+        from multiprocessing.pool import ThreadPool
+        rng = np.random.RandomState(seed)
+        restarts = []
+        for r in range(n_init):
+            if r == 0 and self.components_seeded:
+                init = {'weights': np.array(self.components.weights), 'means': np.array(self.components.means), 'covars': np.array(self.components.covars)}
+            elif r == 0:
+                init = {}
+            else:
+                init = self.internal_random_init(X, rng)
+            restarts.append(GMM(self.M, self.D, cvtype=self.cvtype, backend=self.backend, **init))
+
+        def train_restart(gmm):
+            return gmm.train(X, **train_args)
+        pool = ThreadPool(min(n_init, cpu_count()))
+        try:
+            likelihoods = pool.map(train_restart, restarts)
+        finally:
+            pool.close()
+            pool.join()
+
+        best = restarts[int(np.nanargmax(likelihoods))]
+        self.components = best.components
+        self.eval_data = best.eval_data
+        self.gaussian_selection = None
+        self.eval_data.restart_likelihoods = list(likelihoods)
+        self.components_seeded = True
+        return self.eval_data.likelihood
+
+    def internal_random_init(self, X, rng):
+        # M distinct random events as means, equal weights and the data variance for every component
+        M, D = self.M, self.D
+        means = np.array(X[np.sort(rng.choice(X.shape[0], M, replace=False))], dtype=np.float32)
+        variances = np.var(np.asarray(X, dtype=np.float64), axis=0)
+        if self.cvtype == 'spherical':
+            covars = np.repeat(variances.mean(), M)
+        elif self.cvtype == 'diag':
+            covars = np.tile(variances, (M, 1))
+        elif self.cvtype == 'tied':
+            covars = np.diag(variances)
+        else:
+            covars = np.tile(pack_covars(np.diag(variances)), (M, 1))
+        return {'weights': np.ones(M, dtype=np.float32)/M, 'means': means, 'covars': covars.astype(np.float32)}
+
+    def internal_em_step(self, X, backend_name, resume=0):
+        # One plain EM step on the loaded data; returns the likelihood of the updated parameters. On the native
+        # backends resume says what the last step left loaded (see internal_native_train), so that a step
+        # straight after another one costs a single E-step and M-step
+        if backend_name == 'numpy':
+            return self.internal_numpy_train(X, 1, 1)[0]
+        self.internal_alloc_component_data()
+        return self.internal_native_train(X.shape[0], 1, 1, resume=resume)[0]
+
+    def internal_squarem_train(self, X, backend_name, min_em_iters, max_em_iters):
+        # SQUAREM (Varadhan and Roland, 2008): from two EM steps x0 -> x1 -> x2, jump to
+        # x0 - 2*alpha*r + alpha^2*v with r = x1 - x0, v = x2 - 2*x1 + x0 and alpha = -|r|/|v|, then take one EM step
+        # from there. alpha is halved towards -1 (which gives x2) until the parameters are valid, and the cycle falls
+        # back to x2 if the extrapolated step ends up with a lower likelihood than x2.
+        if backend_name == 'numpy':
+            X = np.asarray(X, dtype=np.float64)
+            if not self.components_seeded:
+                self.internal_numpy_seed(X)
+        N, D = X.shape
+        epsilon = (1+D+0.5*(D+1)*D)*math.log(float(N)*D)*0.0001
+        likelihood = -np.inf
+        iters = 0
+        # 0 before the first native step, then 2 while the loaded posteriors belong to the current parameters
+        # and 1 once the parameters were replaced by an extrapolated or fallback vector
+        resume = 0
+        while iters < max_em_iters:
+            old_likelihood = likelihood
+            x0 = self.internal_parameter_vector()
+            likelihood = self.internal_em_step(X, backend_name, resume)
+            resume = 2
+            iters += 1
+            if iters + 2 > max_em_iters:
+                break
+            x1 = self.internal_parameter_vector()
+            likelihood2 = self.internal_em_step(X, backend_name, resume)
+            x2 = self.internal_parameter_vector()
+            iters += 1
+            r, v = x1 - x0, x2 - 2.0*x1 + x0
+            norm_v = np.sqrt(np.dot(v, v))
+            alpha = min(-1.0, -np.sqrt(np.dot(r, r))/norm_v) if norm_v > 0 else -1.0
+            while alpha < -1.0 and not self.internal_set_parameter_vector(x0 - 2.0*alpha*r + alpha*alpha*v):
+                alpha = 0.5*(alpha - 1.0) if alpha < -1.01 else -1.0
+            likelihood = likelihood2
+            if alpha < -1.0:
+                likelihood = self.internal_em_step(X, backend_name, 1)
+                iters += 1
+                if not likelihood >= likelihood2:
+                    self.internal_set_parameter_vector(x2)
+                    likelihood = self.internal_em_step(X, backend_name, 1)
+                    iters += 1
+            if iters >= min_em_iters and abs(likelihood - old_likelihood) <= epsilon:
+                break
+        return likelihood, iters
+
+    def internal_parameter_vector(self):
+        # The weights, means and covariances as one float64 vector, for extrapolating EM steps
+        c = self.components
+        return np.concatenate((np.ravel(c.weights), np.ravel(c.means), np.ravel(c.covars))).astype(np.float64)
+
+    def internal_set_parameter_vector(self, x):
+        # Load a parameter vector; returns False and leaves the parameters alone if it is not a valid model
+        M, D = self.M, self.D
+        c = self.components
+        weights, means, covars = np.split(x, [M, M + M*D])
+        weights = np.maximum(weights, 0.0)
+        if not np.all(np.isfinite(x)) or weights.sum() <= 0:
+            return False
+        covars = covars.reshape(covars_shape(self.cvtype, M, D))
+        if self.cvtype in ['diag', 'spherical']:
+            if not np.all(covars > 0):
+                return False
+        else:
+            try:
+                np.linalg.cholesky(unpack_covars(covars, D) if self.cvtype == 'full' else covars)
+            except np.linalg.LinAlgError:
+                return False
+        c.weights[:] = weights/weights.sum()
+        c.means.reshape(M*D)[:] = means
+        c.covars.reshape(covars.shape)[:] = covars
+        c.touch()
+        return True
+
+    def train_on_coreset(self, input_data, coreset_fraction=0.1, refine_em_iters=1, min_em_iters=1, max_em_iters=10, seed=None):
+        """
+        Train the GMM on an importance-sampled coreset of the data, then optionally refine it with full-data EM passes.
+        coreset_fraction is the accuracy/time knob. EM on the coreset weighs each sampled event by its importance
+        weight, so its objective, kept in self.eval_data.coreset_likelihood, estimates the full-data log-likelihood.
+        Returns the full-data log-likelihood of the final model and its gap to the coreset objective of that same
+        model (full minus coreset).
+        """
+        N = input_data.shape[0]
+        rng = np.random.RandomState(seed)
+
+        # Lightweight coreset: half uniform, half proportional to the squared distance from the data mean
+        dist = np.square(input_data - input_data.mean(axis=0)).sum(axis=1)
+        total = dist.sum()
+        q = 0.5/N + 0.5*dist/total if total > 0 else np.ones(N)/N
+        q /= q.sum()
+        K = min(N, max(self.M, int(N*coreset_fraction)))
+        index_list = np.sort(rng.choice(N, K, p=q))
+        coreset = np.ascontiguousarray(input_data[index_list])
+        coreset_weights = 1.0/(K*q[index_list])
+
+        self.train(coreset, min_em_iters=min_em_iters, max_em_iters=max_em_iters, sample_weights=coreset_weights)
+        if refine_em_iters > 0:
+            self.train(input_data, min_em_iters=refine_em_iters, max_em_iters=refine_em_iters)
+        # Both likelihoods are of the final parameters, so the gap only measures the coreset's estimation error
+        coreset_likelihood = float(np.dot(coreset_weights, self.score(coreset)))
+        full_likelihood = float(np.sum(self.score(input_data), dtype=np.float64))
+        self.eval_data.likelihood = full_likelihood
+        self.eval_data.coreset_likelihood = coreset_likelihood
+        return full_likelihood, full_likelihood - coreset_likelihood
+
+    @classmethod
+    def map_adapt(cls, ubm, X, relevance_factor=16.0, adapt=('means',)):
+        """
+        A new GMM that is the MAP adaptation of ubm to X: a single E-step against the fixed ubm collects the
+        sufficient statistics, then each parameter listed in adapt ('weights', 'means', 'covars') moves from the ubm
+        towards the data by n/(n + relevance_factor), n being the soft count of its component. The rest are copied.
+        """
+        unknown = set(adapt) - set(['weights', 'means', 'covars'])
+        if unknown:
+            raise RuntimeError("Cannot adapt " + str(sorted(unknown)) + ", try some of ['weights', 'means', 'covars']")
+        if X.shape[1] != ubm.D:
+            raise RuntimeError("Data has %d features, the UBM expects %d features" % (X.shape[1], ubm.D))
+        N, M, D, cvtype = X.shape[0], ubm.M, ubm.D, ubm.cvtype
+        logprob, log_joint = ubm.eval(X)
+        posteriors = np.exp(np.asarray(log_joint, dtype=np.float64) - logprob)
+        X = np.asarray(X, dtype=np.float64)
+
+        # Zeroth and first order statistics; a component that saw no data keeps the ubm parameters since alpha is 0
+        counts = posteriors.sum(axis=1)
+        alpha = counts/(counts + relevance_factor)
+        safe_counts = np.where(counts > 0, counts, 1.0)
+        first = np.dot(posteriors, X)/safe_counts[:, np.newaxis]
+        weights = np.asarray(ubm.components.weights, dtype=np.float64)
+        means = np.asarray(ubm.components.means, dtype=np.float64).reshape(M, D)
+        covars = np.asarray(ubm.components.covars, dtype=np.float64).reshape(covars_shape(cvtype, M, D))
+
+        new_weights, new_means, new_covars = weights, means, covars
+        if 'weights' in adapt:
+            new_weights = alpha*counts/N + (1.0 - alpha)*weights
+            new_weights = new_weights/new_weights.sum()
+        if 'means' in adapt:
+            new_means = alpha[:, np.newaxis]*first + (1.0 - alpha[:, np.newaxis])*means
+        if 'covars' in adapt:
+            # Interpolate the second moments around zero, then recentre them on the adapted means
+            if cvtype == 'diag':
+                second = np.dot(posteriors, X*X)/safe_counts[:, np.newaxis]
+                new_covars = alpha[:, np.newaxis]*second + (1.0 - alpha[:, np.newaxis])*(covars + means*means) - new_means*new_means
+            elif cvtype == 'spherical':
+                second = np.dot(posteriors, np.sum(X*X, axis=1))/(safe_counts*D)
+                new_covars = alpha*second + (1.0 - alpha)*(covars + np.mean(means*means, axis=1)) - np.mean(new_means*new_means, axis=1)
+            elif cvtype == 'full':
+                new_covars = np.empty_like(covars)
+                prior = unpack_covars(covars, D)
+                for m in range(M):
+                    second = np.dot((posteriors[m][:, np.newaxis]*X).T, X)/safe_counts[m]
+                    covar = alpha[m]*second + (1.0 - alpha[m])*(prior[m] + np.outer(means[m], means[m])) - np.outer(new_means[m], new_means[m])
+                    new_covars[m] = pack_covars(covar)
+            else:
+                # One matrix for all components, so the whole of X counts towards it
+                scatter = np.zeros((D, D))
+                for m in range(M):
+                    diff = X - new_means[m]
+                    scatter += np.dot((posteriors[m][:, np.newaxis]*diff).T, diff)
+                total_alpha = N/(N + relevance_factor)
+                new_covars = total_alpha*scatter/N + (1.0 - total_alpha)*covars
+
+        return cls(M, D, cvtype=cvtype, backend=ubm.backend,
+                   weights=np.ascontiguousarray(new_weights, dtype=np.float32),
+                   means=np.ascontiguousarray(new_means, dtype=np.float32),
+                   covars=np.ascontiguousarray(new_covars, dtype=np.float32))
+
+    def partial_fit(self, chunks, learning_rate_decay=0.6, learning_rate_offset=2.0):
+        """
+        Online EM over a stream: chunks is one N x D array or any iterable of them. Each chunk is scored on the
+        backend the cost model picks, its per-event sufficient statistics are blended into the running ones with
+        weight (step + learning_rate_offset)**-learning_rate_decay (1 for the first chunk), and the parameters are
+        re-estimated from them. Memory stays at the statistics (see GMMStreamState) plus one chunk.
+        learning_rate_decay must be in (0.5, 1] for the stream to converge. Returns the total log-likelihood of the
+        chunks, each scored before the update it contributed to.
+        """
+        if not 0.5 < learning_rate_decay <= 1.0:
+            raise RuntimeError("learning_rate_decay must be in (0.5, 1], got %r" % (learning_rate_decay,))
+        if isinstance(chunks, np.ndarray):
+            chunks = [chunks]
+        if self.stream_state is None:
+            self.stream_state = GMMStreamState(self.M, self.D, self.cvtype)
+        state = self.stream_state
+        likelihood = 0.0
+        for chunk in chunks:
+            if chunk.shape[1] != self.D:
+                raise RuntimeError("Data has %d features, model expects %d features." % (chunk.shape[1], self.D))
+            N = chunk.shape[0]
+            if N == 0: continue
+            if not self.components_seeded:
+                self.internal_numpy_seed(np.asarray(chunk, dtype=np.float64))
+            logprob, log_joint = self.eval(chunk)
+            likelihood += np.sum(logprob, dtype=np.float64)
+            posteriors = np.exp(np.asarray(log_joint, dtype=np.float64) - logprob)
+            X = np.asarray(chunk, dtype=np.float64)
+
+            eta = 1.0 if state.step == 0 else (state.step + learning_rate_offset)**-learning_rate_decay
+            state.counts += eta*(posteriors.sum(axis=1)/N - state.counts)
+            state.first += eta*(np.dot(posteriors, X)/N - state.first)
+            if self.cvtype in ['diag', 'spherical']:
+                second = np.dot(posteriors, X*X)/N
+            elif self.cvtype == 'tied':
+                second = np.dot(X.T, X)/N
+            else:
+                second = np.array([np.dot((posteriors[m][:, np.newaxis]*X).T, X) for m in range(self.M)])/N
+            state.second += eta*(second - state.second)
+            state.step += 1
+            self.internal_stream_mstep()
+        return likelihood
+
+    def internal_stream_mstep(self):
+        # Parameters from the running statistics; a component without posterior mass keeps its mean and covariance
+        M, D = self.M, self.D
+        state = self.stream_state
+        means = self.components.means.reshape(M, D)
+        covars = self.components.covars.reshape(covars_shape(self.cvtype, M, D))
+        alive = state.counts > 1e-10
+        mean_x = state.first.sum(axis=0)
+        if self.cvtype == 'tied':
+            mean_x2 = np.diagonal(state.second)
+        elif self.cvtype == 'full':
+            mean_x2 = np.diagonal(state.second, axis1=1, axis2=2).sum(axis=0)
+        else:
+            mean_x2 = state.second.sum(axis=0)
+        avgvar = np.mean(mean_x2 - mean_x*mean_x)/COVARIANCE_DYNAMIC_RANGE
+
+        self.components.weights[:] = state.counts/state.counts.sum()
+        new_means = state.first[alive]/state.counts[alive][:, np.newaxis]
+        means[alive] = new_means
+        counts = state.counts[alive]
+        if self.cvtype == 'diag':
+            covars[alive] = state.second[alive]/counts[:, np.newaxis] - new_means*new_means + avgvar
+        elif self.cvtype == 'spherical':
+            covars[alive] = np.mean(state.second[alive]/counts[:, np.newaxis] - new_means*new_means, axis=1) + avgvar
+        elif self.cvtype == 'full':
+            outer = new_means[:, :, np.newaxis]*new_means[:, np.newaxis, :]
+            covars[alive] = pack_covars(state.second[alive]/counts[:, np.newaxis, np.newaxis] - outer + avgvar*np.eye(D))
+        else:
+            between = np.dot((counts[:, np.newaxis]*new_means).T, new_means)
+            covars[:] = (state.second - between)/counts.sum() + avgvar*np.eye(D)
+        self.components.touch()
+
+    def save_stream_checkpoint(self, filename):
+        """
+        Write the parameters and the partial_fit statistics, so that load_stream_checkpoint can resume the stream.
+        The file is written under a temporary name and renamed, so an interrupted write leaves the old checkpoint.
+        """
+        state = self.stream_state if self.stream_state is not None else GMMStreamState(self.M, self.D, self.cvtype)
+        tmp_path = "%s.%d" % (filename, os.getpid())
+        f = open(tmp_path, 'wb')
+        try:
+            np.savez(f, M=self.M, D=self.D, cvtype=self.cvtype, seeded=self.components_seeded,
+                     weights=self.components.weights, means=self.components.means, covars=self.components.covars,
+                     step=state.step, counts=state.counts, first=state.first, second=state.second)
+        finally:
+            f.close()
+        os.rename(tmp_path, filename)
+
+    def eval(self, obs_data, logprob_out=None, posterior_out=None):
+        """
+        Without outputs, the returned arrays are views of self.eval_data that the next evaluation overwrites.
+        logprob_out (N) and posterior_out (M x N) must be C-contiguous, writeable float32 arrays; the backend
+        writes its results straight into them and they are returned as is, without any intermediate copy.
+        """
         N = obs_data.shape[0]
         if obs_data.shape[1] != self.D:
             print "Error: Data has %d features, model expects %d features." % (obs_data.shape[1], self.D)
-        self.internal_alloc_event_data(obs_data)
-        self.internal_alloc_eval_data(obs_data)
-        self.internal_alloc_component_data()
+        self.internal_check_output(logprob_out, (N,), np.float32)
+        self.internal_check_output(posterior_out, (self.M, N), np.float32)
+        if self.internal_select_backend('eval', N) != 'numpy':
+            self.internal_alloc_event_data(obs_data)
+        return self.internal_eval_loaded_events(obs_data, logprob_out, posterior_out)
+
+    def internal_check_output(self, out, shape, dtype):
+        if out is None: return
+        if not isinstance(out, np.ndarray) or out.shape != shape or out.dtype != dtype:
+            raise RuntimeError("Output must be a %s array of shape %s" % (np.dtype(dtype).name, shape))
+        if not out.flags.c_contiguous or not out.flags.writeable:
+            raise RuntimeError("Output must be C-contiguous and writeable")
+
+    def internal_eval_loaded_events(self, obs_data, logprob_out=None, posterior_out=None):
+        # Evaluate on the backend picked by internal_select_backend, against the event data already loaded there
+        N = obs_data.shape[0]
+        start = time.time()
+        if self.selected_backend == 'numpy':
+            self.internal_numpy_eval(obs_data, logprob_out, posterior_out)
+        else:
+            self.internal_alloc_eval_data(obs_data)
+            self.internal_alloc_component_data()
+            if logprob_out is not None or posterior_out is not None:
+                self.internal_redirect_eval_data(logprob_out, posterior_out)
 
-        self.eval_data.likelihood = getattr(self.get_asp_mod(),'eval_'+self.cvtype)(self.M, self.D, N)
+            self.eval_data.likelihood = getattr(self.get_asp_mod(),'eval_'+self.cvtype)(self.M, self.D, N, int(not self.components.constants_valid))
+            self.components.mark_constants_valid()
+        self.internal_record_time(self.selected_backend, 'eval', N, time.time() - start)
 
-        logprob = self.eval_data.loglikelihoods
-        posteriors = self.eval_data.memberships
-        return logprob, posteriors # N log probabilities, NxM posterior probabilities for each component
+        logprob = logprob_out if logprob_out is not None else self.eval_data.loglikelihoods
+        posteriors = posterior_out if posterior_out is not None else self.eval_data.memberships
+        return logprob, posteriors # N log probabilities, MxN log joint probabilities for each component
 
-    def score(self, obs_data):
-        logprob, posteriors = self.eval(obs_data)
+    def score(self, obs_data, out=None):
+        """
+        out, if given, is a float32 array of N that receives the log probabilities (see eval).
+        """
+        logprob, posteriors = self.eval(obs_data, logprob_out=out)
         return logprob # N log probabilities
 
-    def decode(self, obs_data):
-        logprob, posteriors = self.eval(obs_data)
-        return logprob, posteriors.argmax(axis=0) # N log probabilities, N indexes of most likely components 
+    def eval_blocks(self, obs_data, logprob_out=None, posterior_out=None, block_size=65536):
+        """
+        Evaluate obs_data block_size events at a time, for inputs and outputs that do not fit in memory.
+        obs_data can be any N x D array-like that slices into arrays (np.memmap, h5py datasets, ...). Each block's
+        log-likelihoods and, if posterior_out is given, its M x block memberships (as returned by eval) are written
+        to logprob_out[n0:n1] and posterior_out[:, n0:n1]. An output can be an array-like of that shape or a file
+        name, which is created as a float32 np.memmap. Peak memory depends on block_size and M, not on N.
+        Returns logprob_out and posterior_out.
+        """
+        N = obs_data.shape[0]
+        if obs_data.shape[1] != self.D:
+            raise RuntimeError("Data has %d features, model expects %d features." % (obs_data.shape[1], self.D))
+        if block_size < 1:
+            raise RuntimeError("block_size must be positive, got %r" % (block_size,))
+        logprob_out = self.internal_block_output(logprob_out, (N,))
+        if posterior_out is not None:
+            posterior_out = self.internal_block_output(posterior_out, (self.M, N))
+        direct = isinstance(logprob_out, np.ndarray) and logprob_out.dtype == np.float32 and logprob_out.flags.c_contiguous
+        for start in range(0, N, block_size):
+            stop = min(N, start + block_size)
+            block = np.asarray(obs_data[start:stop])
+            if direct:
+                logprob, posteriors = self.eval(block, logprob_out=logprob_out[start:stop])
+            else:
+                logprob, posteriors = self.eval(block)
+                logprob_out[start:stop] = logprob
+            if posterior_out is not None:
+                posterior_out[:, start:stop] = posteriors
+        for out in [logprob_out, posterior_out]:
+            if isinstance(out, np.memmap):
+                out.flush()
+        return logprob_out, posterior_out
+
+    def internal_block_output(self, out, shape):
+        if out is None:
+            return np.empty(shape, dtype=np.float32)
+        if isinstance(out, str):
+            return np.memmap(out, dtype=np.float32, mode='w+', shape=shape)
+        if tuple(out.shape) != shape:
+            raise RuntimeError("Output has shape %s, expected %s" % (tuple(out.shape), shape))
+        return out
+
+    def internal_nearest_codewords(self, points, codewords):
+        distances = np.sum(codewords*codewords, axis=1) - 2.0*np.dot(points, codewords.T)
+        return np.argmin(distances, axis=1)
+
+    def build_gaussian_selection(self, X, num_codewords=64, shortlist_size=32, kmeans_iters=10, seed=None):
+        """
+        Prepare Gaussian selection scoring (see score_top_c). The component means are vector quantized into
+        num_codewords codewords with k-means, then each codeword gets a shortlist of the shortlist_size components
+        that are most often among the shortlist_size best components of the frames of X nearest to it, the most
+        frequent first. Codewords no frame falls on rank components by their likelihood at the codeword. Rebuild
+        after retraining.
+        """
+        M, D = self.M, self.D
+        K = min(num_codewords, M)
+        S = min(shortlist_size, M)
+        if K < 1 or S < 1:
+            raise RuntimeError("num_codewords and shortlist_size must be positive")
+        if not self.components.constants_valid:
+            self.internal_numpy_constants()
+        rng = np.random.RandomState(seed)
+        scale = 1.0/np.sqrt(np.mean(self.components.variances(), axis=0, dtype=np.float64))
+        points = np.asarray(self.components.means, dtype=np.float64).reshape(M, D)*scale
+        codewords = points[rng.permutation(M)[:K]]
+        for i in range(kmeans_iters):
+            nearest = self.internal_nearest_codewords(points, codewords)
+            for k in range(K):
+                if np.any(nearest == k):
+                    codewords[k] = points[nearest == k].mean(axis=0)
+
+        X = np.asarray(X, dtype=np.float64)
+        log_joint, logprob = self.internal_numpy_estep1(X)
+        best = np.argpartition(-log_joint, S-1, axis=0)[:S] if S < M else np.tile(np.arange(M)[:, np.newaxis], (1, X.shape[0]))
+        nearest = self.internal_nearest_codewords(X*scale, codewords)
+        counts = np.zeros((K, M))
+        np.add.at(counts, (np.tile(nearest, (S, 1)), best), 1)
+        at_codewords, logprob = self.internal_numpy_estep1(codewords/scale)
+        shortlists = np.empty((K, S), dtype=np.int32)
+        for k in range(K):
+            shortlists[k] = np.lexsort((-at_codewords[:, k], -counts[k]))[:S]
+        self.gaussian_selection = GMMGaussianSelection(codewords, shortlists, scale, self.components.version)
+        return self.gaussian_selection
+
+    def score_top_c(self, obs_data, C=5):
+        """
+        Approximate per-frame log-likelihoods using only the first C components of the shortlist of each frame's
+        nearest codeword, so each frame costs one codebook search plus C components instead of all M. On a
+        compiled backend this runs natively, one frame at a time. Needs build_gaussian_selection. The error
+        against score is measured by gaussian_selection_error.
+        """
+        selection = self.gaussian_selection
+        if selection is None or selection.version != self.components.version:
+            raise RuntimeError("Call build_gaussian_selection first, and again after the components change")
+        if not 1 <= C <= selection.shortlists.shape[1]:
+            raise RuntimeError("C must be between 1 and the shortlist size, %d" % selection.shortlists.shape[1])
+        N = obs_data.shape[0]
+        logprob = np.empty(N)
+        if self.internal_select_backend('eval', N) != 'numpy':
+            self.internal_alloc_event_data(obs_data)
+            self.internal_alloc_component_data()
+            K, S = selection.shortlists.shape
+            self.get_asp_mod().score_shortlist(native_array(selection.codewords, dtypes=(np.float64,)), native_array(selection.shortlists, dtypes=(np.int32,)),
+                                               native_array(selection.scale, dtypes=(np.float64,)), logprob, K, S, C, self.D, N, GMM.cvtype_name_list.index(self.cvtype))
+            return logprob # N approximate log probabilities
+        X = np.asarray(obs_data, dtype=np.float64)
+        nearest = self.internal_nearest_codewords(X*selection.scale, selection.codewords)
+        for k in np.unique(nearest):
+            frames = np.flatnonzero(nearest == k)
+            logprob[frames] = self.internal_numpy_estep1(X[frames], selection.shortlists[k, :C])[1]
+        return logprob # N approximate log probabilities
+
+    def gaussian_selection_error(self, obs_data, C=5):
+        """
+        Mean and maximum absolute difference between score_top_c and the exact score over obs_data.
+        """
+        exact = np.array(self.score(obs_data), dtype=np.float64)
+        error = np.abs(self.score_top_c(obs_data, C) - exact)
+        return float(np.mean(error)), float(np.max(error))
 
-    def predict(self, obs_data):
+    def score_ragged(self, X_concat, offsets, reduce='mean'):
+        """
+        Score many sequences stored back to back in X_concat in one eval call. See score_ragged.
+        """
+        return score_ragged([self], X_concat, offsets, reduce)[0] # S per-sequence scores
+
+    def supervectors(self, X_concat, offsets, relevance_factor=16.0, normalize=True, out=None):
+        """
+        MAP-adapted mean supervectors of many sequences stored back to back in X_concat, with this GMM as the UBM.
+        See supervectors.
+        """
+        return supervectors(self, X_concat, offsets, relevance_factor, normalize, out) # S x M*D supervectors
+
+    def decode(self, obs_data, logprob_out=None, out=None):
+        """
+        logprob_out and out, if given, receive the log probabilities and the component indexes (see predict).
+        """
+        self.internal_check_output(out, (obs_data.shape[0],), np.intp)
+        logprob, posteriors = self.eval(obs_data, logprob_out=logprob_out)
+        return logprob, posteriors.argmax(axis=0, out=out) # N log probabilities, N indexes of most likely components 
+
+    def predict(self, obs_data, out=None):
+        """
+        out, if given, is a C-contiguous np.intp array of N that receives the indexes and is returned.
+        """
+        self.internal_check_output(out, (obs_data.shape[0],), np.intp)
         logprob, posteriors = self.eval(obs_data)
-        return posteriors.argmax(axis=0) # N indexes of most likely components
+        return posteriors.argmax(axis=0, out=out) # N indexes of most likely components
+
+    def split_components(self, new_M):
+        """
+        A new GMM with new_M >= M components, made by repeatedly splitting the heaviest component in two along the
+        principal axis of its covariance (means half a standard deviation either side, half the weight each), to
+        warm-start training a larger model from this one.
+        """
+        if new_M < self.M:
+            raise RuntimeError("Cannot split %d components into %d" % (self.M, new_M))
+        M, D = self.M, self.D
+        weights = list(np.asarray(self.components.weights, dtype=np.float64))
+        means = list(np.asarray(self.components.means, dtype=np.float64).reshape(M, D))
+        expanded = self.components.expanded_covars()
+        sources = list(range(M)) # the component each new one inherits its covariance from
+        while len(weights) < new_M:
+            m = int(np.argmax(weights))
+            eigenvalues, eigenvectors = np.linalg.eigh(expanded[sources[m]])
+            offset = 0.5*np.sqrt(max(eigenvalues[-1], 0.0))*eigenvectors[:, -1]
+            weights[m] *= 0.5
+            weights.append(weights[m])
+            means.append(means[m] + offset)
+            means[m] = means[m] - offset
+            sources.append(sources[m])
+        covars = np.asarray(self.components.covars).reshape(covars_shape(self.cvtype, M, D))
+        if self.cvtype != 'tied':
+            covars = covars[sources]
+        return GMM(new_M, D, cvtype=self.cvtype, backend=self.backend, weights=np.array(weights, dtype=np.float32),
+                   means=np.array(means, dtype=np.float32), covars=np.array(covars, dtype=np.float32))
+
+    def num_parameters(self):
+        """
+        The number of free parameters: M-1 weights, M*D means and the covariance parameters of the cvtype.
+        """
+        M, D = self.M, self.D
+        covar_parameters = {'spherical': M, 'diag': M*D, 'tied': D*(D+1)//2, 'full': M*D*(D+1)//2}[self.cvtype]
+        return M - 1 + M*D + covar_parameters
 
     def merge_components(self, c1, c2, new_component):
+        self.internal_select_native_backend()
+        self.internal_alloc_component_data()
+        self.get_asp_mod().merge_components(c1, c2, new_component, self.M, self.D, int(self.cvtype == 'diag'))
         self.get_asp_mod().dealloc_temp_components_on_CPU()
-        self.get_asp_mod().merge_components(c1, c2, new_component, self.M, self.D)
         self.M -= 1
         self.components.shrink_components(self.M)
-        self.get_asp_mod().relink_components_on_CPU(self.components.weights, self.components.means, self.components.covars)
+        self.get_asp_mod().relink_components_on_CPU(self.components.weights, self.components.means, self.components.covars, self.components.comp_probs, self.components.Rinv, self.components.constant)
+        self.native_state.component_data_version = self.components.version
+
+    def reduce_components(self, target_M):
+        """
+        Greedily merge the pair of components closest by compute_distance_rissanen until target_M remain, in a
+        single native call. Only diag and full models can be reduced; the distances weigh components by the soft
+        counts of their last native training. Returns the number of merges.
+        """
+        if self.cvtype not in ['diag', 'full']:
+            raise RuntimeError("reduce_components supports only diag and full covariances, not %s" % self.cvtype)
+        if not 1 <= target_M <= self.M:
+            raise RuntimeError("target_M must be between 1 and %d, got %s" % (self.M, target_M))
+        if not self.components.constants_valid:
+            self.internal_numpy_constants()
+        self.internal_select_native_backend()
+        self.internal_alloc_component_data()
+        merges = self.get_asp_mod().reduce_components(self.M, target_M, self.D, int(self.cvtype == 'diag'))
+        self.M -= merges
+        self.components.shrink_components(self.M)
+        self.get_asp_mod().relink_components_on_CPU(self.components.weights, self.components.means, self.components.covars, self.components.comp_probs, self.components.Rinv, self.components.constant)
+        self.native_state.component_data_version = self.components.version
+        return merges
 
     def compute_distance_rissanen(self, c1, c2):
-        self.get_asp_mod().compute_distance_rissanen(c1, c2, self.D)
-        new_component = self.get_asp_mod().compiled_module.component_distance.new_component
-        dist = self.get_asp_mod().compiled_module.component_distance.distance
+        self.internal_select_native_backend()
+        self.internal_alloc_component_data()
+        new_component, dist = self.get_asp_mod().compute_distance_rissanen(c1, c2, self.D, int(self.cvtype == 'diag'))
         return new_component, dist
 
     def find_top_KL_pairs(self, K, gmm_list):
-        if GMM.log_table_allocated is None:
+        self.internal_select_native_backend()
+        if self.active_backend not in GMM.log_table_allocated:
             self.get_asp_mod().create_lut_log_table()
-            GMM.log_table_allocated = 1
+            GMM.log_table_allocated.add(self.active_backend)
             
         l = len(gmm_list)
+        variances = [g.components.variances() for g in gmm_list]
         score_list = []
         for gmm1idx in range(l):
             for gmm2idx in range(gmm1idx+1, l):
-                score = self.get_asp_mod().compute_KL_distance(gmm_list[gmm1idx].D, gmm_list[gmm1idx].M, gmm_list[gmm2idx].M, gmm_list[gmm1idx].components.weights, gmm_list[gmm1idx].components.means, gmm_list[gmm1idx].components.covars,gmm_list[gmm1idx].components.comp_probs, gmm_list[gmm2idx].components.weights, gmm_list[gmm2idx].components.means, gmm_list[gmm2idx].components.covars, gmm_list[gmm2idx].components.comp_probs)
+                score = self.get_asp_mod().compute_KL_distance(gmm_list[gmm1idx].D, gmm_list[gmm1idx].M, gmm_list[gmm2idx].M, gmm_list[gmm1idx].components.weights, gmm_list[gmm1idx].components.means, variances[gmm1idx],gmm_list[gmm1idx].components.comp_probs, gmm_list[gmm2idx].components.weights, gmm_list[gmm2idx].components.means, variances[gmm2idx], gmm_list[gmm2idx].components.comp_probs)
                 score_list.append((score, (gmm1idx,gmm2idx)))
 
         sorted_list = sorted(score_list, key=lambda score: score[0])
@@ -754,7 +2223,250 @@ class GMM(object):
                 for k in range(0,len(gmm_list)-1):
                     ret_list.append(sorted_list[k][1])
         return ret_list
+
+    def save(self, filename):
+        """
+        Write the model in the binary model format (see load_gmm), including precomputed scoring constants.
+        """
+        if self.components.constants_valid:
+            Rinv, constant = self.components.Rinv, self.components.constant
+        else:
+            Rinv, constant = self.components.compute_scoring_constants()
+        blocks = [self.components.weights, self.components.means, self.components.covars, Rinv, constant]
+        blocks = [np.ascontiguousarray(b, dtype=np.float32).ravel() for b in blocks]
+
+        offset = GMM_BINARY_HEADER_SIZE
+        table = []
+        for b in blocks:
+            table.extend([offset, b.nbytes])
+            offset += -(-b.nbytes // GMM_BINARY_ALIGNMENT) * GMM_BINARY_ALIGNMENT
+
+        header = struct.pack(GMM_BINARY_HEADER_FORMAT, GMM_BINARY_MAGIC, GMM_BINARY_VERSION, self.M, self.D,
+                             GMM.cvtype_name_list.index(self.cvtype), len(blocks), *table)
+        f = open(filename, 'wb')
+        try:
+            f.write(header)
+            for b, start in zip(blocks, table[0::2]):
+                f.seek(start)
+                b.tofile(f)
+            f.truncate(offset)
+        finally:
+            f.close()
+
+def release_native_state():
+    """
+    Free the native event, component, eval and scratch buffers that the calling thread holds, on every backend.
+    They are freed anyway when the thread exits; this frees them early, e.g. in a long-lived worker thread that is
+    done with large data. Models used afterwards on the same thread reallocate what they need.
+    """
+    if GMM is None: return
+    for state in GMM.native_states.values():
+        state.release()
+
+#Binary model format: a fixed-size little-endian header followed by 64-byte aligned float32 blocks for
+#weights [M], means [M*D], covars and Rinv (laid out as covars_shape) and log-constants [M]. The header stores the
+#format version, M, D, the index of the cvtype in GMM.cvtype_name_list and an (offset, nbytes) pair per block.
+#Earlier versions stored diag (version 1) and full (versions 1 and 2) covars and Rinv as M*D*D matrices; they
+#are still read.
+GMM_BINARY_MAGIC = b'GMMB'
+GMM_BINARY_VERSION = 3
+GMM_BINARY_NUM_BLOCKS = 5
+GMM_BINARY_HEADER_FORMAT = '<4sIIIII' + 'QQ'*GMM_BINARY_NUM_BLOCKS
+GMM_BINARY_HEADER_SIZE = 128
+GMM_BINARY_ALIGNMENT = 64
+
+def load_gmm(filename, use_mmap=True):
+    """
+    Load a model written by GMM.save. With use_mmap the parameter arrays are copy-on-write views of a single
+    memory map of the file, so loading does no parsing or copying and scoring reuses the stored constants.
+    """
+    if use_mmap:
+        buf = np.memmap(filename, dtype=np.uint8, mode='c')
+    else:
+        buf = np.fromfile(filename, dtype=np.uint8)
+    fields = struct.unpack_from(GMM_BINARY_HEADER_FORMAT, buf)
+    magic, version, M, D, cvtype_index, num_blocks = fields[:6]
+    if magic != GMM_BINARY_MAGIC or num_blocks != GMM_BINARY_NUM_BLOCKS:
+        raise RuntimeError("%s is not a GMM binary model file" % filename)
+    if not 1 <= version <= GMM_BINARY_VERSION:
+        raise RuntimeError("%s is a version %d GMM binary model file, only versions 1 to %d are supported" % (filename, version, GMM_BINARY_VERSION))
+    table = fields[6:]
+    cvtype = GMM.cvtype_name_list[cvtype_index]
+    dense = (cvtype == 'diag' and version < 2) or (cvtype == 'full' and version < 3)
+    stored_shape = (M, D, D) if dense else covars_shape(cvtype, M, D)
+    shapes = [(M,), (M, D), stored_shape, stored_shape, (M,)]
+    weights, means, covars, Rinv, constant = [buf[start:start+nbytes].view(np.float32).reshape(shape)
+                                              for start, nbytes, shape in zip(table[0::2], table[1::2], shapes)]
+    if dense:
+        covars = compact_covars(covars, cvtype, M, D)
+        Rinv = compact_covars(Rinv, cvtype, M, D)
+
+    gmm = GMM(M, D, means=means, covars=covars, weights=weights, cvtype=cvtype)
+    gmm.components = GMMComponents(M, D, weights, means, covars, Rinv, constant, gmm.cvtype)
+    return gmm
                             
+def load_stream_checkpoint(filename, backend=None):
+    """
+    A GMM resuming the partial_fit stream saved by GMM.save_stream_checkpoint.
+    """
+    f = np.load(filename)
+    try:
+        M, D, cvtype = int(f['M']), int(f['D']), str(f['cvtype'])
+        gmm = GMM(M, D, cvtype=cvtype, backend=backend, weights=np.array(f['weights'], dtype=np.float32),
+                  means=np.array(f['means'], dtype=np.float32), covars=np.array(f['covars'], dtype=np.float32))
+        gmm.components_seeded = bool(f['seeded'])
+        gmm.stream_state = GMMStreamState(M, D, cvtype)
+        gmm.stream_state.step = int(f['step'])
+        gmm.stream_state.counts[:] = f['counts']
+        gmm.stream_state.first[:] = f['first']
+        gmm.stream_state.second[:] = f['second']
+    finally:
+        f.close()
+    return gmm
+
+def check_offsets(offsets, N):
+    """
+    The sequence boundaries of a ragged batch as int64, after checking they start at 0, end at N and never decrease.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if offsets.ndim != 1 or offsets.shape[0] < 1 or offsets[0] != 0 or offsets[-1] != N or np.any(np.diff(offsets) < 0):
+        raise RuntimeError("offsets must be non-decreasing, start at 0 and end at the number of events (%d)" % N)
+    return offsets
+
+def score_ragged(gmm_list, X_concat, offsets, reduce='mean'):
+    """
+    Score S sequences stored back to back in X_concat against each GMM in gmm_list.
+    Sequence s is X_concat[offsets[s]:offsets[s+1]], so offsets has S+1 entries, starting at 0 and ending at N.
+    The events are loaded once per backend and each model is evaluated over all of them in a single call; the frame
+    log-likelihoods are then summed or averaged per sequence (empty sequences give 0 for 'sum', nan for 'mean').
+    Returns a len(gmm_list) x S array.
+    """
+    if reduce not in ('mean', 'sum'):
+        raise RuntimeError("reduce must be 'mean' or 'sum', got %r" % (reduce,))
+    N = X_concat.shape[0]
+    offsets = check_offsets(offsets, N)
+    for gmm in gmm_list:
+        if gmm.D != X_concat.shape[1]:
+            raise RuntimeError("Data has %d features, model expects %d features." % (X_concat.shape[1], gmm.D))
+
+    lengths = np.diff(offsets)
+    result = np.empty((len(gmm_list), lengths.shape[0]), dtype=np.float64)
+    if N == 0:
+        result[:] = 0.0 if reduce == 'sum' else np.nan
+        return result
+
+    loaded_backends = set()
+    for i, gmm in enumerate(gmm_list):
+        backend_name = gmm.internal_select_backend('eval', N)
+        if backend_name != 'numpy' and backend_name not in loaded_backends:
+            gmm.internal_alloc_event_data(X_concat)
+            loaded_backends.add(backend_name)
+        logprob, posteriors = gmm.internal_eval_loaded_events(X_concat)
+        cumulative = np.zeros(N+1, dtype=np.float64)
+        np.cumsum(logprob, out=cumulative[1:])
+        result[i] = cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+    if reduce == 'mean':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result /= lengths
+    return result
+
+def supervectors(ubm, X_concat, offsets, relevance_factor=16.0, normalize=True, out=None):
+    """
+    The GMM supervector of each of S sequences stored back to back in X_concat (laid out as for score_ragged): the
+    means of ubm MAP-adapted to the sequence (see GMM.map_adapt), concatenated into M*D values. With normalize, the
+    means are scaled by sqrt(weight)/stddev of their ubm component, so that dot products between supervectors
+    approximate the KL divergence kernel. The ubm is evaluated over all the events in a single call; on a compiled
+    backend the per-sequence statistics are then accumulated natively in one pass over the events, straight into
+    out, and on the numpy backend they are differences of prefix sums. out, if given, is a C-contiguous
+    S x M*D float32 array to fill. Returns the S x M*D supervectors.
+    """
+    M, D = ubm.M, ubm.D
+    N = X_concat.shape[0]
+    offsets = check_offsets(offsets, N)
+    if X_concat.shape[1] != D:
+        raise RuntimeError("Data has %d features, model expects %d features." % (X_concat.shape[1], D))
+    S = offsets.shape[0] - 1
+    if out is None:
+        out = np.empty((S, M*D), dtype=np.float32)
+    elif out.shape != (S, M*D) or out.dtype != np.float32 or not out.flags.c_contiguous:
+        raise RuntimeError("out must be a C-contiguous float32 array of shape %s" % ((S, M*D),))
+    means = np.asarray(ubm.components.means, dtype=np.float64).reshape(M, D)
+    result = out.reshape(S, M, D)
+    if N == 0:
+        result[:] = means
+    elif ubm.internal_select_backend('eval', N) != 'numpy':
+        ubm.internal_alloc_event_data(X_concat)
+        ubm.internal_eval_loaded_events(X_concat)
+        ubm.get_asp_mod().supervector_statistics(offsets, out, S, M, D, N, relevance_factor)
+    else:
+        logprob, log_joint = ubm.internal_eval_loaded_events(X_concat)
+        posteriors = np.exp(np.asarray(log_joint, dtype=np.float64) - logprob)
+        X = np.asarray(X_concat, dtype=np.float64)
+        cumulative = np.zeros((N+1, D+1), dtype=np.float64)
+        for m in range(M):
+            # Column D accumulates the soft counts, the others the posterior-weighted events
+            np.cumsum(posteriors[m][:, np.newaxis]*X, axis=0, out=cumulative[1:, :D])
+            np.cumsum(posteriors[m], out=cumulative[1:, D])
+            stats = cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+            result[:, m, :] = (stats[:, :D] + relevance_factor*means[m])/(stats[:, D:] + relevance_factor)
+    if normalize:
+        scale = np.sqrt(np.asarray(ubm.components.weights, dtype=np.float64)[:, np.newaxis]/ubm.components.variances())
+        result *= scale.astype(np.float32)
+    return out
+
+def select_num_components(X, M_values, criterion='bic', cvtype='diag', backend=None, min_em_iters=1, max_em_iters=10):
+    """
+    Train a GMM for each number of components in M_values and score it with criterion, 'bic' (-2*loglik +
+    p*log(N)) or 'aic' (-2*loglik + 2p), where p is GMM.num_parameters(); lower is better.
+    The smallest order is trained first; every larger one is warm-started by splitting its components (see
+    GMM.split_components) and all of them are trained concurrently on a thread pool, against one float32 copy of X.
+    Returns the best GMM and the sweep as a list of (M, score, likelihood, gmm) sorted by M.
+    """
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    if criterion not in ('bic', 'aic'):
+        raise RuntimeError("criterion must be 'bic' or 'aic', got %r" % (criterion,))
+    M_values = sorted(set(M_values))
+    if len(M_values) == 0 or M_values[0] < 1:
+        raise RuntimeError("M_values must be positive numbers of components")
+    X = native_array(X, ndim=2)
+    N = X.shape[0]
+
+    base = GMM(M_values[0], X.shape[1], cvtype=cvtype, backend=backend)
+    likelihoods = [base.train(X, min_em_iters=min_em_iters, max_em_iters=max_em_iters)]
+    candidates = [base.split_components(M) for M in M_values[1:]]
+    if candidates:
+        def train_candidate(gmm):
+            return gmm.train(X, min_em_iters=min_em_iters, max_em_iters=max_em_iters)
+        pool = ThreadPool(min(len(candidates), cpu_count()))
+        try:
+            likelihoods += pool.map(train_candidate, candidates)
+        finally:
+            pool.close()
+            pool.join()
+
+    sweep = []
+    for gmm, likelihood in zip([base] + candidates, likelihoods):
+        penalty = gmm.num_parameters()*(math.log(N) if criterion == 'bic' else 2.0)
+        sweep.append((gmm.M, -2.0*likelihood + penalty, likelihood, gmm))
+    best = min(sweep, key=lambda entry: entry[1])
+    return best[3], sweep
+
+def calibrate_cost_model(sizes=((1000, 8, 8), (20000, 16, 16)), cvtypes=('diag', 'full'), backends=None, repeats=3):
+    """
+    Time a short train and a few evals on random data of each (N, M, D) size on each backend, so the cost
+    model has measurements for every backend before it starts dispatching real calls.
+    """
+    for backend_name in backends or GMM.available_backends:
+        for N, M, D in sizes:
+            X = np.random.randn(N, D).astype(np.float32)
+            for cvtype in cvtypes:
+                gmm = GMM(M, D, cvtype=cvtype, backend=backend_name)
+                gmm.train(X, min_em_iters=1, max_em_iters=1)
+                for r in range(repeats):
+                    gmm.score(X)
+    return GMM.cost_model
+
 #Functions for calculating distance between two GMMs according to BIC scores.
 def compute_distance_BIC(gmm1, gmm2, data, em_iters=10):
     cd1_M = gmm1.M
@@ -764,9 +2476,13 @@ def compute_distance_BIC(gmm1, gmm2, data, em_iters=10):
     ratio1 = float(cd1_M)/float(nComps)
     ratio2 = float(cd2_M)/float(nComps)
 
-    w = np.ascontiguousarray(np.append(ratio1*gmm1.components.weights, ratio2*gmm2.components.weights))
-    m = np.ascontiguousarray(np.append(gmm1.components.means, gmm2.components.means))
-    c = np.ascontiguousarray(np.append(gmm1.components.covars, gmm2.components.covars))
+    w = np.append(ratio1*gmm1.components.weights, ratio2*gmm2.components.weights)
+    m = np.append(gmm1.components.means, gmm2.components.means)
+    if gmm1.cvtype == 'tied':
+        # The merged model still shares one covariance, so pool the two
+        c = ratio1*gmm1.components.covars + ratio2*gmm2.components.covars
+    else:
+        c = np.append(gmm1.components.covars, gmm2.components.covars)
 
     temp_GMM = GMM(nComps, gmm1.D, weights=w, means=m, covars=c, cvtype=gmm1.cvtype)
 
@@ -782,9 +2498,13 @@ def compute_distance_BIC_idx(gmm1, gmm2, data, index_list):
     ratio1 = float(cd1_M)/float(nComps)
     ratio2 = float(cd2_M)/float(nComps)
     
-    w = np.ascontiguousarray(np.append(ratio1*gmm1.components.weights, ratio2*gmm2.components.weights))
-    m = np.ascontiguousarray(np.append(gmm1.components.means, gmm2.components.means))
-    c = np.ascontiguousarray(np.append(gmm1.components.covars, gmm2.components.covars))
+    w = np.append(ratio1*gmm1.components.weights, ratio2*gmm2.components.weights)
+    m = np.append(gmm1.components.means, gmm2.components.means)
+    if gmm1.cvtype == 'tied':
+        # The merged model still shares one covariance, so pool the two
+        c = ratio1*gmm1.components.covars + ratio2*gmm2.components.covars
+    else:
+        c = np.append(gmm1.components.covars, gmm2.components.covars)
     temp_GMM = GMM(nComps, gmm1.D, weights=w, means=m, covars=c, cvtype=gmm1.cvtype)
     
     temp_GMM.train_on_subset_c(data, index_list)
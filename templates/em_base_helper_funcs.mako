@@ -2,6 +2,10 @@
 #define COVARIANCE_DYNAMIC_RANGE 1E6
 #define MINVALUEFORMINUSLOG -1000.0
 
+// Full covariances keep only the upper triangle of each symmetric matrix, row by row
+#define PACKED_SIZE(D) ((D)*((D)+1)/2)
+#define PACKED_INDEX(i, j, D) ((i)*(2*(D)-(i)-1)/2+(j)) // entry (i, j) with i <= j
+
 void print_evals(float* component_memberships, float* loglikelihoods, int num_events, int num_components){
   for(int m = 0; m < num_components; m++){
     for(int e = 0; e < num_events; e++)
@@ -53,14 +57,6 @@ void print_components(components_t * components, int num_components, int num_dim
   printf("===============\n");
 }
 
-typedef struct return_component_container
-{
-  boost::python::object component;
-  float distance;
-} ret_c_con_t;
-
-ret_c_con_t ret;
-
 void mvtmeans(float* data_by_event, int num_dimensions, int num_events, float* means) {
     for(int d=0; d < num_dimensions; d++) {
         means[d] = 0.0;
@@ -89,33 +85,97 @@ void normalize_pi(components_t* components, int num_components) {
     }
     
     for(int m=0; m < num_components; m++){
-        components->pi[m] /= total; 
+        components->pi[m] /= total;
     }
 }
+
+//=== Sparse responsibilities ===
+
+// The responsibilities kept by a sparse M-step, grouped by component: component m's are
+// values[indptr[m]:indptr[m+1]], for the events indices[indptr[m]:indptr[m+1]]
+typedef struct sparse_memberships_struct {
+  int* indptr;   // [M+1]
+  int* indices;  // [capacity]
+  float* values; // [capacity]
+  int capacity;
+} sparse_memberships_t;
+
+void alloc_sparse_memberships(sparse_memberships_t* csr, int num_components) {
+  csr->indptr = (int*) malloc(sizeof(int)*(num_components+1));
+  csr->indptr[0] = 0;
+  csr->indices = NULL;
+  csr->values = NULL;
+  csr->capacity = 0;
+}
+
+// Turns the per-component counts in indptr[1..M] into offsets, and grows the entry buffers to hold them all.
+// The buffers are reused from one EM iteration to the next
+void reserve_sparse_memberships(sparse_memberships_t* csr, int num_components) {
+  for(int m = 0; m < num_components; m++) {
+    csr->indptr[m+1] += csr->indptr[m];
+  }
+  int nnz = csr->indptr[num_components];
+  if(nnz > csr->capacity) {
+    csr->capacity = 2*csr->capacity > nnz ? 2*csr->capacity : nnz;
+    free(csr->indices);
+    free(csr->values);
+    csr->indices = (int*) malloc(sizeof(int)*csr->capacity);
+    csr->values = (float*) malloc(sizeof(float)*csr->capacity);
+  }
+}
+
+void dealloc_sparse_memberships(sparse_memberships_t* csr) {
+  free(csr->indptr);
+  free(csr->indices);
+  free(csr->values);
+}
+//=== Threading ===
+
+// The event, component, eval and scratch state below is per thread, so Python threads
+// can train or score independent models at the same time once the GIL is released.
+// dealloc_thread_state_on_CPU frees it; Python calls it when the thread's GMMNativeState goes away
+#ifndef GMM_THREAD_LOCAL
+#define GMM_THREAD_LOCAL __thread
+#endif
+
+// Releases the GIL for the lifetime of the object, or until reacquire()
+struct release_gil {
+  PyThreadState *state;
+  release_gil() { state = PyEval_SaveThread(); }
+  void reacquire() {
+    if(state) PyEval_RestoreThread(state);
+    state = NULL;
+  }
+  ~release_gil() { reacquire(); }
+};
+
 //=== Data structure pointers ===
 
 //CPU copies of events
-float *fcs_data_by_event;
-float *fcs_data_by_dimension;
+GMM_THREAD_LOCAL float *fcs_data_by_event;
+GMM_THREAD_LOCAL float *fcs_data_by_dimension;
+static GMM_THREAD_LOCAL int event_capacity = 0; // floats allocated for fcs_data_by_dimension
+static GMM_THREAD_LOCAL float *event_copy = NULL; // by-event copy of inputs that are not C-contiguous float32
+static GMM_THREAD_LOCAL int event_copy_capacity = 0;
 
 // index list for train_on_subset
-int* index_list;
+GMM_THREAD_LOCAL int* index_list;
 
 
 //CPU copies of components
-components_t components;
-components_t saved_components;
-components_t** scratch_component_arr; // for computing distances and merging
-static int num_scratch_components = 0;
+GMM_THREAD_LOCAL components_t components;
+GMM_THREAD_LOCAL components_t saved_components;
+GMM_THREAD_LOCAL components_t** scratch_component_arr = NULL; // for computing distances and merging
+static GMM_THREAD_LOCAL int num_scratch_components = 0;
 
 //CPU copies of eval data
-float *component_memberships;
-float *loglikelihoods;
+GMM_THREAD_LOCAL float *component_memberships;
+GMM_THREAD_LOCAL float *loglikelihoods;
 
 //=== AHC function prototypes ===
-void copy_component(components_t *dest, int c_dest, components_t *src, int c_src, int num_dimensions);
-void add_components(components_t *components, int c1, int c2, components_t *temp_component, int num_dimensions);
-float component_distance(components_t *components, int c1, int c2, components_t *temp_component, int num_dimensions);
+void copy_component(components_t *dest, int c_dest, components_t *src, int c_src, int num_dimensions, int diag);
+void add_components(components_t *components, int c1, int c2, components_t *temp_component, int num_dimensions, int diag);
+float component_distance(components_t *components, int c1, int c2, components_t *temp_component, int num_dimensions, int diag);
 
 //=== Helper function prototypes ===
 void writeCluster(FILE* f, components_t components, int c,  int num_dimensions);
@@ -123,6 +183,129 @@ void printCluster(components_t components, int c, int num_dimensions);
 void invert_cpu(float* data, int actualsize, float* log_determinant);
 int  invert_matrix(float* a, int n, float* determinant);
 
+//=== Full, diagonal, spherical and tied covariances ===
+
+// Full components store the packed upper triangles of their matrices, PACKED_SIZE(D) entries each;
+// diagonal components store only their variances, R[m*D+i], and precisions, Rinv[m*D+i];
+// spherical components store one variance each in R[m] and its inverse in Rinv[m];
+// tied components share the single D*D matrix in R and Rinv
+
+void pack_covariance(float* matrix, float* packed, int D) {
+    for(int i=0, p=0; i < D; i++) {
+        for(int j=i; j < D; j++, p++) {
+            packed[p] = matrix[i*D+j];
+        }
+    }
+}
+
+void unpack_covariance(float* packed, float* matrix, int D) {
+    for(int i=0, p=0; i < D; i++) {
+        for(int j=i; j < D; j++, p++) {
+            matrix[i*D+j] = packed[p];
+            matrix[j*D+i] = packed[p];
+        }
+    }
+}
+
+void seed_full_covars(components_t* components, float* R0, int num_dimensions, int num_components) {
+    for(int c=0; c < num_components; c++) {
+        pack_covariance(R0, &(components->R[c*PACKED_SIZE(num_dimensions)]), num_dimensions);
+        memset(&(components->Rinv[c*PACKED_SIZE(num_dimensions)]), 0, sizeof(float)*PACKED_SIZE(num_dimensions));
+    }
+}
+
+void seed_diag_covars(components_t* components, float* R0, int num_dimensions, int num_components) {
+    for(int c=0; c < num_components; c++) {
+        for(int i=0; i < num_dimensions; i++) {
+            components->R[c*num_dimensions+i] = R0[i*num_dimensions+i];
+            components->Rinv[c*num_dimensions+i] = 0.0f;
+        }
+    }
+}
+
+void seed_spherical_covars(components_t* components, float* R0, int num_dimensions, int num_components) {
+    float variance = 0.0f;
+    for(int i=0; i < num_dimensions; i++) {
+        variance += R0[i*num_dimensions+i];
+    }
+    for(int c=0; c < num_components; c++) {
+        components->R[c] = variance / (float) num_dimensions;
+        components->Rinv[c] = 0.0f;
+    }
+}
+
+void seed_tied_covars(components_t* components, float* R0, int num_dimensions) {
+    memcpy(components->R, R0, sizeof(float)*num_dimensions*num_dimensions);
+    memset(components->Rinv, 0, sizeof(float)*num_dimensions*num_dimensions);
+}
+
+void diag_constants(components_t* components, int M, int D) {
+    for(int m=0; m < M; m++) {
+        float log_determinant = 0.0f;
+        for(int i=0; i < D; i++) {
+            components->Rinv[m*D+i] = 1.0f / components->R[m*D+i];
+            log_determinant += logf(components->R[m*D+i]);
+        }
+        components->constant[m] = -D*0.5f*logf(2*PI) - 0.5f*log_determinant;
+        components->CP[m] = components->constant[m]*2.0;
+    }
+    normalize_pi(components, M);
+}
+
+void spherical_constants(components_t* components, int M, int D) {
+    for(int m=0; m < M; m++) {
+        components->Rinv[m] = 1.0f / components->R[m];
+        components->constant[m] = -D*0.5f*logf(2*PI) - 0.5f*D*logf(components->R[m]);
+        components->CP[m] = components->constant[m]*2.0;
+    }
+    normalize_pi(components, M);
+}
+
+void tied_constants(components_t* components, int M, int D) {
+    float log_determinant;
+    memcpy(components->Rinv, components->R, sizeof(float)*D*D);
+    invert_cpu(components->Rinv, D, &log_determinant);
+    for(int m=0; m < M; m++) {
+        components->constant[m] = -D*0.5f*logf(2*PI) - 0.5f*log_determinant;
+        components->CP[m] = components->constant[m]*2.0;
+    }
+    normalize_pi(components, M);
+}
+
+// Factors the shared inverse covariance as Rinv = W'W with W upper triangular (a Cholesky
+// factorization), so that (x-mu)' Rinv (x-mu) = |Wx - Wmu|^2. Writes W and the whitened means.
+void tied_whitening(components_t* components, int M, int D, float* W, float* whitened_means) {
+    double* L = (double*) malloc(sizeof(double)*D*D);
+    for(int i=0; i < D; i++) {
+        for(int j=0; j <= i; j++) {
+            double sum = components->Rinv[i*D+j];
+            for(int k=0; k < j; k++) {
+                sum -= L[i*D+k]*L[j*D+k];
+            }
+            if(i == j) {
+                L[i*D+i] = sqrt(sum > 0.0 ? sum : 1e-30);
+            } else {
+                L[i*D+j] = sum / L[j*D+j];
+            }
+        }
+    }
+    for(int i=0; i < D; i++) {
+        for(int j=0; j < D; j++) {
+            W[i*D+j] = (j >= i) ? (float) L[j*D+i] : 0.0f;
+        }
+    }
+    for(int m=0; m < M; m++) {
+        for(int i=0; i < D; i++) {
+            float sum = 0.0f;
+            for(int j=i; j < D; j++) {
+                sum += W[i*D+j]*components->means[m*D+j];
+            }
+            whitened_means[m*D+i] = sum;
+        }
+    }
+    free(L);
+}
+
 //============ LUTLOG ==============
 
 float *LOOKUP_TABLE;
@@ -173,8 +356,7 @@ components_t* alloc_temp_component_on_CPU(int num_dimensions) {
   return scratch_component;
 }
 
-void dealloc_temp_components_on_CPU() {
-  printf("dealloc tempcomponents on CPU\n");
+static void free_scratch_components() {
   for(int i = 0; i<num_scratch_components; i++) {
     free(scratch_component_arr[i]->N);
     free(scratch_component_arr[i]->pi);
@@ -184,29 +366,68 @@ void dealloc_temp_components_on_CPU() {
     free(scratch_component_arr[i]->means);
     free(scratch_component_arr[i]->R);
     free(scratch_component_arr[i]->Rinv);
+    free(scratch_component_arr[i]);
   }
   num_scratch_components = 0;
+}
 
+void dealloc_temp_components_on_CPU() {
+  printf("dealloc tempcomponents on CPU\n");
+  free_scratch_components();
   return;
 }
 
 
 // ================== Event data allocation on CPU  ================= :
-void alloc_events_on_CPU(PyObject *input_data) {
 
-  fcs_data_by_event = ((float*)PyArray_DATA(input_data));
-  int num_events = PyArray_DIM(input_data,0);
-  int num_dimensions = PyArray_DIM(input_data,1);
+// Grow the transposed event buffer geometrically; returns 1 if it had to be reallocated
+int reserve_event_buffer(int size) {
+  if(size <= event_capacity) return 0;
+  int new_capacity = 2*event_capacity > size ? 2*event_capacity : size;
+  free(fcs_data_by_dimension);
+  fcs_data_by_dimension = (float*) malloc(sizeof(float)*new_capacity);
+  event_capacity = new_capacity;
+  return 1;
+}
+
+// Reads a float32 or float64 N x D array with any strides. A C-contiguous float32 array is used in place as the
+// by-event layout; anything else is converted into an owned by-event copy in the same pass that builds the
+// transposed layout. Returns (reallocated, converted).
+boost::python::tuple alloc_events_on_CPU(PyObject *input_data) {
+  PyArrayObject *input_arr = (PyArrayObject*)input_data;
+  int num_events = PyArray_DIM(input_arr,0);
+  int num_dimensions = PyArray_DIM(input_arr,1);
+  npy_intp event_stride = PyArray_STRIDE(input_arr,0);
+  npy_intp dimension_stride = PyArray_STRIDE(input_arr,1);
+  const char *input = PyArray_BYTES(input_arr);
+  int is_double = PyArray_TYPE(input_arr) == NPY_FLOAT64;
+  int converted = is_double || !PyArray_IS_C_CONTIGUOUS(input_arr);
   // Transpose the event data (allows coalesced access pattern in E-step kernel)
   // This has consecutive values being from the same dimension of the data
   // (num_dimensions by num_events matrix)
-  fcs_data_by_dimension  = (float*) malloc(sizeof(float)*num_events*num_dimensions);
+  int reallocated = reserve_event_buffer(num_events*num_dimensions);
+  if(converted) {
+    if(num_events*num_dimensions > event_copy_capacity) {
+      event_copy_capacity = 2*event_copy_capacity > num_events*num_dimensions ? 2*event_copy_capacity : num_events*num_dimensions;
+      free(event_copy);
+      event_copy = (float*) malloc(sizeof(float)*event_copy_capacity);
+      reallocated = 1;
+    }
+    fcs_data_by_event = event_copy;
+  } else {
+    fcs_data_by_event = (float*)PyArray_DATA(input_arr);
+  }
 
   for(int e=0; e<num_events; e++) {
+    const char *event = input + e*event_stride;
     for(int d=0; d<num_dimensions; d++) {
-      fcs_data_by_dimension[d*num_events+e] = fcs_data_by_event[e*num_dimensions+d];
+      const char *value = event + d*dimension_stride;
+      float x = is_double ? (float)*(const double*)value : *(const float*)value;
+      fcs_data_by_dimension[d*num_events+e] = x;
+      if(converted) fcs_data_by_event[e*num_dimensions+d] = x;
     }
   }
+  return boost::python::make_tuple(reallocated, converted);
 }
 
 void alloc_index_list_on_CPU(PyObject *input_index_list) {
@@ -222,7 +443,7 @@ void alloc_events_from_index_on_CPU(PyObject *input_data, PyObject *indices, int
     }
   }
 
-  fcs_data_by_dimension = (float*)malloc(num_indices*num_dimensions*sizeof(int));
+  reserve_event_buffer(num_indices*num_dimensions);
   for(int e=0; e<num_indices; e++) {
     for(int d = 0; d<num_dimensions; d++) {
       fcs_data_by_dimension[d*num_indices+e] = fcs_data_by_event[e*num_dimensions+d];
@@ -233,23 +454,32 @@ void alloc_events_from_index_on_CPU(PyObject *input_data, PyObject *indices, int
 
 // ================== Cluster data allocation on CPU  ================= :
 
-void alloc_components_on_CPU(int M, int D, PyObject *weights, PyObject *means, PyObject *covars, PyObject *comp_probs) {
+void alloc_components_on_CPU(int M, int D, PyObject *weights, PyObject *means, PyObject *covars, PyObject *comp_probs, PyObject *Rinv, PyObject *constant) {
   components.pi = ((float*)PyArray_DATA(weights));
   components.means = ((float*)PyArray_DATA(means));
   components.R = ((float*)PyArray_DATA(covars));
   components.CP = ((float*)PyArray_DATA(comp_probs));
+  // Scoring constants live in the Python arrays so they can be saved and reloaded with the model
+  components.Rinv = ((float*)PyArray_DATA(Rinv));
+  components.constant = ((float*)PyArray_DATA(constant));
 
   components.N = (float*) malloc(sizeof(float)*M);
-  components.constant = (float*) malloc(sizeof(float)*M);
   components.avgvar = (float*) malloc(sizeof(float)*M);
-  components.Rinv = (float*) malloc(sizeof(float)*M*D*D);
+  // Training replaces these with soft counts; until then the weights stand in for them, which gives the
+  // Rissanen distances the same ordering
+  for(int m = 0; m < M; m++) {
+    components.N[m] = components.pi[m];
+  }
 }  
 
 //Hacky way to make sure the CPU pointers are aimed at the right component data
-void relink_components_on_CPU(PyObject *weights, PyObject *means, PyObject *covars) {
+void relink_components_on_CPU(PyObject *weights, PyObject *means, PyObject *covars, PyObject *comp_probs, PyObject *Rinv, PyObject *constant) {
   components.pi = ((float*)PyArray_DATA(weights));
   components.means = ((float*)PyArray_DATA(means));
   components.R = ((float*)PyArray_DATA(covars));
+  components.CP = ((float*)PyArray_DATA(comp_probs));
+  components.Rinv = ((float*)PyArray_DATA(Rinv));
+  components.constant = ((float*)PyArray_DATA(constant));
 }
 
 // ================= Eval data alloc on CPU =============== 
@@ -263,12 +493,18 @@ void alloc_evals_on_CPU(PyObject *component_mem_np_arr, PyObject *loglikelihoods
 void dealloc_events_on_CPU() {
   //free(fcs_data_by_event);
   free(fcs_data_by_dimension);
+  fcs_data_by_dimension = NULL;
+  event_capacity = 0;
+  free(event_copy);
+  event_copy = NULL;
+  event_copy_capacity = 0;
   return;
 }
 
 // ================== Index list dellocation on CPU  ================= :
 void dealloc_index_list_on_CPU() {
   free(index_list);
+  index_list = NULL;
   return;
 }
 
@@ -279,10 +515,12 @@ void dealloc_components_on_CPU() {
   //free(components.means);
   //free(components.R);
   //free(components.CP);
+  //free(components.constant);
+  //free(components.Rinv);
   free(components.N);
-  free(components.constant);
   free(components.avgvar);
-  free(components.Rinv);
+  components.N = NULL;
+  components.avgvar = NULL;
   return;
 }
 
@@ -293,6 +531,17 @@ void dealloc_evals_on_CPU() {
   return;
 }
 
+// Frees everything the calling thread holds; the pointers are left NULL, so repeating it is harmless
+void dealloc_thread_state_on_CPU() {
+  dealloc_events_on_CPU();
+  dealloc_index_list_on_CPU();
+  dealloc_components_on_CPU();
+  dealloc_evals_on_CPU();
+  free_scratch_components();
+  free(scratch_component_arr);
+  scratch_component_arr = NULL;
+}
+
 
 // ==== Accessor functions for pi, means, covars ====
 
@@ -357,7 +606,7 @@ double Log_Likelihood(int DIM, int m, float *feature, float *means, float *covar
   for(int i=0; i<DIM; i++)
     {
       x = feature[i]-means[DIM*m + i];
-      z = covars[m*DIM*DIM + i*DIM+i];
+      z = covars[m*DIM + i];
       y += x*x/z;//+lut_log(2*3.141592654*z,LOOKUP_TABLE,N_LOOKUP_SIZE); LINE MODIFIED
       // printf("y = %f, feature[%d]  = %f, mean[%d] = %f \n", y, i, feature[i], i, means[i*m+i], m*DIM*DIM+i*DIM+i, cov\
       ars[m*DIM*DIM + i*DIM+i]);
@@ -390,6 +639,7 @@ float Log_Likelihood_KL(float *feature, int DIM, int gmm_M, float *gmm_weights,
 }
 
 
+// The covars arguments hold the per-dimension variances of each component, M x DIM
 float compute_KL_distance(int DIM, int gmm1_M, int gmm2_M, PyObject *gmm1_weights_in, PyObject *gmm1_means_in, PyObject *gmm1_covars_in, PyObject *gmm1_CP_in, PyObject *gmm2_weights_in, PyObject *gmm2_means_in, PyObject *gmm2_covars_in, PyObject *gmm2_CP_in) {
 
   float aux;
@@ -416,7 +666,7 @@ float compute_KL_distance(int DIM, int gmm1_M, int gmm2_M, PyObject *gmm1_weight
           for(int j=0;j<DIM;j++)
             {
               if(j==k){
-                aux = sqrt(19.0)*sqrt(gmm1_covars[i*DIM*DIM + k*DIM+k]);
+                aux = sqrt(19.0)*sqrt(gmm1_covars[i*DIM + k]);
                 point_a[j] = gmm1_means[i*DIM+j] + aux;
                 point_b[j] = gmm1_means[i*DIM+j] - aux;
               }
@@ -442,7 +692,7 @@ float compute_KL_distance(int DIM, int gmm1_M, int gmm2_M, PyObject *gmm1_weight
           for(int j=0;j<DIM;j++)
             {
               if(j==k){
-                aux = sqrt(19.0)*sqrt(gmm2_covars[i*DIM*DIM + k*DIM+k]);
+                aux = sqrt(19.0)*sqrt(gmm2_covars[i*DIM + k]);
                 point_a[j] = gmm2_means[i*DIM+j] + aux;
                 point_b[j] = gmm2_means[i*DIM+j] - aux;
               }
@@ -465,46 +715,272 @@ float compute_KL_distance(int DIM, int gmm1_M, int gmm2_M, PyObject *gmm1_weight
 }
 
 
-int compute_distance_rissanen(int c1, int c2, int num_dimensions) {
+// Returns (merged component, distance); the merged component is a scratch component of this thread, freed by
+// dealloc_temp_components_on_CPU
+boost::python::tuple compute_distance_rissanen(int c1, int c2, int num_dimensions, int diag) {
   // compute distance function between the 2 components
 
   components_t *new_component = alloc_temp_component_on_CPU(num_dimensions);
 
-  float distance = component_distance(&components,c1,c2,new_component,num_dimensions);
+  float distance = component_distance(&components,c1,c2,new_component,num_dimensions,diag);
   //printf("distance %d-%d: %f\n", c1, c2, distance);
 
+  scratch_component_arr = (components_t**) realloc(scratch_component_arr, sizeof(components_t*)*(num_scratch_components+1));
   scratch_component_arr[num_scratch_components] = new_component;
   num_scratch_components++;
-  
-  ret.component = boost::python::object(boost::python::ptr(new_component));
-  ret.distance = distance;
-
-  return 0;
 
+  return boost::python::make_tuple(boost::python::object(boost::python::ptr(new_component)), distance);
 }
 
-void merge_components(int min_c1, int min_c2, components_t *min_component, int num_components, int num_dimensions) {
+void merge_components(int min_c1, int min_c2, components_t *min_component, int num_components, int num_dimensions, int diag) {
 
   // Copy new combined component into the main group of components, compact them
-  copy_component(&components,min_c1, min_component,0,num_dimensions);
+  copy_component(&components,min_c1, min_component,0,num_dimensions,diag);
 
   for(int i=min_c2; i < num_components-1; i++) {
   
-    copy_component(&components,i,&components,i+1,num_dimensions);
+    copy_component(&components,i,&components,i+1,num_dimensions,diag);
+  }
+}
+
+// A candidate merge for reduce_components; the versions are those of c1 and c2 when the distance was computed
+typedef struct merge_candidate {
+  float distance;
+  int c1, c2;
+  int version1, version2;
+  bool operator>(const merge_candidate &other) const { return distance > other.distance; }
+} merge_candidate;
+
+void free_temp_component(components_t *c) {
+  free(c->N);
+  free(c->pi);
+  free(c->CP);
+  free(c->constant);
+  free(c->avgvar);
+  free(c->means);
+  free(c->R);
+  free(c->Rinv);
+  free(c);
+}
+
+// Greedily merges the closest pair of components, by Rissanen distance, until target_components remain.
+// All pairwise distances are computed once, rows in parallel, and kept in a min-heap; after a merge only the
+// merged component's distances are recomputed, and heap entries that refer to an old version of a component are
+// dropped when they surface. The surviving components are compacted in their original order.
+// Returns the number of merges performed.
+int reduce_components(int num_components, int target_components, int num_dimensions, int diag) {
+  // components is thread local, so worker threads have to reach this thread's copy through a pointer
+  components_t *comps = &components;
+  std::vector<int> version(num_components, 0);
+  std::vector<char> alive(num_components, 1);
+  std::vector< std::vector<merge_candidate> > rows(num_components);
+
+  #pragma omp parallel
+  {
+    components_t *scratch = alloc_temp_component_on_CPU(num_dimensions);
+    #pragma omp for schedule(dynamic)
+    for(int c1 = 0; c1 < num_components; c1++) {
+      for(int c2 = c1+1; c2 < num_components; c2++) {
+        merge_candidate candidate = {component_distance(comps,c1,c2,scratch,num_dimensions,diag), c1, c2, 0, 0};
+        rows[c1].push_back(candidate);
+      }
+    }
+    free_temp_component(scratch);
+  }
+
+  std::priority_queue<merge_candidate, std::vector<merge_candidate>, std::greater<merge_candidate> > queue;
+  for(int c1 = 0; c1 < num_components; c1++) {
+    for(size_t k = 0; k < rows[c1].size(); k++) {
+      queue.push(rows[c1][k]);
+    }
+  }
+
+  components_t *merged = alloc_temp_component_on_CPU(num_dimensions);
+  std::vector<float> distances(num_components);
+  int remaining = num_components;
+  while(remaining > target_components && !queue.empty()) {
+    merge_candidate best = queue.top();
+    queue.pop();
+    if(!alive[best.c1] || !alive[best.c2] || version[best.c1] != best.version1 || version[best.c2] != best.version2) {
+      continue;
+    }
+    component_distance(comps,best.c1,best.c2,merged,num_dimensions,diag);
+    copy_component(comps,best.c1,merged,0,num_dimensions,diag);
+    alive[best.c2] = 0;
+    version[best.c1]++;
+    remaining--;
+    if(remaining <= target_components) {
+      break;
+    }
+
+    int c = best.c1;
+    #pragma omp parallel
+    {
+      components_t *scratch = alloc_temp_component_on_CPU(num_dimensions);
+      #pragma omp for schedule(dynamic)
+      for(int other = 0; other < num_components; other++) {
+        if(alive[other] && other != c) {
+          distances[other] = component_distance(comps,std::min(c,other),std::max(c,other),scratch,num_dimensions,diag);
+        }
+      }
+      free_temp_component(scratch);
+    }
+    for(int other = 0; other < num_components; other++) {
+      if(alive[other] && other != c) {
+        int c1 = std::min(c,other), c2 = std::max(c,other);
+        merge_candidate candidate = {distances[other], c1, c2, version[c1], version[c2]};
+        queue.push(candidate);
+      }
+    }
+  }
+  free_temp_component(merged);
+
+  int next = 0;
+  for(int c = 0; c < num_components; c++) {
+    if(alive[c]) {
+      if(next != c) {
+        copy_component(comps,next,comps,c,num_dimensions,diag);
+      }
+      next++;
+    }
+  }
+  return num_components - remaining;
+}
+
+// log(pi[m]) plus the log density of component m at event, for a model whose cvtype is the given index in
+// GMM.cvtype_name_list (diag, full, spherical, tied), from the constants left by the last constants step
+static float component_log_joint(components_t *comps, const float *event, int m, int D, int cvtype) {
+  if(comps->pi[m] <= 0.0f) {
+    return MINVALUEFORMINUSLOG;
+  }
+  const float *means = &comps->means[m*D];
+  float like = 0.0f;
+  if(cvtype == 0) {
+    const float *Rinv = &comps->Rinv[m*D];
+    for(int i = 0; i < D; i++) {
+      like += (event[i]-means[i])*(event[i]-means[i])*Rinv[i];
+    }
+  } else if(cvtype == 1) {
+    // Walk the packed upper triangle once, counting each off-diagonal term twice
+    const float *Rinv = &comps->Rinv[m*PACKED_SIZE(D)];
+    for(int i = 0, p = 0; i < D; i++) {
+      float diff = event[i]-means[i];
+      float row = 0.0f;
+      for(int j = i+1; j < D; j++) {
+        row += (event[j]-means[j])*Rinv[p+j-i];
+      }
+      like += diff*(diff*Rinv[p] + 2.0f*row);
+      p += D-i;
+    }
+  } else if(cvtype == 2) {
+    for(int i = 0; i < D; i++) {
+      like += (event[i]-means[i])*(event[i]-means[i]);
+    }
+    like *= comps->Rinv[m];
+  } else {
+    for(int i = 0; i < D; i++) {
+      float row = 0.0f;
+      for(int j = 0; j < D; j++) {
+        row += comps->Rinv[i*D+j]*(event[j]-means[j]);
+      }
+      like += (event[i]-means[i])*row;
+    }
   }
+  return -0.5f*like + comps->constant[m] + logf(comps->pi[m]);
 }
 
+// Gaussian selection scoring of the loaded events: each event is matched to its nearest codeword, comparing
+// event*scale against the K x D codewords, and only the first C components of that codeword's shortlist (K x S)
+// are evaluated. Writes the log-sum of their joint log-likelihoods to out[n], events in parallel
+void score_shortlist(PyObject *codewords_in, PyObject *shortlists_in, PyObject *scale_in, PyObject *out, int num_codewords, int shortlist_size, int C, int num_dimensions, int num_events, int cvtype) {
+  // The thread local pointers have to be read on this thread
+  const double *codewords = (const double*) PyArray_DATA(codewords_in);
+  const int *shortlists = (const int*) PyArray_DATA(shortlists_in);
+  const double *scale = (const double*) PyArray_DATA(scale_in);
+  double *logprob = (double*) PyArray_DATA(out);
+  const float *data = fcs_data_by_event;
+  components_t *comps = &components;
+  int D = num_dimensions;
+  release_gil nogil;
+
+  #pragma omp parallel for schedule(static)
+  for(int n = 0; n < num_events; n++) {
+    const float *event = &data[n*D];
+    int nearest = 0;
+    double nearest_distance = 0.0;
+    for(int k = 0; k < num_codewords; k++) {
+      double distance = 0.0;
+      for(int i = 0; i < D; i++) {
+        double diff = event[i]*scale[i] - codewords[k*D+i];
+        distance += diff*diff;
+      }
+      if(k == 0 || distance < nearest_distance) {
+        nearest = k;
+        nearest_distance = distance;
+      }
+    }
+    float total = MINVALUEFORMINUSLOG;
+    for(int c = 0; c < C; c++) {
+      total = log_add(total, component_log_joint(comps, event, shortlists[nearest*shortlist_size+c], D, cvtype));
+    }
+    logprob[n] = total;
+  }
+}
 
-float component_distance(components_t *components, int c1, int c2, components_t *temp_component, int num_dimensions) {
+// MAP-adapted means of the sequences offsets[s]..offsets[s+1] of the loaded events, from the log joint
+// probabilities and log-likelihoods left by the last eval, written to out[s*M*D + m*D + i]. Each sequence's zeroth
+// and first order statistics are accumulated in one pass over its events, sequences in parallel
+void supervector_statistics(PyObject *offsets, PyObject *out, int num_sequences, int num_components, int num_dimensions, int num_events, float relevance_factor) {
+  // The thread local pointers have to be read on this thread
+  const npy_int64 *bounds = (const npy_int64*) PyArray_DATA(offsets);
+  float *result = (float*) PyArray_DATA(out);
+  const float *data = fcs_data_by_event;
+  const float *log_joint = component_memberships;
+  const float *logprob = loglikelihoods;
+  const float *means = components.means;
+  int M = num_components, D = num_dimensions, N = num_events;
+  release_gil nogil;
+
+  #pragma omp parallel
+  {
+    double *stats = (double*) malloc(sizeof(double)*M*(D+1)); // D first order sums, then the soft count
+    #pragma omp for schedule(dynamic)
+    for(int s = 0; s < num_sequences; s++) {
+      memset(stats, 0, sizeof(double)*M*(D+1));
+      for(npy_int64 n = bounds[s]; n < bounds[s+1]; n++) {
+        const float *event = &data[n*D];
+        for(int m = 0; m < M; m++) {
+          double posterior = exp(log_joint[m*N+n] - logprob[n]);
+          double *row = &stats[m*(D+1)];
+          for(int i = 0; i < D; i++) {
+            row[i] += posterior*event[i];
+          }
+          row[D] += posterior;
+        }
+      }
+      float *adapted = &result[(npy_int64)s*M*D];
+      for(int m = 0; m < M; m++) {
+        const double *row = &stats[m*(D+1)];
+        for(int i = 0; i < D; i++) {
+          adapted[m*D+i] = (float) ((row[i] + relevance_factor*means[m*D+i])/(row[D] + relevance_factor));
+        }
+      }
+    }
+    free(stats);
+  }
+}
+
+
+float component_distance(components_t *components, int c1, int c2, components_t *temp_component, int num_dimensions, int diag) {
   // Add the components together, this updates pi,means,R,N and stores in temp_component
 
-  add_components(components,c1,c2,temp_component,num_dimensions);
+  add_components(components,c1,c2,temp_component,num_dimensions,diag);
   //printf("%f, %f, %f, %f, %f, %f\n", components->N[c1], components->constant[c1], components->N[c2], components->constant[c2], temp_component->N[0], temp_component->constant[0]);
   return components->N[c1]*components->constant[c1] + components->N[c2]*components->constant[c2] - temp_component->N[0]*temp_component->constant[0];
   
 }
 
-void add_components(components_t *components, int c1, int c2, components_t *temp_component, int num_dimensions) {
+void add_components(components_t *components, int c1, int c2, components_t *temp_component, int num_dimensions, int diag) {
   float wt1,wt2;
  
   wt1 = (components->N[c1]) / (components->N[c1] + components->N[c2]);
@@ -515,48 +991,65 @@ void add_components(components_t *components, int c1, int c2, components_t *temp
     temp_component->means[i] = wt1*components->means[c1*num_dimensions+i] + wt2*components->means[c2*num_dimensions+i];
   }
     
-  // Compute new weighted covariance
-  for(int i=0; i<num_dimensions; i++) {
-    for(int j=i; j<num_dimensions; j++) {
-      // Compute R contribution from component1
-      temp_component->R[i*num_dimensions+j] = ((temp_component->means[i]-components->means[c1*num_dimensions+i])
-                                             *(temp_component->means[j]-components->means[c1*num_dimensions+j])
-                                             +components->R[c1*num_dimensions*num_dimensions+i*num_dimensions+j])*wt1;
-      // Add R contribution from component2
-      temp_component->R[i*num_dimensions+j] += ((temp_component->means[i]-components->means[c2*num_dimensions+i])
-                                              *(temp_component->means[j]-components->means[c2*num_dimensions+j])
-                                              +components->R[c2*num_dimensions*num_dimensions+i*num_dimensions+j])*wt2;
-      // Because its symmetric...
-      temp_component->R[j*num_dimensions+i] = temp_component->R[i*num_dimensions+j];
-    }
-  }
-    
   // Compute pi
   temp_component->pi[0] = components->pi[c1] + components->pi[c2];
     
   // compute N
   temp_component->N[0] = components->N[c1] + components->N[c2];
 
+  // avgvar same for all components
+  temp_component->avgvar[0] = components->avgvar[0];
+
   float log_determinant;
-  // Copy R to Rinv matrix
-  memcpy(temp_component->Rinv,temp_component->R,sizeof(float)*num_dimensions*num_dimensions);
-  // Invert the matrix
-  invert_cpu(temp_component->Rinv,num_dimensions,&log_determinant);
+  if(diag) {
+    // Merged variances, the diagonal of the merged covariance
+    log_determinant = 0.0f;
+    for(int i=0; i<num_dimensions; i++) {
+      float d1 = temp_component->means[i]-components->means[c1*num_dimensions+i];
+      float d2 = temp_component->means[i]-components->means[c2*num_dimensions+i];
+      temp_component->R[i] = (d1*d1+components->R[c1*num_dimensions+i])*wt1 + (d2*d2+components->R[c2*num_dimensions+i])*wt2;
+      temp_component->Rinv[i] = 1.0f / temp_component->R[i];
+      log_determinant += logf(temp_component->R[i]);
+    }
+    temp_component->constant[0] = (-num_dimensions)*0.5*logf(2*PI)-0.5*log_determinant;
+    return;
+  }
+
+  // Compute new weighted covariance, one packed upper triangle entry at a time
+  int packed_size = PACKED_SIZE(num_dimensions);
+  for(int i=0, p=0; i<num_dimensions; i++) {
+    for(int j=i; j<num_dimensions; j++, p++) {
+      // Compute R contribution from component1
+      temp_component->R[p] = ((temp_component->means[i]-components->means[c1*num_dimensions+i])
+                             *(temp_component->means[j]-components->means[c1*num_dimensions+j])
+                             +components->R[c1*packed_size+p])*wt1;
+      // Add R contribution from component2
+      temp_component->R[p] += ((temp_component->means[i]-components->means[c2*num_dimensions+i])
+                              *(temp_component->means[j]-components->means[c2*num_dimensions+j])
+                              +components->R[c2*packed_size+p])*wt2;
+    }
+  }
+
+  // Invert the full matrix
+  float* matrix = (float*) malloc(sizeof(float)*num_dimensions*num_dimensions);
+  unpack_covariance(temp_component->R,matrix,num_dimensions);
+  invert_cpu(matrix,num_dimensions,&log_determinant);
+  pack_covariance(matrix,temp_component->Rinv,num_dimensions);
+  free(matrix);
   // Compute the constant
   temp_component->constant[0] = (-num_dimensions)*0.5*logf(2*PI)-0.5*log_determinant;
-    
-  // avgvar same for all components
-  temp_component->avgvar[0] = components->avgvar[0];
 }
 
-void copy_component(components_t *dest, int c_dest, components_t *src, int c_src, int num_dimensions) {
+void copy_component(components_t *dest, int c_dest, components_t *src, int c_src, int num_dimensions, int diag) {
+  // A diagonal component's R and Rinv are its num_dimensions variances and precisions, a full one's are packed
+  int covar_size = diag ? num_dimensions : PACKED_SIZE(num_dimensions);
   dest->N[c_dest] = src->N[c_src];
   dest->pi[c_dest] = src->pi[c_src];
   dest->constant[c_dest] = src->constant[c_src];
   dest->avgvar[c_dest] = src->avgvar[c_src];
   memcpy(&(dest->means[c_dest*num_dimensions]),&(src->means[c_src*num_dimensions]),sizeof(float)*num_dimensions);
-  memcpy(&(dest->R[c_dest*num_dimensions*num_dimensions]),&(src->R[c_src*num_dimensions*num_dimensions]),sizeof(float)*num_dimensions*num_dimensions);
-  memcpy(&(dest->Rinv[c_dest*num_dimensions*num_dimensions]),&(src->Rinv[c_src*num_dimensions*num_dimensions]),sizeof(float)*num_dimensions*num_dimensions);
+  memcpy(&(dest->R[c_dest*covar_size]),&(src->R[c_src*covar_size]),sizeof(float)*covar_size);
+  memcpy(&(dest->Rinv[c_dest*covar_size]),&(src->Rinv[c_src*covar_size]),sizeof(float)*covar_size);
   // do we need to copy memberships?
 }
 //---------------- END AHC FUNCTIONS ----------------
@@ -22,22 +22,22 @@
 //=== Data structure pointers ===
 
 //GPU copies of events
-float* d_fcs_data_by_event;
-float* d_fcs_data_by_dimension;
+GMM_THREAD_LOCAL float* d_fcs_data_by_event;
+GMM_THREAD_LOCAL float* d_fcs_data_by_dimension;
 
 //GPU index list for train_on_subset
-int* d_index_list;
+GMM_THREAD_LOCAL int* d_index_list;
 
 //GPU copies of components
-components_t temp_components;
-components_t* d_components;
+GMM_THREAD_LOCAL components_t temp_components;
+GMM_THREAD_LOCAL components_t* d_components;
 
 //GPU copies of eval data
-float *d_component_memberships;
-float *d_loglikelihoods;
+GMM_THREAD_LOCAL float *d_component_memberships;
+GMM_THREAD_LOCAL float *d_loglikelihoods;
 
 //Copy functions to ensure CPU data structures are up to date
-void copy_component_data_GPU_to_CPU(int num_components, int num_dimensions);
+void copy_component_data_GPU_to_CPU(int num_components, int num_dimensions, int diag);
 void copy_evals_data_GPU_to_CPU(int num_events, int num_components);
 
 //=== Memory Alloc/Free Functions ===
@@ -114,8 +114,42 @@ void copy_events_from_index_CPU_to_GPU(int num_indices, int num_dimensions) {
   CUT_CHECK_ERROR("Copy events by index from CPU to GPU execution failed: ");
 }
 
+// ======================== Copy covariances between the host and GPU layouts ================
+// The kernels keep D*D matrices per component on the GPU, while the host only stores the D variances
+// (and precisions) of diagonal components and the packed upper triangles of full ones, so those are
+// expanded and compacted in transit
+void copy_covars_CPU_to_GPU(float* d_covars, float* covars, int num_components, int num_dimensions, int diag) {
+  float* expanded = (float*) calloc(num_dimensions*num_dimensions*num_components, sizeof(float));
+  for(int m=0; m < num_components; m++) {
+    if(diag) {
+      for(int i=0; i < num_dimensions; i++) {
+        expanded[m*num_dimensions*num_dimensions+i*num_dimensions+i] = covars[m*num_dimensions+i];
+      }
+    } else {
+      unpack_covariance(&covars[m*PACKED_SIZE(num_dimensions)], &expanded[m*num_dimensions*num_dimensions], num_dimensions);
+    }
+  }
+  CUDA_SAFE_CALL(cudaMemcpy(d_covars, expanded, sizeof(float)*num_dimensions*num_dimensions*num_components,cudaMemcpyHostToDevice));
+  free(expanded);
+}
+
+void copy_covars_GPU_to_CPU(float* covars, float* d_covars, int num_components, int num_dimensions, int diag) {
+  float* expanded = (float*) malloc(sizeof(float)*num_dimensions*num_dimensions*num_components);
+  CUDA_SAFE_CALL(cudaMemcpy(expanded, d_covars, sizeof(float)*num_dimensions*num_dimensions*num_components,cudaMemcpyDeviceToHost));
+  for(int m=0; m < num_components; m++) {
+    if(diag) {
+      for(int i=0; i < num_dimensions; i++) {
+        covars[m*num_dimensions+i] = expanded[m*num_dimensions*num_dimensions+i*num_dimensions+i];
+      }
+    } else {
+      pack_covariance(&expanded[m*num_dimensions*num_dimensions], &covars[m*PACKED_SIZE(num_dimensions)], num_dimensions);
+    }
+  }
+  free(expanded);
+}
+
 // ======================== Copy component data from CPU to GPU ================
-void copy_component_data_CPU_to_GPU(int num_components, int num_dimensions) {
+void copy_component_data_CPU_to_GPU(int num_components, int num_dimensions, int diag) {
   CUDA_SAFE_CALL(cudaMemcpy(temp_components.N, components.N, sizeof(float)*num_components,cudaMemcpyHostToDevice));
   CUDA_SAFE_CALL(cudaMemcpy(temp_components.pi, components.pi, sizeof(float)*num_components,cudaMemcpyHostToDevice));
   CUDA_SAFE_CALL(cudaMemcpy(temp_components.CP, components.CP, sizeof(float)*num_components,cudaMemcpyHostToDevice)); 
@@ -123,15 +157,15 @@ void copy_component_data_CPU_to_GPU(int num_components, int num_dimensions) {
   CUDA_SAFE_CALL(cudaMemcpy(temp_components.constant, components.constant, sizeof(float)*num_components,cudaMemcpyHostToDevice));
   CUDA_SAFE_CALL(cudaMemcpy(temp_components.avgvar, components.avgvar, sizeof(float)*num_components,cudaMemcpyHostToDevice));
   CUDA_SAFE_CALL(cudaMemcpy(temp_components.means, components.means, sizeof(float)*num_dimensions*num_components,cudaMemcpyHostToDevice));
-  CUDA_SAFE_CALL(cudaMemcpy(temp_components.R, components.R, sizeof(float)*num_dimensions*num_dimensions*num_components,cudaMemcpyHostToDevice));
-  CUDA_SAFE_CALL(cudaMemcpy(temp_components.Rinv, components.Rinv, sizeof(float)*num_dimensions*num_dimensions*num_components,cudaMemcpyHostToDevice));
+  copy_covars_CPU_to_GPU(temp_components.R, components.R, num_components, num_dimensions, diag);
+  copy_covars_CPU_to_GPU(temp_components.Rinv, components.Rinv, num_components, num_dimensions, diag);
   CUDA_SAFE_CALL(cudaMemcpy(d_components,&temp_components,sizeof(components_t),cudaMemcpyHostToDevice));
   CUT_CHECK_ERROR("Copy components from CPU to GPU execution failed: ");
 }
 
 
 // ======================== Copy component data from GPU to CPU ================
-void copy_component_data_GPU_to_CPU(int num_components, int num_dimensions) {
+void copy_component_data_GPU_to_CPU(int num_components, int num_dimensions, int diag) {
   CUDA_SAFE_CALL(cudaMemcpy(&temp_components, d_components, sizeof(components_t),cudaMemcpyDeviceToHost));
   // copy all of the arrays from the structs
   CUDA_SAFE_CALL(cudaMemcpy(components.N, temp_components.N, sizeof(float)*num_components,cudaMemcpyDeviceToHost));
@@ -140,8 +174,8 @@ void copy_component_data_GPU_to_CPU(int num_components, int num_dimensions) {
   CUDA_SAFE_CALL(cudaMemcpy(components.constant, temp_components.constant, sizeof(float)*num_components,cudaMemcpyDeviceToHost));
   CUDA_SAFE_CALL(cudaMemcpy(components.avgvar, temp_components.avgvar, sizeof(float)*num_components,cudaMemcpyDeviceToHost));
   CUDA_SAFE_CALL(cudaMemcpy(components.means, temp_components.means, sizeof(float)*num_dimensions*num_components,cudaMemcpyDeviceToHost));
-  CUDA_SAFE_CALL(cudaMemcpy(components.R, temp_components.R, sizeof(float)*num_dimensions*num_dimensions*num_components,cudaMemcpyDeviceToHost));
-  CUDA_SAFE_CALL(cudaMemcpy(components.Rinv, temp_components.Rinv, sizeof(float)*num_dimensions*num_dimensions*num_components,cudaMemcpyDeviceToHost));
+  copy_covars_GPU_to_CPU(components.R, temp_components.R, num_components, num_dimensions, diag);
+  copy_covars_GPU_to_CPU(components.Rinv, temp_components.Rinv, num_components, num_dimensions, diag);
   CUT_CHECK_ERROR("Copy components from GPU to CPU execution failed: ");
 }
 
@@ -163,11 +197,14 @@ void copy_evals_data_GPU_to_CPU(int num_events, int num_components){
 void dealloc_events_on_GPU() {
   CUDA_SAFE_CALL(cudaFree(d_fcs_data_by_event));
   CUDA_SAFE_CALL(cudaFree(d_fcs_data_by_dimension));
+  d_fcs_data_by_event = NULL;
+  d_fcs_data_by_dimension = NULL;
   CUT_CHECK_ERROR("Dealloc events on GPU failed: ");
 }
 
 void dealloc_index_list_on_GPU() {
   CUDA_SAFE_CALL(cudaFree(d_index_list));
+  d_index_list = NULL;
   CUT_CHECK_ERROR("Dealloc index list on GPU failed: ");
 }
 
@@ -182,6 +219,8 @@ void dealloc_components_on_GPU() {
   CUDA_SAFE_CALL(cudaFree(temp_components.R));
   CUDA_SAFE_CALL(cudaFree(temp_components.Rinv));
   CUDA_SAFE_CALL(cudaFree(d_components));
+  memset(&temp_components, 0, sizeof(components_t));
+  d_components = NULL;
   CUT_CHECK_ERROR("Dealloc components on GPU failed: ");
 }
 
@@ -189,13 +228,24 @@ void dealloc_components_on_GPU() {
 void dealloc_evals_on_GPU() {
   CUDA_SAFE_CALL(cudaFree(d_component_memberships));
   CUDA_SAFE_CALL(cudaFree(d_loglikelihoods));
+  d_component_memberships = NULL;
+  d_loglikelihoods = NULL;
   CUT_CHECK_ERROR("Dealloc eval data on GPU failed: ");
 }
 
+// Frees the device buffers of the calling thread; cudaFree(NULL) is a no-op, so repeating it is harmless
+void dealloc_thread_state_on_GPU() {
+  dealloc_events_on_GPU();
+  dealloc_index_list_on_GPU();
+  dealloc_components_on_GPU();
+  dealloc_evals_on_GPU();
+}
+
 // ==================== Diagnostics =================
 
-void print_components(int num_components, int num_dimensions){
-  copy_component_data_GPU_to_CPU(num_components,num_dimensions);
+void print_components(int num_components, int num_dimensions, int diag){
+  copy_component_data_GPU_to_CPU(num_components,num_dimensions,diag);
+  int covar_size = diag ? num_dimensions : PACKED_SIZE(num_dimensions);
   printf("===============\n");
   for(int m = 0; m < num_components; m++){
 	printf("%0.4f ", components.N[m]);
@@ -218,16 +268,14 @@ void print_components(int num_components, int num_dimensions){
     printf("\n");
   }
     for(int m = 0; m < num_components; m++){
-        for(int d = 0; d < num_dimensions; d++)
-            for(int d2 = 0; d2 < num_dimensions; d2++)
-                printf("%0.4f ", components.R[m*num_dimensions*num_dimensions+d*num_dimensions+d2]);
+        for(int p = 0; p < covar_size; p++)
+            printf("%0.4f ", components.R[m*covar_size+p]);
         printf("\n");
     }
 
     for(int m = 0; m < num_components; m++){
-        for(int d = 0; d < num_dimensions; d++)
-            for(int d2 = 0; d2 < num_dimensions; d2++)
-                printf("%0.4f ", components.Rinv[m*num_dimensions*num_dimensions+d*num_dimensions+d2]);
+        for(int p = 0; p < covar_size; p++)
+            printf("%0.4f ", components.Rinv[m*covar_size+p]);
         printf("\n");
     }
   printf("===============\n");
@@ -9,6 +9,7 @@ boost::python::tuple em_cuda_train${'_'+'_'.join(param_val_list)} (
                              int min_iters,
                              int max_iters) 
 {
+  release_gil nogil;
 
   // ================= Temp buffer for codevar 2b ================ 
   ${tempbuff_type_name} *temp_buffer_2b = NULL;
@@ -26,7 +27,7 @@ boost::python::tuple em_cuda_train${'_'+'_'.join(param_val_list)} (
   constants_kernel_launch${'_'+'_'.join(param_val_list)}(d_components,num_components,num_dimensions);
   cudaThreadSynchronize();
   CUT_CHECK_ERROR("Constants Kernel execution failed: ");
-  //copy_component_data_GPU_to_CPU(num_components, num_dimensions);
+  //copy_component_data_GPU_to_CPU(num_components, num_dimensions, ${1 if cvtype == 'diag' else 0});
   //print_components(&components, num_components, num_dimensions);
   //copy_evals_data_GPU_to_CPU(num_events, num_components);
   //print_evals(component_memberships, loglikelihoods, num_events, num_components);
@@ -103,7 +104,7 @@ boost::python::tuple em_cuda_train${'_'+'_'.join(param_val_list)} (
 
     iters++;
     
-    //copy_component_data_GPU_to_CPU(num_components, num_dimensions);
+    //copy_component_data_GPU_to_CPU(num_components, num_dimensions, ${1 if cvtype == 'diag' else 0});
     //print_components(&components, num_components, num_dimensions);
   }//EM Loop
 
@@ -125,7 +126,7 @@ boost::python::tuple em_cuda_train${'_'+'_'.join(param_val_list)} (
 
   //================================ EM DONE ==============================
 
-  copy_component_data_GPU_to_CPU(num_components, num_dimensions);
+  copy_component_data_GPU_to_CPU(num_components, num_dimensions, ${1 if cvtype == 'diag' else 0});
   copy_evals_data_GPU_to_CPU(num_events, num_components);
   
 %if covar_version_name.upper() in ['2B','V2B','_V2B']:
@@ -133,6 +134,7 @@ boost::python::tuple em_cuda_train${'_'+'_'.join(param_val_list)} (
   CUDA_SAFE_CALL(cudaFree(temp_buffer_2b));
 %endif
 
+   nogil.reacquire();
    return boost::python::make_tuple(likelihood, iters);
 }
 
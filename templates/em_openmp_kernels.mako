@@ -0,0 +1,532 @@
+<%
+omp_schedule = 'schedule(%s)' % schedule if chunk_size == '0' else 'schedule(%s, %s)' % (schedule, chunk_size)
+%>
+
+void seed_covars${'_'+'_'.join(param_val_list)}(float* R, float* fcs_data, float* means, int num_dimensions, int num_events, float* avgvar, int num_components) {
+
+    #pragma omp parallel for ${omp_schedule}
+    for(int i=0; i < num_dimensions*num_dimensions; i++) {
+      int row = (i) / num_dimensions;
+      int col = (i) % num_dimensions;
+      R[row*num_dimensions+col] = 0.0f;
+      if(row==col) {
+        for(int j=0; j < num_events; j++) {
+          R[row*num_dimensions+col] += (fcs_data[j*num_dimensions + row])*(fcs_data[j*num_dimensions + row]);
+        }
+        R[row*num_dimensions+col] /= (float) (num_events -1);
+        R[row*num_dimensions+col] -= ((float)(num_events)*means[row]*means[row]) / (float)(num_events-1);
+        R[row*num_dimensions+col] /= (float)num_components;
+      }
+    }
+}
+
+void average_variance${'_'+'_'.join(param_val_list)}(float* fcs_data, float* means, int num_dimensions, int num_events, float* avgvar) {
+
+    float total = 0.0f;
+    // Compute average variance for each dimension
+    #pragma omp parallel for ${omp_schedule} reduction(+:total)
+    for(int i = 0; i < num_dimensions; i++) {
+        float variance = 0.0f;
+        for(int j=0; j < num_events; j++) {
+            variance += fcs_data[j*num_dimensions + i]*fcs_data[j*num_dimensions + i];
+        }
+        variance /= (float) num_events;
+        variance -= means[i]*means[i];
+        total += variance;
+    }
+
+    *avgvar = total / (float) num_dimensions;
+}
+
+void constants${'_'+'_'.join(param_val_list)}(components_t* components, int M, int D) {
+%if cvtype == 'spherical':
+    spherical_constants(components, M, D);
+%elif cvtype == 'tied':
+    tied_constants(components, M, D);
+%elif cvtype == 'diag':
+    diag_constants(components, M, D);
+%else:
+    // Each component's covariance is inverted independently
+    #pragma omp parallel for ${omp_schedule}
+    for(int m=0; m < M; m++) {
+        float log_determinant;
+        float* matrix = (float*) malloc(sizeof(float)*D*D);
+
+        // Invert covariance matrix
+        unpack_covariance(&(components->R[m*PACKED_SIZE(D)]),matrix,D);
+        invert_cpu(matrix,D,&log_determinant);
+        pack_covariance(matrix,&(components->Rinv[m*PACKED_SIZE(D)]),D);
+
+        // Compute constant
+        components->constant[m] = -D*0.5f*logf(2*PI) - 0.5f*log_determinant;
+        components->CP[m] = components->constant[m]*2.0;
+        free(matrix);
+    }
+    normalize_pi(components, M);
+%endif
+}
+
+void seed_components${'_'+'_'.join(param_val_list)}(float *data_by_event, components_t* components, int num_dimensions, int num_components, int num_events) {
+    float* means = (float*) malloc(sizeof(float)*num_dimensions);
+    float* R0 = (float*) malloc(sizeof(float)*num_dimensions*num_dimensions);
+    float avgvar;
+
+    // Compute means
+    mvtmeans(data_by_event, num_dimensions, num_events, means);
+
+    // Compute the average variance
+    seed_covars${'_'+'_'.join(param_val_list)}(R0, data_by_event, means, num_dimensions, num_events, &avgvar, num_components);
+    average_variance${'_'+'_'.join(param_val_list)}(data_by_event, means, num_dimensions, num_events, &avgvar);
+    float seed;
+    if(num_components > 1) {
+       seed = (num_events)/(num_components);
+    } else {
+       seed = 0.0f;
+    }
+
+    memcpy(components->means, means, sizeof(float)*num_dimensions);
+
+    for(int c=1; c < num_components; c++) {
+        memcpy(&components->means[c*num_dimensions], &data_by_event[((int)(c*seed))*num_dimensions], sizeof(float)*num_dimensions);
+    }
+
+%if cvtype == 'spherical':
+    seed_spherical_covars(components, R0, num_dimensions, num_components);
+%elif cvtype == 'tied':
+    seed_tied_covars(components, R0, num_dimensions);
+%elif cvtype == 'diag':
+    seed_diag_covars(components, R0, num_dimensions, num_components);
+%else:
+    seed_full_covars(components, R0, num_dimensions, num_components);
+%endif
+
+    //compute pi, N
+    for(int c =0; c<num_components; c++) {
+        components->pi[c] = 1.0f/((float)num_components);
+        components->N[c] = ((float) num_events) / ((float)num_components);
+        components->avgvar[c] = avgvar / COVARIANCE_DYNAMIC_RANGE;
+    }
+
+    free(R0);
+    free(means);
+}
+
+void compute_average_variance${'_'+'_'.join(param_val_list)}( float* fcs_data, components_t* components, int num_dimensions, int num_components, int num_events)
+{
+    float* means = (float*) malloc(sizeof(float)*num_dimensions);
+    float avgvar;
+
+    // Compute the means
+    mvtmeans(fcs_data, num_dimensions, num_events, means);
+
+    average_variance${'_'+'_'.join(param_val_list)}(fcs_data, means, num_dimensions, num_events, &avgvar);
+
+    for(int c =0; c<num_components; c++) {
+        components->avgvar[c] = avgvar / COVARIANCE_DYNAMIC_RANGE;
+    }
+    free(means);
+}
+
+void estep1${'_'+'_'.join(param_val_list)}(float* data, components_t* components, float* component_memberships, int D, int M, int N, float* loglikelihoods) {
+%if cvtype == 'tied':
+    // Whiten the events and means once with the shared covariance, so each component only needs a diagonal distance
+    float* W = (float*) malloc(sizeof(float)*D*D);
+    float* component_means = (float*) malloc(sizeof(float)*M*D);
+    float* whitened_data = (float*) malloc(sizeof(float)*D*N);
+    tied_whitening(components, M, D, W, component_means);
+    #pragma omp parallel for ${omp_schedule}
+    for(int n=0; n < N; n++) {
+        for(int i=0; i < D; i++) {
+            float sum = 0.0f;
+            for(int j=i; j < D; j++) {
+                sum += W[i*D+j]*data[j*N+n];
+            }
+            whitened_data[i*N+n] = sum;
+        }
+    }
+    data = whitened_data;
+%else:
+    float* component_means = components->means;
+%endif
+    // Compute likelihood for every data point in each component, then log_add them, one event per iteration
+    #pragma omp parallel for ${omp_schedule}
+    for(int n=0; n < N; n++) {
+        float finalloglike = MINVALUEFORMINUSLOG;
+        for(int m=0; m < M; m++) {
+            float component_pi = components->pi[m];
+            float* means = &(component_means[m*D]);
+%if cvtype == 'diag':
+            float* Rinv = &(components->Rinv[m*D]);
+%elif cvtype == 'full':
+            float* Rinv = &(components->Rinv[m*PACKED_SIZE(D)]);
+%endif
+            float like = 0.0;
+%if cvtype == 'diag':
+            for(int i=0; i < D; i++) {
+                like += (data[i*N+n]-means[i])*(data[i*N+n]-means[i])*Rinv[i];
+            }
+%elif cvtype == 'full':
+            // Walk the packed upper triangle once, counting each off-diagonal term twice
+            for(int i=0, p=0; i < D; i++) {
+                float diff = data[i*N+n]-means[i];
+                float row = 0.0f;
+                for(int j=i+1; j < D; j++) {
+                    row += (data[j*N+n]-means[j])*Rinv[p+j-i];
+                }
+                like += diff*(diff*Rinv[p] + 2.0f*row);
+                p += D-i;
+            }
+%else:
+            // Spherical, or tied on whitened data and means
+            for(int i=0; i < D; i++) {
+                like += (data[i*N+n]-means[i])*(data[i*N+n]-means[i]);
+            }
+%endif
+%if cvtype == 'spherical':
+            like *= components->Rinv[m];
+%endif
+            component_memberships[m*N+n] = (component_pi > 0.0f) ? -0.5*like + components->constant[m] + logf(component_pi) : MINVALUEFORMINUSLOG;
+            finalloglike = log_add(finalloglike, component_memberships[m*N+n]);
+        }
+        loglikelihoods[n] = finalloglike;
+    }
+%if cvtype == 'tied':
+    free(whitened_data);
+    free(component_means);
+    free(W);
+%endif
+}
+
+float estep2_events${'_'+'_'.join(param_val_list)}(components_t* components, float* component_memberships, int M, int n, int N) {
+	// Finding maximum likelihood for this data point
+        float temp = 0.0f;
+	float max_likelihood;
+	float denominator_sum = 0.0f;
+
+        max_likelihood = component_memberships[n];
+        for(int m = 1; m < M; m++)
+            max_likelihood =
+                  fmaxf(max_likelihood,component_memberships[m*N+n]);
+
+	// Computes sum of all likelihoods for this event
+	for(int m=0; m < M; m++) {
+            temp = expf(component_memberships[m*N+n] - max_likelihood);
+            denominator_sum += temp;
+	}
+	temp = max_likelihood + logf(denominator_sum);
+
+	// Divide by denominator to get each membership
+	for(int m=0; m < M; m++) {
+	    component_memberships[m*N+n] = expf(component_memberships[m*N+n] - temp);
+	}
+
+	return temp;
+}
+
+void estep2${'_'+'_'.join(param_val_list)}(float* data, components_t* components, float* component_memberships, int D, int M, int N, float* likelihood) {
+    float total = 0.0f;
+    #pragma omp parallel for ${omp_schedule} reduction(+:total)
+    for(int n=0; n < N; n++) {
+        total += estep2_events${'_'+'_'.join(param_val_list)}(components, component_memberships, M, n, N);
+    }
+    *likelihood = total;
+}
+
+void mstep_mean${'_'+'_'.join(param_val_list)}(float* data, components_t* components, float* component_memberships, int D, int M, int N) {
+    #pragma omp parallel for collapse(2) ${omp_schedule}
+    for(int m=0; m < M; m++) {
+        for(int d=0; d < D; d++) {
+            float sum = 0.0f;
+            for(int n=0; n < N; n++) {
+                sum += data[d*N+n]*component_memberships[m*N+n];
+            }
+            components->means[m*D+d] = sum / components->N[m];
+        }
+    }
+}
+
+void mstep_n${'_'+'_'.join(param_val_list)}(float* data, components_t* components, float* component_memberships, int D, int M, int N) {
+    for(int m=0; m < M; m++) {
+        float sum = 0.0f;
+        #pragma omp parallel for ${omp_schedule} reduction(+:sum)
+        for(int n=0; n < N; n++) {
+            sum += component_memberships[m*N+n];
+        }
+        components->N[m] = sum;
+        components->pi[m] = sum;
+    }
+}
+
+void mstep_covar${'_'+'_'.join(param_val_list)}(float* data, components_t* components,float* component_memberships, int D, int M, int N) {
+%if cvtype == 'spherical':
+    #pragma omp parallel for ${omp_schedule}
+    for(int m=0; m < M; m++) {
+        float* means = &(components->means[m*D]);
+        float sum = 0.0f;
+        for(int n=0; n < N; n++) {
+            float dist = 0.0f;
+            for(int i=0; i < D; i++) {
+                dist += (data[i*N+n]-means[i])*(data[i*N+n]-means[i]);
+            }
+            sum += dist*component_memberships[m*N+n];
+        }
+        components->R[m] = (components->N[m] >= 1.0f) ? sum / (components->N[m]*D) : 0.0f;
+        components->R[m] += components->avgvar[m];
+    }
+%elif cvtype == 'tied':
+    float total = 0.0f;
+    for(int m=0; m < M; m++) {
+        total += components->N[m];
+    }
+    // One entry of the lower triangle of the shared covariance per iteration, pooled over all components
+    #pragma omp parallel for collapse(2) ${omp_schedule}
+    for(int i=0; i < D; i++) {
+        for(int j=0; j < D; j++) {
+            if(j > i) continue;
+            float sum = 0.0f;
+            for(int m=0; m < M; m++) {
+                float* means = &(components->means[m*D]);
+                for(int n=0; n < N; n++) {
+                    sum += (data[i*N+n]-means[i])*(data[j*N+n]-means[j])*component_memberships[m*N+n];
+                }
+            }
+            components->R[i*D+j] = (total >= 1.0f) ? sum / total : 0.0f;
+            components->R[j*D+i] = components->R[i*D+j];
+            if(i == j) {
+                components->R[i*D+i] += components->avgvar[0];
+            }
+        }
+    }
+%elif cvtype == 'diag':
+    // One (component, dimension) variance per iteration, stored M x D
+    #pragma omp parallel for collapse(2) ${omp_schedule}
+    for(int m=0; m < M; m++) {
+        for(int i=0; i < D; i++) {
+            float* means = &(components->means[m*D]);
+            float sum = 0.0;
+            for(int n=0; n < N; n++) {
+                sum += (data[i*N+n]-means[i])*(data[i*N+n]-means[i])*component_memberships[m*N+n];
+            }
+            components->R[m*D+i] = (components->N[m] >= 1.0f) ? sum / components->N[m] : 0.0f;
+            components->R[m*D+i] += components->avgvar[m];
+        }
+    }
+%else:
+    // One (component, row, column) entry of the lower triangle per iteration
+    #pragma omp parallel for collapse(3) ${omp_schedule}
+    for(int m=0; m < M; m++) {
+        for(int i=0; i < D; i++) {
+            for(int j=0; j < D; j++) {
+                if(j > i) continue;
+                float* means = &(components->means[m*D]);
+                float sum = 0.0;
+                for(int n=0; n < N; n++) {
+                    sum += (data[i*N+n]-means[i])*(data[j*N+n]-means[j])*component_memberships[m*N+n];
+                }
+
+                // Entry (j, i) of the packed upper triangle
+                int p = m*PACKED_SIZE(D) + PACKED_INDEX(j, i, D);
+                components->R[p] = (components->N[m] >= 1.0f) ? sum / components->N[m] : 0.0f;
+                if(i == j) {
+                    components->R[p] += components->avgvar[m];
+                }
+            }
+        }
+    }
+%endif
+}
+
+// M-step for component m from its responsibilities in csr, reading the events by event for locality. A component
+// without any keeps its parameters and gets weight 0
+void mstep_sparse_component${'_'+'_'.join(param_val_list)}(float* data_by_event, components_t* components, sparse_memberships_t* csr, int D, int m) {
+    int begin = csr->indptr[m];
+    int end = csr->indptr[m+1];
+    float total = 0.0f;
+    for(int k=begin; k < end; k++) {
+        total += csr->values[k];
+    }
+    components->N[m] = total;
+    components->pi[m] = total;
+    if(total <= 0.0f) return;
+
+    float* means = &(components->means[m*D]);
+    for(int i=0; i < D; i++) {
+        means[i] = 0.0f;
+    }
+    for(int k=begin; k < end; k++) {
+        float* event = &(data_by_event[csr->indices[k]*D]);
+        for(int i=0; i < D; i++) {
+            means[i] += event[i]*csr->values[k];
+        }
+    }
+    for(int i=0; i < D; i++) {
+        means[i] /= total;
+    }
+%if cvtype == 'spherical':
+    float sum = 0.0f;
+    for(int k=begin; k < end; k++) {
+        float* event = &(data_by_event[csr->indices[k]*D]);
+        float dist = 0.0f;
+        for(int i=0; i < D; i++) {
+            dist += (event[i]-means[i])*(event[i]-means[i]);
+        }
+        sum += dist*csr->values[k];
+    }
+    components->R[m] = (total >= 1.0f) ? sum / (total*D) : 0.0f;
+    components->R[m] += components->avgvar[m];
+%elif cvtype == 'diag':
+    float* R = &(components->R[m*D]);
+    for(int i=0; i < D; i++) {
+        R[i] = 0.0f;
+    }
+    for(int k=begin; k < end; k++) {
+        float* event = &(data_by_event[csr->indices[k]*D]);
+        for(int i=0; i < D; i++) {
+            R[i] += (event[i]-means[i])*(event[i]-means[i])*csr->values[k];
+        }
+    }
+    for(int i=0; i < D; i++) {
+        R[i] = (total >= 1.0f) ? R[i] / total : 0.0f;
+        R[i] += components->avgvar[m];
+    }
+%elif cvtype == 'full':
+    float* R = &(components->R[m*PACKED_SIZE(D)]);
+    float* diff = (float*) malloc(sizeof(float)*D);
+    memset(R, 0, sizeof(float)*PACKED_SIZE(D));
+    for(int k=begin; k < end; k++) {
+        float* event = &(data_by_event[csr->indices[k]*D]);
+        for(int i=0; i < D; i++) {
+            diff[i] = event[i]-means[i];
+        }
+        // Accumulate the packed upper triangle, row by row
+        for(int i=0, p=0; i < D; i++) {
+            float scaled = diff[i]*csr->values[k];
+            for(int j=i; j < D; j++, p++) {
+                R[p] += scaled*diff[j];
+            }
+        }
+    }
+    for(int p=0; p < PACKED_SIZE(D); p++) {
+        R[p] = (total >= 1.0f) ? R[p] / total : 0.0f;
+    }
+    for(int i=0; i < D; i++) {
+        R[PACKED_INDEX(i, i, D)] += components->avgvar[m];
+    }
+    free(diff);
+%endif
+}
+%if cvtype == 'tied':
+
+// Entry (i, j) of the shared covariance, pooled over all the components' responsibilities in csr
+void mstep_sparse_tied_entry${'_'+'_'.join(param_val_list)}(float* data_by_event, components_t* components, sparse_memberships_t* csr, int D, int M, int i, int j) {
+    float sum = 0.0f;
+    float total = 0.0f;
+    for(int m=0; m < M; m++) {
+        float* means = &(components->means[m*D]);
+        total += components->N[m];
+        for(int k=csr->indptr[m]; k < csr->indptr[m+1]; k++) {
+            float* event = &(data_by_event[csr->indices[k]*D]);
+            sum += (event[i]-means[i])*(event[j]-means[j])*csr->values[k];
+        }
+    }
+    components->R[i*D+j] = (total >= 1.0f) ? sum / total : 0.0f;
+    components->R[j*D+i] = components->R[i*D+j];
+    if(i == j) {
+        components->R[i*D+i] += components->avgvar[0];
+    }
+}
+%endif
+
+// Keeps the responsibilities above threshold in csr and returns 1, unless the ones at or below it add up to more
+// than tolerance of the events; then it returns 0 and the M-step has to use them all
+int sparsify_memberships${'_'+'_'.join(param_val_list)}(float* component_memberships, sparse_memberships_t* csr, int M, int N, float threshold, float tolerance) {
+    float dropped = 0.0f;
+    #pragma omp parallel for ${omp_schedule} reduction(+:dropped)
+    for(int m=0; m < M; m++) {
+        int count = 0;
+        for(int n=0; n < N; n++) {
+            float p = component_memberships[m*N+n];
+            if(p > threshold) {
+                count++;
+            } else {
+                dropped += p;
+            }
+        }
+        csr->indptr[m+1] = count;
+    }
+    if(dropped > tolerance*N) return 0;
+
+    reserve_sparse_memberships(csr, M);
+    #pragma omp parallel for ${omp_schedule}
+    for(int m=0; m < M; m++) {
+        int k = csr->indptr[m];
+        for(int n=0; n < N; n++) {
+            float p = component_memberships[m*N+n];
+            if(p > threshold) {
+                csr->indices[k] = n;
+                csr->values[k] = p;
+                k++;
+            }
+        }
+    }
+    return 1;
+}
+
+void mstep_sparse${'_'+'_'.join(param_val_list)}(float* data_by_event, components_t* components, sparse_memberships_t* csr, int D, int M, int N) {
+    #pragma omp parallel for ${omp_schedule}
+    for(int m=0; m < M; m++) {
+        mstep_sparse_component${'_'+'_'.join(param_val_list)}(data_by_event, components, csr, D, m);
+    }
+%if cvtype == 'tied':
+    #pragma omp parallel for collapse(2) ${omp_schedule}
+    for(int i=0; i < D; i++) {
+        for(int j=0; j < D; j++) {
+            if(j > i) continue;
+            mstep_sparse_tied_entry${'_'+'_'.join(param_val_list)}(data_by_event, components, csr, D, M, i, j);
+        }
+    }
+%endif
+}
+
+// Classification E-step on the log joint probabilities left by estep1: each event goes to its most likely
+// component, with a responsibility of 1. Sums the classification log-likelihood, and returns how many events
+// changed component since the assignments were last updated
+int estep_hard${'_'+'_'.join(param_val_list)}(float* component_memberships, int* assignments, int M, int N, float* likelihood) {
+    float total = 0.0f;
+    int changed = 0;
+    #pragma omp parallel for ${omp_schedule} reduction(+:total,changed)
+    for(int n=0; n < N; n++) {
+        int best = 0;
+        for(int m=1; m < M; m++) {
+            if(component_memberships[m*N+n] > component_memberships[best*N+n]) best = m;
+        }
+        total += component_memberships[best*N+n];
+        for(int m=0; m < M; m++) {
+            component_memberships[m*N+n] = (m == best) ? 1.0f : 0.0f;
+        }
+        changed += assignments[n] != best;
+        assignments[n] = best;
+    }
+    *likelihood = total;
+    return changed;
+}
+
+// Weighted E-step: scales each event's posteriors by its weight, so the M-step counts event n weights[n] times
+void weight_memberships${'_'+'_'.join(param_val_list)}(float* component_memberships, float* weights, int M, int N) {
+    #pragma omp parallel for ${omp_schedule}
+    for(int n=0; n < N; n++) {
+        for(int m=0; m < M; m++) {
+            component_memberships[m*N+n] *= weights[n];
+        }
+    }
+}
+
+// The weighted log-likelihood, from the log-sums left by estep1
+float weighted_likelihood${'_'+'_'.join(param_val_list)}(float* loglikelihoods, float* weights, int N) {
+    float total = 0.0f;
+    #pragma omp parallel for ${omp_schedule} reduction(+:total)
+    for(int n=0; n < N; n++) {
+        total += weights[n]*loglikelihoods[n];
+    }
+    return total;
+}
@@ -0,0 +1,119 @@
+
+boost::python::tuple em_openmp_train${'_'+'_'.join(param_val_list)} (
+                             int num_components, 
+                             int num_dimensions, 
+                             int num_events,
+                             int min_iters,
+                             int max_iters,
+                             float sparse_threshold,
+                             float sparse_tolerance,
+                             int hard,
+                             int resume,
+                             PyObject *event_weights) 
+{
+  // With event_weights, event n counts event_weights[n] times in the likelihood and the M-step
+  float* weights = (event_weights == Py_None) ? NULL : ((float*)PyArray_DATA(event_weights));
+  release_gil nogil;
+    
+    // A resume of 1 continues from parameters that were trained on the loaded events before, so the average
+    // variance is still in place; 2 also means the memberships still hold the posteriors of the current
+    // parameters (left by the final E-step of the last call), so the constants and the first E-step are skipped
+    if(resume < 2) {
+        // Computes the R matrix inverses, and the gaussian constant
+        constants${'_'+'_'.join(param_val_list)}(&components,num_components,num_dimensions);
+    }
+    if(resume < 1) {
+        // Compute average variance based on the data
+        compute_average_variance${'_'+'_'.join(param_val_list)}(fcs_data_by_event, &components, num_dimensions, num_components, num_events);
+    }
+
+    // Calculate an epsilon value
+    //int ndata_points = num_events*num_dimensions;
+    float epsilon = (1+num_dimensions+0.5*(num_dimensions+1)*num_dimensions)*log((float)num_events*num_dimensions)*0.0001;
+    int iters;
+    float likelihood = -100000;
+    float old_likelihood = likelihood * 10;
+    
+    float change = epsilon*2;
+
+    // With a sparse_threshold of 0 or more, the M-step only visits the responsibilities above it, unless
+    // that drops more than sparse_tolerance of the events (see sparsify_memberships)
+    int sparse = sparse_threshold >= 0.0f;
+    int sparse_fallbacks = 0;
+    sparse_memberships_t csr;
+    if(sparse || hard) {
+        alloc_sparse_memberships(&csr, num_components);
+    }
+    
+    iters = 0;
+    if(hard) {
+        // Classification EM: the E-step assigns each event to its most likely component, and the M-step only
+        // accumulates each event into that component. Stops once the assignments no longer change, and leaves
+        // the hard posteriors behind
+        int* assignments = (int*) malloc(sizeof(int)*num_events);
+        for(int n=0; n < num_events; n++) {
+            assignments[n] = -1;
+        }
+        while(1) {
+            estep1${'_'+'_'.join(param_val_list)}(fcs_data_by_dimension,&components,component_memberships,num_dimensions,num_components,num_events,loglikelihoods);
+            int changed = estep_hard${'_'+'_'.join(param_val_list)}(component_memberships,assignments,num_components,num_events,&likelihood);
+            if(iters >= max_iters || (changed == 0 && iters >= min_iters)) break;
+
+            // One responsibility of 1 per event, grouped by component
+            sparsify_memberships${'_'+'_'.join(param_val_list)}(component_memberships,&csr,num_components,num_events,0.5f,num_events);
+            mstep_sparse${'_'+'_'.join(param_val_list)}(fcs_data_by_event,&components,&csr,num_dimensions,num_components,num_events);
+            constants${'_'+'_'.join(param_val_list)}(&components,num_components,num_dimensions);
+            iters++;
+        }
+        free(assignments);
+        dealloc_sparse_memberships(&csr);
+
+        nogil.reacquire();
+        return boost::python::make_tuple(likelihood, iters, sparse_fallbacks);
+    }
+
+    // This is the iterative loop for the EM algorithm.
+    // It re-estimates parameters, re-computes constants, and then regroups the events
+    // These steps keep repeating until the change in likelihood is less than some epsilon        
+    while(iters < min_iters || (fabs(change) > epsilon && iters < max_iters)) {
+        old_likelihood = likelihood;
+
+        if(iters > 0 || resume < 2) {
+            estep1${'_'+'_'.join(param_val_list)}(fcs_data_by_dimension,&components,component_memberships,num_dimensions,num_components,num_events,loglikelihoods);
+            estep2${'_'+'_'.join(param_val_list)}(fcs_data_by_dimension,&components,component_memberships,num_dimensions,num_components,num_events,&likelihood);
+        }
+        if(weights) {
+            likelihood = weighted_likelihood${'_'+'_'.join(param_val_list)}(loglikelihoods,weights,num_events);
+            weight_memberships${'_'+'_'.join(param_val_list)}(component_memberships,weights,num_components,num_events);
+        }
+        
+        if(sparse && sparsify_memberships${'_'+'_'.join(param_val_list)}(component_memberships,&csr,num_components,num_events,sparse_threshold,sparse_tolerance)) {
+            mstep_sparse${'_'+'_'.join(param_val_list)}(fcs_data_by_event,&components,&csr,num_dimensions,num_components,num_events);
+        } else {
+            sparse_fallbacks += sparse;
+            // This kernel computes a new N, pi isn't updated until compute_constants though
+            mstep_n${'_'+'_'.join(param_val_list)}(fcs_data_by_dimension,&components,component_memberships,num_dimensions,num_components,num_events);
+            mstep_mean${'_'+'_'.join(param_val_list)}(fcs_data_by_dimension,&components,component_memberships,num_dimensions,num_components,num_events);
+            mstep_covar${'_'+'_'.join(param_val_list)}(fcs_data_by_dimension,&components,component_memberships,num_dimensions,num_components,num_events);
+        }
+
+        
+        // Inverts the R matrices, computes the constant, normalizes cluster probabilities
+        constants${'_'+'_'.join(param_val_list)}(&components,num_components,num_dimensions);
+        change = likelihood - old_likelihood;
+        iters++;
+    }
+
+    estep1${'_'+'_'.join(param_val_list)}(fcs_data_by_dimension,&components,component_memberships,num_dimensions,num_components,num_events,loglikelihoods);
+    estep2${'_'+'_'.join(param_val_list)}(fcs_data_by_dimension,&components,component_memberships,num_dimensions,num_components,num_events,&likelihood);
+    if(weights) {
+        likelihood = weighted_likelihood${'_'+'_'.join(param_val_list)}(loglikelihoods,weights,num_events);
+    }
+    
+    if(sparse) {
+        dealloc_sparse_memberships(&csr);
+    }
+    
+  nogil.reacquire();
+  return boost::python::make_tuple(likelihood, iters, sparse_fallbacks);
+}
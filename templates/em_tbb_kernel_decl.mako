@@ -9,3 +9,8 @@ void mstep_mean${'_'+'_'.join(param_val_list)}(float* data, components_t* compon
 void mstep_mean_idx${'_'+'_'.join(param_val_list)}(float* d_fcs_data_by_dimension, int* d_index_list, int num_indices, components_t* d_components, float* component_memberships, int num_dimensions, int num_components, int num_events);
 void mstep_covar${'_'+'_'.join(param_val_list)}(float* data, components_t* components,float* component_memberships, int D, int M, int N);
 void mstep_covar_idx${'_'+'_'.join(param_val_list)}(float* d_fcs_data_by_dimension, float* d_fcs_data_by_event,int* d_index_list, int num_indices, components_t* d_components, float* component_memberships, int num_dimensions, int num_components, int num_events);
+int sparsify_memberships${'_'+'_'.join(param_val_list)}(float* component_memberships, sparse_memberships_t* csr, int M, int N, float threshold, float tolerance);
+void mstep_sparse${'_'+'_'.join(param_val_list)}(float* data_by_event, components_t* components, sparse_memberships_t* csr, int D, int M, int N);
+int estep_hard${'_'+'_'.join(param_val_list)}(float* component_memberships, int* assignments, int M, int N, float* likelihood);
+void weight_memberships${'_'+'_'.join(param_val_list)}(float* component_memberships, float* weights, int M, int N);
+float weighted_likelihood${'_'+'_'.join(param_val_list)}(float* loglikelihoods, float* weights, int N);
@@ -1,7 +1,7 @@
 using namespace tbb;
 
 class TBB_seed_covars${'_'+'_'.join(param_val_list)} {
-    components_t* components;
+    float* R;
     float* fcs_data;
     float* means;
     int num_dimensions;
@@ -9,30 +9,30 @@ class TBB_seed_covars${'_'+'_'.join(param_val_list)} {
     float* avgvar;
     int num_components;
   public:
-    TBB_seed_covars${'_'+'_'.join(param_val_list)}(components_t* _components, float* _fcs_data, float* _means, int _num_dimensions, int _num_events, float* _avgvar, int _num_components) : components(_components), fcs_data(_fcs_data), means(_means), num_dimensions(_num_dimensions), num_events(_num_events), avgvar(_avgvar), num_components(_num_components) { }
+    TBB_seed_covars${'_'+'_'.join(param_val_list)}(float* _R, float* _fcs_data, float* _means, int _num_dimensions, int _num_events, float* _avgvar, int _num_components) : R(_R), fcs_data(_fcs_data), means(_means), num_dimensions(_num_dimensions), num_events(_num_events), avgvar(_avgvar), num_components(_num_components) { }
 
     void operator() ( const blocked_range<int>& r ) const {
         for(int i=r.begin(); i != r.end(); i++) {
           int row = (i) / num_dimensions;
           int col = (i) % num_dimensions;
-          components->R[row*num_dimensions+col] = 0.0f;
+          R[row*num_dimensions+col] = 0.0f;
           for(int j=0; j < num_events; j++) {
             if(row==col) {
-              components->R[row*num_dimensions+col] += (fcs_data[j*num_dimensions + row])*(fcs_data[j*num_dimensions + row]);
+              R[row*num_dimensions+col] += (fcs_data[j*num_dimensions + row])*(fcs_data[j*num_dimensions + row]);
             }
           }
           if(row==col) {
-            components->R[row*num_dimensions+col] /= (float) (num_events -1);
-            components->R[row*num_dimensions+col] -= ((float)(num_events)*means[row]*means[row]) / (float)(num_events-1);
-            components->R[row*num_dimensions+col] /= (float)num_components;
+            R[row*num_dimensions+col] /= (float) (num_events -1);
+            R[row*num_dimensions+col] -= ((float)(num_events)*means[row]*means[row]) / (float)(num_events-1);
+            R[row*num_dimensions+col] /= (float)num_components;
           }
         }
     }
 };
 
-void seed_covars${'_'+'_'.join(param_val_list)}(components_t* components, float* fcs_data, float* means, int num_dimensions, int num_events, float* avgvar, int num_components) {
+void seed_covars${'_'+'_'.join(param_val_list)}(float* R, float* fcs_data, float* means, int num_dimensions, int num_events, float* avgvar, int num_components) {
     parallel_for(blocked_range<int>(0, num_dimensions*num_dimensions),
-        TBB_seed_covars${'_'+'_'.join(param_val_list)}( components, fcs_data, means, num_dimensions, num_events, avgvar, num_components) );
+        TBB_seed_covars${'_'+'_'.join(param_val_list)}( R, fcs_data, means, num_dimensions, num_events, avgvar, num_components) );
 }
 
 class TBB_average_variance${'_'+'_'.join(param_val_list)} {
@@ -74,15 +74,22 @@ void average_variance${'_'+'_'.join(param_val_list)}(float* fcs_data, float* mea
 
 
 void constants${'_'+'_'.join(param_val_list)}(components_t* components, int M, int D) {
+%if cvtype == 'spherical':
+    spherical_constants(components, M, D);
+%elif cvtype == 'tied':
+    tied_constants(components, M, D);
+%elif cvtype == 'diag':
+    diag_constants(components, M, D);
+%else:
     float log_determinant;
     float* matrix = (float*) malloc(sizeof(float)*D*D);
 
     //float sum = 0.0;
     for(int m=0; m < M; m++) {
         // Invert covariance matrix
-        memcpy(matrix,&(components->R[m*D*D]),sizeof(float)*D*D);
+        unpack_covariance(&(components->R[m*PACKED_SIZE(D)]),matrix,D);
         invert_cpu(matrix,D,&log_determinant);
-        memcpy(&(components->Rinv[m*D*D]),matrix,sizeof(float)*D*D);
+        pack_covariance(matrix,&(components->Rinv[m*PACKED_SIZE(D)]),D);
     
         // Compute constant
         components->constant[m] = -D*0.5f*logf(2*PI) - 0.5f*log_determinant;
@@ -90,17 +97,19 @@ void constants${'_'+'_'.join(param_val_list)}(components_t* components, int M, i
     }
     normalize_pi(components, M);
     free(matrix);
+%endif
 }
 
 void seed_components${'_'+'_'.join(param_val_list)}(float *data_by_event, components_t* components, int num_dimensions, int num_components, int num_events) {
     float* means = (float*) malloc(sizeof(float)*num_dimensions);
+    float* R0 = (float*) malloc(sizeof(float)*num_dimensions*num_dimensions);
     float avgvar;
 
     // Compute means
     mvtmeans(data_by_event, num_dimensions, num_events, means);
 
     // Compute the average variance
-    seed_covars${'_'+'_'.join(param_val_list)}(components, data_by_event, means, num_dimensions, num_events, &avgvar, num_components);
+    seed_covars${'_'+'_'.join(param_val_list)}(R0, data_by_event, means, num_dimensions, num_events, &avgvar, num_components);
     average_variance${'_'+'_'.join(param_val_list)}(data_by_event, means, num_dimensions, num_events, &avgvar);    
     float seed;
     if(num_components > 1) {
@@ -113,13 +122,18 @@ void seed_components${'_'+'_'.join(param_val_list)}(float *data_by_event, compon
 
     for(int c=1; c < num_components; c++) {
         memcpy(&components->means[c*num_dimensions], &data_by_event[((int)(c*seed))*num_dimensions], sizeof(float)*num_dimensions);
-          
-        for(int i=0; i < num_dimensions*num_dimensions; i++) {
-          components->R[c*num_dimensions*num_dimensions+i] = components->R[i];
-          components->Rinv[c*num_dimensions*num_dimensions+i] = 0.0f;
-        }
     }
 
+%if cvtype == 'spherical':
+    seed_spherical_covars(components, R0, num_dimensions, num_components);
+%elif cvtype == 'tied':
+    seed_tied_covars(components, R0, num_dimensions);
+%elif cvtype == 'diag':
+    seed_diag_covars(components, R0, num_dimensions, num_components);
+%else:
+    seed_full_covars(components, R0, num_dimensions, num_components);
+%endif
+
     //compute pi, N
     for(int c =0; c<num_components; c++) {
         components->pi[c] = 1.0f/((float)num_components);
@@ -127,6 +141,7 @@ void seed_components${'_'+'_'.join(param_val_list)}(float *data_by_event, compon
         components->avgvar[c] = avgvar / COVARIANCE_DYNAMIC_RANGE;
     }
 
+    free(R0);
     free(means);
 }
 
@@ -147,6 +162,7 @@ void compute_average_variance${'_'+'_'.join(param_val_list)}( float* fcs_data, c
 
 class TBB_estep1${'_'+'_'.join(param_val_list)} {
     float* data;
+    float* component_means;
     components_t* components;
     float* component_memberships;
     int D; 
@@ -154,28 +170,45 @@ class TBB_estep1${'_'+'_'.join(param_val_list)} {
     int N;
     float* loglikelihoods;
   public:
-    TBB_estep1${'_'+'_'.join(param_val_list)}(float* _data, components_t* _components, float* _component_memberships, int _D, int _M, int _N, float* _loglikelihoods): 
-        data(_data), components(_components), component_memberships(_component_memberships), D(_D), M(_M), N(_N), loglikelihoods(_loglikelihoods) { }
+    TBB_estep1${'_'+'_'.join(param_val_list)}(float* _data, float* _component_means, components_t* _components, float* _component_memberships, int _D, int _M, int _N, float* _loglikelihoods): 
+        data(_data), component_means(_component_means), components(_components), component_memberships(_component_memberships), D(_D), M(_M), N(_N), loglikelihoods(_loglikelihoods) { }
 
     void operator() ( const blocked_range<int>& r ) const {
         for(int m = r.begin(); m != r.end(); ++m) {
             // Compute likelihood for every data point in each component
             float component_pi = components->pi[m];
             float component_constant = components->constant[m];
-            float* means = &(components->means[m*D]);
-            float* Rinv = &(components->Rinv[m*D*D]);
+            float* means = &(component_means[m*D]);
+%if cvtype == 'diag':
+            float* Rinv = &(components->Rinv[m*D]);
+%elif cvtype == 'full':
+            float* Rinv = &(components->Rinv[m*PACKED_SIZE(D)]);
+%endif
             for(int n=0; n < N; n++) {
                 float like = 0.0;
 %if cvtype == 'diag':
                 for(int i=0; i < D; i++) {
-                    like += (data[i*N+n]-means[i])*(data[i*N+n]-means[i])*Rinv[i*D+i];
+                    like += (data[i*N+n]-means[i])*(data[i*N+n]-means[i])*Rinv[i];
+                }
+%elif cvtype == 'full':
+                // Walk the packed upper triangle once, counting each off-diagonal term twice
+                for(int i=0, p=0; i < D; i++) {
+                    float diff = data[i*N+n]-means[i];
+                    float row = 0.0f;
+                    for(int j=i+1; j < D; j++) {
+                        row += (data[j*N+n]-means[j])*Rinv[p+j-i];
+                    }
+                    like += diff*(diff*Rinv[p] + 2.0f*row);
+                    p += D-i;
                 }
 %else:
+                // Spherical, or tied on whitened data and means
                 for(int i=0; i < D; i++) {
-                    for(int j=0; j < D; j++) {
-                        like += (data[i*N+n]-means[i])*(data[j*N+n]-means[j])*Rinv[i*D+j];
-                    }
+                    like += (data[i*N+n]-means[i])*(data[i*N+n]-means[i]);
                 }
+%endif
+%if cvtype == 'spherical':
+                like *= components->Rinv[m];
 %endif
                 component_memberships[m*N+n] = (component_pi > 0.0f) ? -0.5*like + component_constant + logf(component_pi) : MINVALUEFORMINUSLOG;
             }
@@ -184,9 +217,48 @@ class TBB_estep1${'_'+'_'.join(param_val_list)} {
 };
     
 
+%if cvtype == 'tied':
+class TBB_whiten${'_'+'_'.join(param_val_list)} {
+    float* data;
+    float* W;
+    float* whitened_data;
+    int D;
+    int N;
+  public:
+    TBB_whiten${'_'+'_'.join(param_val_list)}(float* _data, float* _W, float* _whitened_data, int _D, int _N): data(_data), W(_W), whitened_data(_whitened_data), D(_D), N(_N) { }
+
+    void operator() ( const blocked_range<int>& r ) const {
+        for(int n = r.begin(); n != r.end(); ++n) {
+            for(int i=0; i < D; i++) {
+                float sum = 0.0f;
+                for(int j=i; j < D; j++) {
+                    sum += W[i*D+j]*data[j*N+n];
+                }
+                whitened_data[i*N+n] = sum;
+            }
+        }
+    }
+};
+%endif
+
 void estep1${'_'+'_'.join(param_val_list)}(float* data, components_t* components, float* component_memberships, int D, int M, int N, float* loglikelihoods) {
+%if cvtype == 'tied':
+    // Whiten the events and means once with the shared covariance, so each component only needs a diagonal distance
+    float* W = (float*) malloc(sizeof(float)*D*D);
+    float* whitened_means = (float*) malloc(sizeof(float)*M*D);
+    float* whitened_data = (float*) malloc(sizeof(float)*D*N);
+    tied_whitening(components, M, D, W, whitened_means);
+    parallel_for(blocked_range<int>(0, N),
+        TBB_whiten${'_'+'_'.join(param_val_list)}(data, W, whitened_data, D, N));
+    parallel_for(blocked_range<int>(0, M),
+        TBB_estep1${'_'+'_'.join(param_val_list)}(whitened_data, whitened_means, components, component_memberships, D, M, N, loglikelihoods));
+    free(whitened_data);
+    free(whitened_means);
+    free(W);
+%else:
     parallel_for(blocked_range<int>(0, M),
-        TBB_estep1${'_'+'_'.join(param_val_list)}(data, components, component_memberships, D, M, N, loglikelihoods));
+        TBB_estep1${'_'+'_'.join(param_val_list)}(data, components->means, components, component_memberships, D, M, N, loglikelihoods));
+%endif
     //estep1 log_add()
     for(int n=0; n < N; n++) {
         float finalloglike = MINVALUEFORMINUSLOG;
@@ -371,6 +443,46 @@ void mstep_n_idx${'_'+'_'.join(param_val_list)}(float* data_by_dimension, int* i
         TBB_mstep_n_idx${'_'+'_'.join(param_val_list)}( data_by_dimension, indices, num_indices, components, component_memberships, D, M, N));
 }
 
+%if cvtype == 'tied':
+class TBB_mstep_covar${'_'+'_'.join(param_val_list)} {
+    float* data;
+    components_t* components;
+    float* component_memberships;
+    int D; 
+    int M;
+    int N;
+  public:
+    TBB_mstep_covar${'_'+'_'.join(param_val_list)}(float* _data, components_t* _components, float* _component_memberships, int _D, int _M, int _N): data(_data), components(_components), component_memberships(_component_memberships), D(_D), M(_M), N(_N) { }
+
+    void operator() ( const blocked_range<int>& r ) const {
+        // One entry of the lower triangle of the shared covariance per index, pooled over all components
+        for(int idx=r.begin(); idx != r.end(); idx++) {
+            int i = idx / D;
+            int j = idx % D;
+            if(j > i) continue;
+            float sum = 0.0f;
+            float total = 0.0f;
+            for(int m=0; m < M; m++) {
+                float* means = &(components->means[m*D]);
+                total += components->N[m];
+                for(int n=0; n < N; n++) {
+                    sum += (data[i*N+n]-means[i])*(data[j*N+n]-means[j])*component_memberships[m*N+n];
+                }
+            }
+            components->R[i*D+j] = (total >= 1.0f) ? sum / total : 0.0f;
+            components->R[j*D+i] = components->R[i*D+j];
+            if(i == j) {
+                components->R[i*D+i] += components->avgvar[0];
+            }
+        }
+    }
+};
+
+void mstep_covar${'_'+'_'.join(param_val_list)}(float* data, components_t* components, float* component_memberships, int D, int M, int N) {
+    parallel_for(blocked_range<int>(0, D*D),
+        TBB_mstep_covar${'_'+'_'.join(param_val_list)}( data, components, component_memberships, D, M, N));
+}
+%else:
 class TBB_mstep_covar${'_'+'_'.join(param_val_list)} {
     float* data;
     components_t* components;
@@ -384,32 +496,44 @@ class TBB_mstep_covar${'_'+'_'.join(param_val_list)} {
     void operator() ( const blocked_range<int>& r ) const {
         for(int m=r.begin(); m != r.end(); m++) {
             float* means = &(components->means[m*D]);
+    %if cvtype == 'spherical':
+            float sum = 0.0f;
+            for(int n=0; n < N; n++) {
+                float dist = 0.0f;
+                for(int i=0; i < D; i++) {
+                    dist += (data[i*N+n]-means[i])*(data[i*N+n]-means[i]);
+                }
+                sum += dist*component_memberships[m*N+n];
+            }
+            components->R[m] = (components->N[m] >= 1.0f) ? sum / (components->N[m]*D) : 0.0f;
+            components->R[m] += components->avgvar[m];
+    %elif cvtype == 'diag':
+            // Only the variances are stored, M x D
+            for(int i=0; i < D; i++) {
+                float sum = 0.0;
+                for(int n=0; n < N; n++) {
+                    sum += (data[i*N+n]-means[i])*(data[i*N+n]-means[i])*component_memberships[m*N+n];
+                }
+                components->R[m*D+i] = (components->N[m] >= 1.0f) ? sum / components->N[m] : 0.0f;
+                components->R[m*D+i] += components->avgvar[m];
+            }
+    %else:
             for(int i=0; i < D; i++) {
                 for(int j=0; j <= i; j++) {
-    %if cvtype == 'diag':
-                    if(i != j) {
-                        components->R[m*D*D+i*D+j] = 0.0f;
-                        components->R[m*D*D+j*D+i] = 0.0f;
-                        continue;
-                    }
-    %endif
                     float sum = 0.0;
                     for(int n=0; n < N; n++) {
                         sum += (data[i*N+n]-means[i])*(data[j*N+n]-means[j])*component_memberships[m*N+n];
                     }
 
-                    if(components->N[m] >= 1.0f) {
-                        components->R[m*D*D+i*D+j] = sum / components->N[m];
-                        components->R[m*D*D+j*D+i] = sum / components->N[m];
-                    } else {
-                        components->R[m*D*D+i*D+j] = 0.0f;
-                        components->R[m*D*D+j*D+i] = 0.0f;
-                    }
+                    // Entry (j, i) of the packed upper triangle
+                    int p = m*PACKED_SIZE(D) + PACKED_INDEX(j, i, D);
+                    components->R[p] = (components->N[m] >= 1.0f) ? sum / components->N[m] : 0.0f;
                     if(i == j) {
-                        components->R[m*D*D+j*D+i] += components->avgvar[m];
+                        components->R[p] += components->avgvar[m];
                     }
                 }
             }
+    %endif
         }
     }
 };
@@ -418,6 +542,7 @@ void mstep_covar${'_'+'_'.join(param_val_list)}(float* data, components_t* compo
     parallel_for(blocked_range<int>(0, M),
         TBB_mstep_covar${'_'+'_'.join(param_val_list)}( data, components, component_memberships, D, M, N));
 }
+%endif
 
 class TBB_mstep_covar_idx${'_'+'_'.join(param_val_list)} {
     float* data_by_dimension;
@@ -434,33 +559,34 @@ class TBB_mstep_covar_idx${'_'+'_'.join(param_val_list)} {
     void operator() ( const blocked_range<int>& r ) const {
         for(int m=r.begin(); m != r.end(); m++) {
             float* means = &(components->means[m*D]);
+    %if cvtype == 'diag':
+            for(int i=0; i < D; i++) {
+                float sum = 0.0;
+                for(int index=0; index < num_indices; index++) {
+                    int n = indices[index];
+                    sum += (data_by_dimension[i*N+n]-means[i])*(data_by_dimension[i*N+n]-means[i])*component_memberships[m*N+n];
+                }
+                components->R[m*D+i] = (components->N[m] >= 1.0f) ? sum / components->N[m] : 0.0f;
+                components->R[m*D+i] += components->avgvar[m];
+            }
+    %else:
             for(int i=0; i < D; i++) {
                 for(int j=0; j <= i; j++) {
-    %if cvtype == 'diag':
-                    if(i != j) {
-                        components->R[m*D*D+i*D+j] = 0.0f;
-                        components->R[m*D*D+j*D+i] = 0.0f;
-                        continue;
-                    }
-    %endif
                     float sum = 0.0;
                     for(int index=0; index < num_indices; index++) {
                         int n = indices[index];
                         sum += (data_by_dimension[i*N+n]-means[i])*(data_by_dimension[j*N+n]-means[j])*component_memberships[m*N+n];
                     }
 
-                    if(components->N[m] >= 1.0f) {
-                        components->R[m*D*D+i*D+j] = sum / components->N[m];
-                        components->R[m*D*D+j*D+i] = sum / components->N[m];
-                    } else {
-                        components->R[m*D*D+i*D+j] = 0.0f;
-                        components->R[m*D*D+j*D+i] = 0.0f;
-                    }
+                    // Entry (j, i) of the packed upper triangle
+                    int p = m*PACKED_SIZE(D) + PACKED_INDEX(j, i, D);
+                    components->R[p] = (components->N[m] >= 1.0f) ? sum / components->N[m] : 0.0f;
                     if(i == j) {
-                        components->R[m*D*D+j*D+i] += components->avgvar[m];
+                        components->R[p] += components->avgvar[m];
                     }
                 }
             }
+    %endif
         }
     }
 };
@@ -470,3 +596,308 @@ void mstep_covar_idx${'_'+'_'.join(param_val_list)}(float* data_by_dimension, fl
         TBB_mstep_covar_idx${'_'+'_'.join(param_val_list)}( data_by_dimension, indices, num_indices, components, component_memberships, D, M, N));
 }
 
+
+// M-step for component m from its responsibilities in csr, reading the events by event for locality. A component
+// without any keeps its parameters and gets weight 0
+void mstep_sparse_component${'_'+'_'.join(param_val_list)}(float* data_by_event, components_t* components, sparse_memberships_t* csr, int D, int m) {
+    int begin = csr->indptr[m];
+    int end = csr->indptr[m+1];
+    float total = 0.0f;
+    for(int k=begin; k < end; k++) {
+        total += csr->values[k];
+    }
+    components->N[m] = total;
+    components->pi[m] = total;
+    if(total <= 0.0f) return;
+
+    float* means = &(components->means[m*D]);
+    for(int i=0; i < D; i++) {
+        means[i] = 0.0f;
+    }
+    for(int k=begin; k < end; k++) {
+        float* event = &(data_by_event[csr->indices[k]*D]);
+        for(int i=0; i < D; i++) {
+            means[i] += event[i]*csr->values[k];
+        }
+    }
+    for(int i=0; i < D; i++) {
+        means[i] /= total;
+    }
+%if cvtype == 'spherical':
+    float sum = 0.0f;
+    for(int k=begin; k < end; k++) {
+        float* event = &(data_by_event[csr->indices[k]*D]);
+        float dist = 0.0f;
+        for(int i=0; i < D; i++) {
+            dist += (event[i]-means[i])*(event[i]-means[i]);
+        }
+        sum += dist*csr->values[k];
+    }
+    components->R[m] = (total >= 1.0f) ? sum / (total*D) : 0.0f;
+    components->R[m] += components->avgvar[m];
+%elif cvtype == 'diag':
+    float* R = &(components->R[m*D]);
+    for(int i=0; i < D; i++) {
+        R[i] = 0.0f;
+    }
+    for(int k=begin; k < end; k++) {
+        float* event = &(data_by_event[csr->indices[k]*D]);
+        for(int i=0; i < D; i++) {
+            R[i] += (event[i]-means[i])*(event[i]-means[i])*csr->values[k];
+        }
+    }
+    for(int i=0; i < D; i++) {
+        R[i] = (total >= 1.0f) ? R[i] / total : 0.0f;
+        R[i] += components->avgvar[m];
+    }
+%elif cvtype == 'full':
+    float* R = &(components->R[m*PACKED_SIZE(D)]);
+    float* diff = (float*) malloc(sizeof(float)*D);
+    memset(R, 0, sizeof(float)*PACKED_SIZE(D));
+    for(int k=begin; k < end; k++) {
+        float* event = &(data_by_event[csr->indices[k]*D]);
+        for(int i=0; i < D; i++) {
+            diff[i] = event[i]-means[i];
+        }
+        // Accumulate the packed upper triangle, row by row
+        for(int i=0, p=0; i < D; i++) {
+            float scaled = diff[i]*csr->values[k];
+            for(int j=i; j < D; j++, p++) {
+                R[p] += scaled*diff[j];
+            }
+        }
+    }
+    for(int p=0; p < PACKED_SIZE(D); p++) {
+        R[p] = (total >= 1.0f) ? R[p] / total : 0.0f;
+    }
+    for(int i=0; i < D; i++) {
+        R[PACKED_INDEX(i, i, D)] += components->avgvar[m];
+    }
+    free(diff);
+%endif
+}
+%if cvtype == 'tied':
+
+// Entry (i, j) of the shared covariance, pooled over all the components' responsibilities in csr
+void mstep_sparse_tied_entry${'_'+'_'.join(param_val_list)}(float* data_by_event, components_t* components, sparse_memberships_t* csr, int D, int M, int i, int j) {
+    float sum = 0.0f;
+    float total = 0.0f;
+    for(int m=0; m < M; m++) {
+        float* means = &(components->means[m*D]);
+        total += components->N[m];
+        for(int k=csr->indptr[m]; k < csr->indptr[m+1]; k++) {
+            float* event = &(data_by_event[csr->indices[k]*D]);
+            sum += (event[i]-means[i])*(event[j]-means[j])*csr->values[k];
+        }
+    }
+    components->R[i*D+j] = (total >= 1.0f) ? sum / total : 0.0f;
+    components->R[j*D+i] = components->R[i*D+j];
+    if(i == j) {
+        components->R[i*D+i] += components->avgvar[0];
+    }
+}
+%endif
+
+class TBB_sparse_counts${'_'+'_'.join(param_val_list)} {
+    float* component_memberships;
+    sparse_memberships_t* csr;
+    float* dropped;
+    int N;
+    float threshold;
+  public:
+    TBB_sparse_counts${'_'+'_'.join(param_val_list)}(float* _component_memberships, sparse_memberships_t* _csr, float* _dropped, int _N, float _threshold): component_memberships(_component_memberships), csr(_csr), dropped(_dropped), N(_N), threshold(_threshold) { }
+
+    void operator() ( const blocked_range<int>& r ) const {
+        for(int m=r.begin(); m != r.end(); m++) {
+            int count = 0;
+            float mass = 0.0f;
+            for(int n=0; n < N; n++) {
+                float p = component_memberships[m*N+n];
+                if(p > threshold) {
+                    count++;
+                } else {
+                    mass += p;
+                }
+            }
+            csr->indptr[m+1] = count;
+            dropped[m] = mass;
+        }
+    }
+};
+
+class TBB_sparse_fill${'_'+'_'.join(param_val_list)} {
+    float* component_memberships;
+    sparse_memberships_t* csr;
+    int N;
+    float threshold;
+  public:
+    TBB_sparse_fill${'_'+'_'.join(param_val_list)}(float* _component_memberships, sparse_memberships_t* _csr, int _N, float _threshold): component_memberships(_component_memberships), csr(_csr), N(_N), threshold(_threshold) { }
+
+    void operator() ( const blocked_range<int>& r ) const {
+        for(int m=r.begin(); m != r.end(); m++) {
+            int k = csr->indptr[m];
+            for(int n=0; n < N; n++) {
+                float p = component_memberships[m*N+n];
+                if(p > threshold) {
+                    csr->indices[k] = n;
+                    csr->values[k] = p;
+                    k++;
+                }
+            }
+        }
+    }
+};
+
+// Keeps the responsibilities above threshold in csr and returns 1, unless the ones at or below it add up to more
+// than tolerance of the events; then it returns 0 and the M-step has to use them all
+int sparsify_memberships${'_'+'_'.join(param_val_list)}(float* component_memberships, sparse_memberships_t* csr, int M, int N, float threshold, float tolerance) {
+    float* dropped = (float*) malloc(sizeof(float)*M);
+    parallel_for(blocked_range<int>(0, M),
+        TBB_sparse_counts${'_'+'_'.join(param_val_list)}(component_memberships, csr, dropped, N, threshold));
+    float total = 0.0f;
+    for(int m=0; m < M; m++) {
+        total += dropped[m];
+    }
+    free(dropped);
+    if(total > tolerance*N) return 0;
+
+    reserve_sparse_memberships(csr, M);
+    parallel_for(blocked_range<int>(0, M),
+        TBB_sparse_fill${'_'+'_'.join(param_val_list)}(component_memberships, csr, N, threshold));
+    return 1;
+}
+
+class TBB_mstep_sparse${'_'+'_'.join(param_val_list)} {
+    float* data_by_event;
+    components_t* components;
+    sparse_memberships_t* csr;
+    int D;
+    int M;
+  public:
+    TBB_mstep_sparse${'_'+'_'.join(param_val_list)}(float* _data_by_event, components_t* _components, sparse_memberships_t* _csr, int _D, int _M): data_by_event(_data_by_event), components(_components), csr(_csr), D(_D), M(_M) { }
+
+    void operator() ( const blocked_range<int>& r ) const {
+        for(int m=r.begin(); m != r.end(); m++) {
+            mstep_sparse_component${'_'+'_'.join(param_val_list)}(data_by_event, components, csr, D, m);
+        }
+    }
+};
+%if cvtype == 'tied':
+
+class TBB_mstep_sparse_tied${'_'+'_'.join(param_val_list)} {
+    float* data_by_event;
+    components_t* components;
+    sparse_memberships_t* csr;
+    int D;
+    int M;
+  public:
+    TBB_mstep_sparse_tied${'_'+'_'.join(param_val_list)}(float* _data_by_event, components_t* _components, sparse_memberships_t* _csr, int _D, int _M): data_by_event(_data_by_event), components(_components), csr(_csr), D(_D), M(_M) { }
+
+    void operator() ( const blocked_range<int>& r ) const {
+        for(int idx=r.begin(); idx != r.end(); idx++) {
+            int i = idx / D;
+            int j = idx % D;
+            if(j > i) continue;
+            mstep_sparse_tied_entry${'_'+'_'.join(param_val_list)}(data_by_event, components, csr, D, M, i, j);
+        }
+    }
+};
+%endif
+
+void mstep_sparse${'_'+'_'.join(param_val_list)}(float* data_by_event, components_t* components, sparse_memberships_t* csr, int D, int M, int N) {
+    parallel_for(blocked_range<int>(0, M),
+        TBB_mstep_sparse${'_'+'_'.join(param_val_list)}(data_by_event, components, csr, D, M));
+%if cvtype == 'tied':
+    parallel_for(blocked_range<int>(0, D*D),
+        TBB_mstep_sparse_tied${'_'+'_'.join(param_val_list)}(data_by_event, components, csr, D, M));
+%endif
+}
+
+class TBB_estep_hard${'_'+'_'.join(param_val_list)} {
+    float* component_memberships;
+    int* assignments;
+    int M;
+    int N;
+  public:
+    float total;
+    int changed;
+
+    TBB_estep_hard${'_'+'_'.join(param_val_list)} (TBB_estep_hard${'_'+'_'.join(param_val_list)}& x, split) : component_memberships(x.component_memberships), assignments(x.assignments), M(x.M), N(x.N), total(0.0f), changed(0) { }
+
+    TBB_estep_hard${'_'+'_'.join(param_val_list)} (float* _component_memberships, int* _assignments, int _M, int _N) : component_memberships(_component_memberships), assignments(_assignments), M(_M), N(_N), total(0.0f), changed(0) { }
+
+    void join( const TBB_estep_hard${'_'+'_'.join(param_val_list)}& y) {total += y.total; changed += y.changed;}
+
+    void operator()( const blocked_range<int>& r ) {
+        for(int n = r.begin(); n != r.end(); ++n) {
+            int best = 0;
+            for(int m=1; m < M; m++) {
+                if(component_memberships[m*N+n] > component_memberships[best*N+n]) best = m;
+            }
+            total += component_memberships[best*N+n];
+            for(int m=0; m < M; m++) {
+                component_memberships[m*N+n] = (m == best) ? 1.0f : 0.0f;
+            }
+            changed += assignments[n] != best;
+            assignments[n] = best;
+        }
+    }
+};
+
+// Classification E-step on the log joint probabilities left by estep1: each event goes to its most likely
+// component, with a responsibility of 1. Sums the classification log-likelihood, and returns how many events
+// changed component since the assignments were last updated
+int estep_hard${'_'+'_'.join(param_val_list)}(float* component_memberships, int* assignments, int M, int N, float* likelihood) {
+    TBB_estep_hard${'_'+'_'.join(param_val_list)} hard(component_memberships, assignments, M, N);
+    parallel_reduce( blocked_range<int>(0, N), hard);
+    *likelihood = hard.total;
+    return hard.changed;
+}
+
+class TBB_weight_memberships${'_'+'_'.join(param_val_list)} {
+    float* component_memberships;
+    float* weights;
+    int M;
+    int N;
+  public:
+    TBB_weight_memberships${'_'+'_'.join(param_val_list)}(float* _component_memberships, float* _weights, int _M, int _N): component_memberships(_component_memberships), weights(_weights), M(_M), N(_N) { }
+
+    void operator() ( const blocked_range<int>& r ) const {
+        for(int n=r.begin(); n != r.end(); n++) {
+            for(int m=0; m < M; m++) {
+                component_memberships[m*N+n] *= weights[n];
+            }
+        }
+    }
+};
+
+// Weighted E-step: scales each event's posteriors by its weight, so the M-step counts event n weights[n] times
+void weight_memberships${'_'+'_'.join(param_val_list)}(float* component_memberships, float* weights, int M, int N) {
+    parallel_for(blocked_range<int>(0, N), TBB_weight_memberships${'_'+'_'.join(param_val_list)}(component_memberships, weights, M, N));
+}
+
+class TBB_weighted_likelihood${'_'+'_'.join(param_val_list)} {
+    float* loglikelihoods;
+    float* weights;
+  public:
+    float total;
+
+    TBB_weighted_likelihood${'_'+'_'.join(param_val_list)} (TBB_weighted_likelihood${'_'+'_'.join(param_val_list)}& x, split) : loglikelihoods(x.loglikelihoods), weights(x.weights), total(0.0f) { }
+
+    TBB_weighted_likelihood${'_'+'_'.join(param_val_list)} (float* _loglikelihoods, float* _weights) : loglikelihoods(_loglikelihoods), weights(_weights), total(0.0f) { }
+
+    void join( const TBB_weighted_likelihood${'_'+'_'.join(param_val_list)}& y) {total += y.total;}
+
+    void operator()( const blocked_range<int>& r ) {
+        for(int n = r.begin(); n != r.end(); ++n) {
+            total += weights[n]*loglikelihoods[n];
+        }
+    }
+};
+
+// The weighted log-likelihood, from the log-sums left by estep1
+float weighted_likelihood${'_'+'_'.join(param_val_list)}(float* loglikelihoods, float* weights, int N) {
+    TBB_weighted_likelihood${'_'+'_'.join(param_val_list)} weighted(loglikelihoods, weights);
+    parallel_reduce( blocked_range<int>(0, N), weighted);
+    return weighted.total;
+}
@@ -0,0 +1,128 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+def time_import(repeats=5):
+    # Each import runs in a fresh interpreter, so nothing is already loaded
+    code = "import time; start = time.time(); import gmm_specializer.gmm; print(time.time() - start)"
+    times = []
+    for r in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', code])
+        times.append(float(output.decode().strip().split()[-1]))
+    return min(times), np.median(times)
+
+def time_platform_probe():
+    from gmm_specializer.gmm import GMMPlatformProbe
+    path = os.path.join(tempfile.mkdtemp(), 'platform.json')
+    times = []
+    for r in range(2):
+        start = time.time()
+        probe = GMMPlatformProbe(path)
+        probe.get_compilers()
+        probe.get_cpu_info()
+        times.append(time.time() - start)
+    return times[0], times[1]
+
+def time_train_eval(backend, N, M, D, cvtype, em_iters=10):
+    from gmm_specializer.gmm import GMM
+    X = np.random.randn(N, D).astype(np.float32)
+    gmm = GMM(M, D, cvtype=cvtype, backend=backend)
+    gmm.train(X, max_em_iters=1) # the first call on a compiled backend builds it
+    start = time.time()
+    gmm.train(X, min_em_iters=em_iters, max_em_iters=em_iters)
+    train_time = time.time() - start
+    start = time.time()
+    gmm.score(X)
+    eval_time = time.time() - start
+    return train_time, eval_time
+
+def compare_accelerated_em(backend, N, M, D, cvtype, max_em_iters=200):
+    from gmm_specializer.gmm import GMM
+    # Overlapping clusters, where plain EM converges slowly
+    X = np.concatenate([np.random.randn(N//M, D) + 0.5*m for m in range(M)]).astype(np.float32)
+    GMM(M, D, cvtype=cvtype, backend=backend).train(X, max_em_iters=1) # build the backend
+    results = []
+    for accelerate in [False, True]:
+        gmm = GMM(M, D, cvtype=cvtype, backend=backend)
+        start = time.time()
+        likelihood = gmm.train(X, max_em_iters=max_em_iters, accelerate=accelerate)
+        results.append((gmm.eval_data.iters, time.time() - start, likelihood))
+    return results
+
+def compare_sparse_mstep(backend, N, M, D, cvtype, em_iters=10, sparse_threshold=1e-4):
+    from gmm_specializer.gmm import GMM
+    # Well separated clusters, where most responsibilities are close to 0
+    X = np.concatenate([np.random.randn(N//M, D) + 10.0*m for m in range(M)]).astype(np.float32)
+    GMM(M, D, cvtype=cvtype, backend=backend).train(X, max_em_iters=1) # build the backend
+    results = []
+    for threshold in [None, sparse_threshold]:
+        gmm = GMM(M, D, cvtype=cvtype, backend=backend)
+        start = time.time()
+        likelihood = gmm.train(X, min_em_iters=em_iters, max_em_iters=em_iters, sparse_threshold=threshold)
+        results.append((time.time() - start, likelihood))
+    return results[0], results[1], gmm.eval_data.sparse_fallbacks
+
+def compare_hard_em(backend, N, M, D, cvtype, em_iters=10):
+    from gmm_specializer.gmm import GMM
+    X = np.concatenate([np.random.randn(N//M, D) + 2.0*m for m in range(M)]).astype(np.float32)
+    GMM(M, D, cvtype=cvtype, backend=backend).train(X, max_em_iters=1) # build the backend
+    results = []
+    for mode in ['soft', 'hard']:
+        gmm = GMM(M, D, cvtype=cvtype, backend=backend)
+        start = time.time()
+        gmm.train(X, min_em_iters=em_iters, max_em_iters=em_iters, mode=mode)
+        # Hard EM stops early once its assignments settle
+        results.append((time.time() - start)/max(gmm.eval_data.iters, 1))
+    return results
+
+def compare_gaussian_selection(backend, N, M, D, cvtype, C=8, num_codewords=64, shortlist_size=32):
+    from gmm_specializer.gmm import GMM
+    X = np.concatenate([np.random.randn(N//M, D) + 2.0*m for m in range(M)]).astype(np.float32)
+    gmm = GMM(M, D, cvtype=cvtype, backend=backend)
+    gmm.train(X, max_em_iters=5)
+    gmm.build_gaussian_selection(X[::10], num_codewords=num_codewords, shortlist_size=shortlist_size, seed=0)
+    gmm.score_top_c(X, C) # warm up
+    start = time.time()
+    gmm.score(X)
+    exact_time = time.time() - start
+    start = time.time()
+    gmm.score_top_c(X, C)
+    top_c_time = time.time() - start
+    mean_error, max_error = gmm.gaussian_selection_error(X, C)
+    return exact_time, top_c_time, mean_error, max_error
+
+if __name__ == '__main__':
+    best, median = time_import()
+    print "import gmm_specializer.gmm: best %.4fs, median %.4fs" % (best, median)
+    cold, warm = time_platform_probe()
+    print "platform probe: cold %.4fs, cached %.4fs" % (cold, warm)
+
+    from gmm_specializer.gmm import GMM
+    for backend in GMM.available_backends:
+        for N, M, D in [(10000, 16, 16), (100000, 32, 16)]:
+            for cvtype in GMM.cvtype_name_list:
+                train_time, eval_time = time_train_eval(backend, N, M, D, cvtype)
+                print "%-7s N=%-7d M=%-3d D=%-3d %-5s train %.4fs  eval %.4fs" % (backend, N, M, D, cvtype, train_time, eval_time)
+
+    for backend in GMM.available_backends:
+        for cvtype in GMM.cvtype_name_list:
+            plain, accelerated = compare_accelerated_em(backend, 20000, 8, 8, cvtype)
+            print "%-7s %-9s EM: %3d iters %.4fs loglik %.2f  SQUAREM: %3d iters %.4fs loglik %.2f" % ((backend, cvtype) + plain + accelerated)
+
+    for backend in GMM.available_backends:
+        for cvtype in GMM.cvtype_name_list:
+            dense, sparse, fallbacks = compare_sparse_mstep(backend, 100000, 32, 16, cvtype)
+            print "%-7s %-9s dense M-step: %.4fs loglik %.2f  sparse M-step: %.4fs loglik %.2f (%d fallbacks)" % ((backend, cvtype) + dense + sparse + (fallbacks,))
+
+    for backend in GMM.available_backends:
+        for cvtype in GMM.cvtype_name_list:
+            soft, hard = compare_hard_em(backend, 100000, 32, 16, cvtype)
+            print "%-7s %-9s soft EM: %.4fs per iter  hard EM: %.4fs per iter" % (backend, cvtype, soft, hard)
+
+    for backend in GMM.available_backends:
+        for cvtype in GMM.cvtype_name_list:
+            results = compare_gaussian_selection(backend, 100000, 256, 16, cvtype)
+            print "%-7s %-9s score: %.4fs  score_top_c: %.4fs  error: mean %.4f max %.4f" % ((backend, cvtype) + results)
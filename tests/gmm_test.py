@@ -1,13 +1,47 @@
 import unittest2 as unittest
 import copy
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
 import numpy as np
-from gmm_specializer.gmm import GMM, compute_distance_BIC
+from gmm_specializer.gmm import GMM, GMMCostModel, GMMPlatformProbe, compute_distance_BIC, load_gmm, load_stream_checkpoint, pack_covars, release_native_state, score_ragged, select_num_components, supervectors, unpack_covars
 
 class BasicTests(unittest.TestCase):
     def test_init(self):
         gmm = GMM(3, 2, cvtype='diag')
         self.assertIsNotNone(gmm)
 
+    def test_lazy_import(self):
+        code = "import sys, gmm_specializer.gmm; print(sorted(m for m in ('asp', 'codepy') if m in sys.modules))"
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.decode().strip(), '[]')
+
+    def test_platform_probe_cache(self):
+        path = os.path.join(tempfile.mkdtemp(), 'platform.json')
+        detectors = []
+        def stub_detector():
+            detectors.append(object())
+            return detectors[-1]
+        def fail(detector): raise AssertionError("cached result was not used")
+        probe = GMMPlatformProbe(path, ttl=60, detector_factory=stub_detector)
+        self.assertEqual(probe.query('answer', lambda detector: 42 if detector is detectors[0] else None), 42)
+        self.assertEqual(probe.probes, 1)
+        cached = GMMPlatformProbe(path, ttl=60, detector_factory=stub_detector)
+        self.assertEqual(cached.query('answer', fail), 42)
+        self.assertEqual(cached.probes, 0)
+        self.assertEqual(len(detectors), 1)
+        with open(path) as f: results = json.load(f)
+        results['time'] -= 120
+        with open(path, 'w') as f: json.dump(results, f)
+        expired = GMMPlatformProbe(path, ttl=60, detector_factory=stub_detector)
+        self.assertEqual(expired.query('answer', lambda detector: 43), 43)
+        self.assertEqual(expired.probes, 1)
+        self.assertEqual(len(detectors), 2)
+
 class SyntheticDataTests(unittest.TestCase):
     def setUp(self):
         self.D = 2
@@ -91,6 +125,572 @@ class SyntheticDataTests(unittest.TestCase):
         for a,b in zip(Y0, Y1): self.assertAlmostEqual(a,b)
         self.assertTrue(len(set(Y0)) > 1)
 
+    def test_training_on_coreset(self):
+        gmm0 = GMM(self.M, self.D, cvtype='diag')
+        likelihood0, gap0 = gmm0.train_on_coreset(self.X, coreset_fraction=0.5, seed=0)
+        Y0 = gmm0.predict(self.X)
+
+        self.assertTrue(np.isfinite(likelihood0))
+        self.assertTrue(len(set(Y0)) > 1)
+        # The gap is between the full-data likelihood of the final model and the weighted coreset objective
+        full_likelihood = np.sum(gmm0.score(self.X), dtype=np.float64)
+        self.assertTrue(abs(likelihood0 - full_likelihood) < 1e-4*abs(full_likelihood))
+        self.assertAlmostEqual(gap0, full_likelihood - gmm0.eval_data.coreset_likelihood, delta=1e-4*abs(full_likelihood))
+        self.assertTrue(abs(gap0) < 0.1*abs(full_likelihood))
+
+        # Importance weights make an event count as often as its weight says
+        init = {'weights': np.ones(self.M, dtype=np.float32)/self.M, 'means': np.array(self.X[[0, 250, 450]]),
+                'covars': np.ones((self.M, self.D), dtype=np.float32)}
+        gmm2 = GMM(self.M, self.D, cvtype='diag', backend='numpy', **copy.deepcopy(init))
+        likelihood2 = gmm2.train(np.concatenate([self.X[::2], self.X[::2]]), min_em_iters=5, max_em_iters=5)
+        for backend in ['numpy', GMM.default_native_backend]:
+            gmm1 = GMM(self.M, self.D, cvtype='diag', backend=backend, **copy.deepcopy(init))
+            likelihood1 = gmm1.train(self.X[::2], min_em_iters=5, max_em_iters=5, sample_weights=np.ones(self.N//2)*2)
+            self.assertTrue(np.allclose(gmm1.components.means, gmm2.components.means, atol=1e-3))
+            self.assertTrue(abs(likelihood1 - likelihood2) < 1e-4*abs(likelihood2))
+        self.assertRaises(RuntimeError, gmm1.train, self.X, 1, 10, False, 'soft', None, 1e-3, 1, None, np.ones(5))
+
+    def test_binary_model_round_trip(self):
+        gmm0 = GMM(self.M, self.D, cvtype='full')
+        gmm0.train(self.X)
+        lklds0 = np.array(gmm0.score(self.X))
+
+        fd, filename = tempfile.mkstemp(suffix='.gmm')
+        os.close(fd)
+        try:
+            gmm0.save(filename)
+            gmm1 = load_gmm(filename)
+            self.assertEqual(gmm1.cvtype, 'full')
+            self.assertTrue(gmm1.components.constants_valid)
+            for a,b in zip(gmm0.components.means.flatten(), gmm1.components.means.flatten()): self.assertAlmostEqual(a,b,places=5)
+            lklds1 = gmm1.score(self.X)
+            for a,b in zip(lklds0, lklds1): self.assertAlmostEqual(a,b,places=3)
+            del gmm1
+
+            # A file from a newer format version names the version it has and the ones that can be read
+            with open(filename, 'r+b') as f:
+                f.seek(4)
+                f.write(struct.pack('<I', 99))
+            with self.assertRaisesRegexp(RuntimeError, 'version 99 .* versions 1 to'):
+                load_gmm(filename)
+        finally:
+            os.remove(filename)
+
+    def test_scoring_constants_cache(self):
+        gmm0 = GMM(self.M, self.D, cvtype='full')
+        gmm0.train(self.X)
+        self.assertTrue(gmm0.components.constants_valid)
+        lklds0 = np.array(gmm0.score(self.X))
+        version = gmm0.components.version
+        lklds1 = np.array(gmm0.score(self.X))
+        self.assertEqual(gmm0.components.version, version)
+        for a,b in zip(lklds0, lklds1): self.assertAlmostEqual(a,b,places=3)
+
+        gmm0.components.covars *= 4.0
+        gmm0.components.touch()
+        self.assertFalse(gmm0.components.constants_valid)
+        lklds2 = np.array(gmm0.score(self.X))
+        self.assertTrue(gmm0.components.constants_valid)
+        self.assertNotAlmostEqual(np.sum(lklds0), np.sum(lklds2), places=1)
+
+    def test_ragged_scoring(self):
+        gmm0 = GMM(self.M, self.D, cvtype='diag')
+        gmm0.train(self.X)
+        gmm1 = GMM(self.M, self.D, cvtype='diag')
+        gmm1.train(self.X[:300])
+        offsets = np.array([0, 100, 100, 350, self.N])
+        means = score_ragged([gmm0, gmm1], self.X, offsets, reduce='mean')
+        sums = gmm0.score_ragged(self.X, offsets, reduce='sum')
+        self.assertEqual(means.shape, (2, 4))
+        self.assertTrue(np.isnan(means[0][1]))
+        self.assertEqual(sums[1], 0.0)
+        for s in [0, 2, 3]:
+            seq = self.X[offsets[s]:offsets[s+1]]
+            self.assertAlmostEqual(means[0][s], np.mean(gmm0.score(seq)), places=2)
+            self.assertAlmostEqual(means[1][s], np.mean(gmm1.score(seq)), places=2)
+            self.assertAlmostEqual(sums[s]/1000.0, np.sum(gmm0.score(seq))/1000.0, places=2)
+        self.assertRaises(RuntimeError, score_ragged, [gmm0], self.X, [0, 10], 'mean')
+
+    def test_eval_buffer_reuse(self):
+        gmm0 = GMM(self.M, self.D, cvtype='diag')
+        gmm0.train(self.X)
+        full = np.array(gmm0.score(self.X))
+        eval_reallocs = GMM.eval_data_reallocs
+        event_reallocs = GMM.event_data_reallocs
+        for n in [100, 350, 17, self.N]:
+            lklds = gmm0.score(self.X[:n])
+            self.assertEqual(lklds.shape, (n,))
+            for a,b in zip(full[:n], lklds): self.assertAlmostEqual(a,b,places=3)
+        self.assertEqual(GMM.eval_data_reallocs, eval_reallocs)
+        self.assertEqual(GMM.event_data_reallocs, event_reallocs)
+        logprob, posteriors = gmm0.eval(np.concatenate((self.X, self.X)))
+        self.assertEqual(posteriors.shape, (self.M, 2*self.N))
+        self.assertEqual(GMM.eval_data_reallocs, eval_reallocs+1)
+        self.assertTrue(GMM.event_data_reallocs <= event_reallocs+1)
+
+    def test_concurrent_models(self):
+        from multiprocessing.pool import ThreadPool
+        def train_and_score(X):
+            gmm = GMM(self.M, self.D, cvtype='diag', backend=GMM.default_native_backend)
+            gmm.train(X)
+            # The scratch component of the distance is per thread too
+            new_component, dist = gmm.compute_distance_rissanen(0, 1)
+            return np.append(gmm.score(self.X), dist)
+        inputs = [self.X, self.X[:400], self.X[200:], self.X]
+        serial = [train_and_score(X) for X in inputs]
+        pool = ThreadPool(len(inputs))
+        try:
+            concurrent = pool.map(train_and_score, inputs)
+        finally:
+            pool.close()
+            pool.join()
+        for a, b in zip(serial, concurrent):
+            for x,y in zip(a, b): self.assertAlmostEqual(x,y,places=3)
+
+    def test_release_native_state(self):
+        backend = GMM.default_native_backend
+        if backend is None: return
+        import threading
+        results = []
+        def worker():
+            gmm = GMM(self.M, self.D, cvtype='diag', backend=backend)
+            gmm.train(self.X)
+            state = GMM.native_states[backend]
+            held = state.event_data_cpu_copy is not None and state.component_data_cpu_copy is not None
+            release_native_state()
+            released = state.event_data_cpu_copy is None and state.component_data_cpu_copy is None
+            # The model reallocates what it needs when it is used again on this thread
+            scores = gmm.score(self.X)
+            release_native_state()
+            results.append((held, released, bool(np.all(np.isfinite(scores)))))
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [(True, True, True)])
+
+        # Without the explicit call, the buffers are freed as the thread exits
+        def train_only():
+            GMM(self.M, self.D, cvtype='diag', backend=backend).train(self.X)
+        releases = GMM.native_state_releases
+        thread = threading.Thread(target=train_only)
+        thread.start()
+        thread.join()
+        for i in range(100):
+            if GMM.native_state_releases > releases: break
+            time.sleep(0.01)
+        self.assertEqual(GMM.native_state_releases, releases + 1)
+
+    def test_numpy_backend(self):
+        gmm0 = GMM(self.M, self.D, cvtype='full', backend='numpy')
+        likelihood0 = gmm0.train(self.X)
+        self.assertTrue(len(set(gmm0.predict(self.X))) > 1)
+        if GMM.default_native_backend is None: return
+        gmm1 = GMM(self.M, self.D, cvtype='full', weights=np.array(gmm0.components.weights), means=np.array(gmm0.components.means), covars=np.array(gmm0.components.covars), backend=GMM.default_native_backend)
+        lklds0 = gmm0.score(self.X)
+        lklds1 = gmm1.score(self.X)
+        for a,b in zip(lklds0, lklds1): self.assertAlmostEqual(a,b,places=3)
+
+    def test_spherical_and_tied(self):
+        for cvtype, shape in [('diag', (self.M, self.D)), ('full', (self.M, self.D*(self.D+1)//2)), ('spherical', (self.M,)), ('tied', (self.D, self.D))]:
+            gmm0 = GMM(self.M, self.D, cvtype=cvtype)
+            likelihood0 = gmm0.train(self.X)
+            self.assertEqual(gmm0.components.covars.shape, shape)
+            self.assertTrue(np.isfinite(likelihood0))
+            self.assertTrue(len(set(gmm0.predict(self.X))) > 1)
+
+            fd, filename = tempfile.mkstemp(suffix='.gmm')
+            os.close(fd)
+            try:
+                gmm0.save(filename)
+                self.assertEqual(load_gmm(filename).components.covars.shape, shape)
+            finally:
+                os.remove(filename)
+
+            # Same scores as a full covariance model holding the expanded matrices
+            gmm1 = GMM(self.M, self.D, cvtype='full', weights=np.array(gmm0.components.weights), means=np.array(gmm0.components.means), covars=gmm0.components.expanded_covars().astype(np.float32))
+            for a,b in zip(gmm0.score(self.X), gmm1.score(self.X)): self.assertAlmostEqual(a,b,places=3)
+
+            # The native and numpy backends agree from the same starting point
+            if GMM.default_native_backend is None: continue
+            init = dict(weights=np.array(gmm0.components.weights), means=np.array(gmm0.components.means), covars=np.array(gmm0.components.covars))
+            gmm2 = GMM(self.M, self.D, cvtype=cvtype, backend='numpy', **copy.deepcopy(init))
+            gmm3 = GMM(self.M, self.D, cvtype=cvtype, backend=GMM.default_native_backend, **copy.deepcopy(init))
+            likelihood2 = gmm2.train(self.X, min_em_iters=3, max_em_iters=3)
+            likelihood3 = gmm3.train(self.X, min_em_iters=3, max_em_iters=3)
+            self.assertAlmostEqual(likelihood2/likelihood3, 1.0, places=3)
+
+    def test_compact_diag_storage(self):
+        gmm0 = GMM(self.M, self.D, cvtype='diag')
+        gmm0.train(self.X)
+        self.assertEqual(gmm0.components.covars.shape, (self.M, self.D))
+        self.assertEqual(gmm0.components.Rinv.shape, (self.M, self.D))
+        expanded = gmm0.components.expanded_covars().astype(np.float32)
+        self.assertEqual(expanded.shape, (self.M, self.D, self.D))
+
+        # Full matrices given for a diag model are reduced to their diagonals
+        init = dict(weights=np.array(gmm0.components.weights), means=np.array(gmm0.components.means))
+        gmm1 = GMM(self.M, self.D, cvtype='diag', covars=expanded, **copy.deepcopy(init))
+        gmm2 = GMM(self.M, self.D, cvtype='full', covars=expanded, **copy.deepcopy(init))
+        self.assertEqual(gmm1.components.covars.shape, (self.M, self.D))
+        lklds0 = gmm0.score(self.X)
+        for a,b in zip(lklds0, gmm1.score(self.X)): self.assertAlmostEqual(a,b,places=3)
+        for a,b in zip(lklds0, gmm2.score(self.X)): self.assertAlmostEqual(a,b,places=3)
+
+        if GMM.default_native_backend is None: return
+        gmm3 = GMM(self.M, self.D, cvtype='diag', covars=np.array(gmm0.components.covars), backend=GMM.default_native_backend, **copy.deepcopy(init))
+        new_component, dist = gmm3.compute_distance_rissanen(0, 1)
+        gmm3.merge_components(0, 1, new_component)
+        self.assertEqual(gmm3.components.covars.size, (self.M-1)*self.D)
+        self.assertTrue(np.all(np.isfinite(gmm3.score(self.X))))
+
+    def test_packed_full_storage(self):
+        gmm0 = GMM(self.M, self.D, cvtype='full')
+        gmm0.train(self.X)
+        packed_size = self.D*(self.D+1)//2
+        self.assertEqual(gmm0.components.covars.shape, (self.M, packed_size))
+        self.assertEqual(gmm0.components.Rinv.shape, (self.M, packed_size))
+        expanded = gmm0.components.expanded_covars()
+        for m in range(self.M):
+            self.assertTrue(np.allclose(expanded[m], expanded[m].T))
+        self.assertTrue(np.allclose(pack_covars(expanded), gmm0.components.covars))
+        self.assertTrue(np.allclose(unpack_covars(pack_covars(expanded), self.D), expanded))
+
+        if GMM.default_native_backend is None: return
+        gmm1 = GMM(self.M, self.D, cvtype='full', weights=np.array(gmm0.components.weights), means=np.array(gmm0.components.means), covars=np.array(gmm0.components.covars), backend=GMM.default_native_backend)
+        new_component, dist = gmm1.compute_distance_rissanen(0, 1)
+        gmm1.merge_components(0, 1, new_component)
+        self.assertEqual(gmm1.components.covars.size, (self.M-1)*packed_size)
+        self.assertTrue(np.all(np.isfinite(gmm1.score(self.X))))
+
+    def test_gaussian_selection(self):
+        gmm0 = GMM(8, self.D, cvtype='diag')
+        gmm0.train(self.X)
+        self.assertRaises(RuntimeError, gmm0.score_top_c, self.X)
+
+        # With every component on every shortlist, the top-C scores are exact
+        gmm0.build_gaussian_selection(self.X, num_codewords=4, shortlist_size=8, seed=0)
+        mean_error, max_error = gmm0.gaussian_selection_error(self.X, C=8)
+        self.assertTrue(max_error < 1e-3)
+        # Dropping components from the top-C sum can only lower the score
+        errors = [gmm0.gaussian_selection_error(self.X, C=c)[0] for c in [2, 4, 8]]
+        self.assertTrue(errors[0] >= errors[1] - 1e-4 and errors[1] >= errors[2] - 1e-4)
+
+        gmm0.build_gaussian_selection(self.X, num_codewords=4, shortlist_size=4, seed=0)
+        approx = gmm0.score_top_c(self.X, C=2)
+        exact = np.array(gmm0.score(self.X))
+        self.assertTrue(np.all(approx <= exact + 1e-3))
+        self.assertRaises(RuntimeError, gmm0.score_top_c, self.X, 5)
+
+        # The native shortlist E-step matches the numpy one
+        for cvtype in GMM.cvtype_name_list:
+            gmm1 = GMM(8, self.D, cvtype=cvtype, backend=GMM.default_native_backend)
+            gmm1.train(self.X)
+            gmm1.build_gaussian_selection(self.X, num_codewords=4, shortlist_size=4, seed=0)
+            native = gmm1.score_top_c(self.X, C=2)
+            gmm1.backend = 'numpy'
+            self.assertTrue(np.allclose(native, gmm1.score_top_c(self.X, C=2), atol=1e-3))
+
+    def test_map_adapt(self):
+        for cvtype in GMM.cvtype_name_list:
+            ubm = GMM(self.M, self.D, cvtype=cvtype)
+            ubm.train(self.X)
+            shifted = self.X[:self.N//3] + 0.5
+            logprob, log_joint = ubm.eval(shifted)
+            posteriors = np.exp(np.asarray(log_joint, dtype=np.float64) - logprob)
+            expected_means = np.dot(posteriors, shifted)/posteriors.sum(axis=1)[:, np.newaxis]
+
+            # Without a prior the adapted means are the posterior-weighted data means
+            gmm0 = GMM.map_adapt(ubm, shifted, relevance_factor=0.0)
+            self.assertEqual(gmm0.cvtype, cvtype)
+            self.assertTrue(np.allclose(gmm0.components.means, expected_means, atol=1e-3))
+            self.assertTrue(np.allclose(gmm0.components.covars, ubm.components.covars))
+
+            # A huge relevance factor leaves the ubm untouched
+            gmm1 = GMM.map_adapt(ubm, shifted, relevance_factor=1e9, adapt=('weights', 'means', 'covars'))
+            self.assertTrue(np.allclose(gmm1.components.means, ubm.components.means, atol=1e-3))
+            self.assertTrue(np.allclose(gmm1.components.covars, ubm.components.covars, atol=1e-3))
+
+            gmm2 = GMM.map_adapt(ubm, shifted, relevance_factor=4.0, adapt=('weights', 'means', 'covars'))
+            self.assertAlmostEqual(np.sum(gmm2.components.weights), 1.0, places=5)
+            self.assertTrue(np.sum(gmm2.score(shifted)) > np.sum(ubm.score(shifted)))
+        self.assertRaises(RuntimeError, GMM.map_adapt, ubm, self.X, 16.0, ('priors',))
+
+    def test_supervectors(self):
+        ubm = GMM(self.M, self.D, cvtype='diag', backend=GMM.default_native_backend)
+        ubm.train(self.X)
+        offsets = [0, 100, 100, 350, self.N]
+        out = np.zeros((4, self.M*self.D), dtype=np.float32)
+        result = supervectors(ubm, self.X, offsets, relevance_factor=4.0, normalize=False, out=out)
+        self.assertTrue(result is out)
+        for s in [0, 2, 3]:
+            adapted = GMM.map_adapt(ubm, self.X[offsets[s]:offsets[s+1]], relevance_factor=4.0)
+            self.assertTrue(np.allclose(out[s], np.ravel(adapted.components.means), atol=1e-3))
+        # An empty sequence has the ubm means
+        self.assertTrue(np.allclose(out[1], np.ravel(ubm.components.means)))
+        # The numpy backend's prefix sums give the same statistics
+        numpy_ubm = GMM(self.M, self.D, cvtype='diag', backend='numpy', weights=np.array(ubm.components.weights),
+                        means=np.array(ubm.components.means), covars=np.array(ubm.components.covars))
+        self.assertTrue(np.allclose(supervectors(numpy_ubm, self.X, offsets, relevance_factor=4.0, normalize=False), out, atol=1e-4))
+
+        normalized = ubm.supervectors(self.X, offsets, relevance_factor=4.0)
+        scale = np.sqrt(np.array(ubm.components.weights)[:, np.newaxis]/ubm.components.variances())
+        self.assertTrue(np.allclose(normalized, out*np.ravel(scale), atol=1e-4))
+        self.assertRaises(RuntimeError, supervectors, ubm, self.X, offsets, 4.0, True, np.zeros((3, self.M*self.D), dtype=np.float32))
+
+    def test_partial_fit(self):
+        rng = np.random.RandomState(0)
+        for cvtype in GMM.cvtype_name_list:
+            batch = GMM(self.M, self.D, cvtype=cvtype)
+            batch.train(self.X, max_em_iters=50)
+            batch_likelihood = np.sum(batch.score(self.X), dtype=np.float64)
+
+            stream = GMM(self.M, self.D, cvtype=cvtype)
+            for epoch in range(20):
+                order = rng.permutation(self.N)
+                stream.partial_fit(self.X[order[i:i+100]] for i in range(0, self.N, 100))
+            stream_likelihood = np.sum(stream.score(self.X), dtype=np.float64)
+            self.assertTrue(stream_likelihood > batch_likelihood - 0.08*abs(batch_likelihood))
+
+        # Resuming from a checkpoint continues the stream exactly
+        path = os.path.join(tempfile.mkdtemp(), 'stream.npz')
+        stream.save_stream_checkpoint(path)
+        resumed = load_stream_checkpoint(path)
+        self.assertEqual(resumed.stream_state.step, stream.stream_state.step)
+        chunk = self.X[:200]
+        stream.partial_fit(chunk)
+        resumed.partial_fit(chunk)
+        self.assertTrue(np.allclose(resumed.components.means, stream.components.means, atol=1e-4))
+        self.assertTrue(np.allclose(resumed.components.covars, stream.components.covars, atol=1e-4))
+        self.assertRaises(RuntimeError, stream.partial_fit, chunk, 0.4)
+
+    def test_eval_blocks(self):
+        gmm0 = GMM(self.M, self.D, cvtype='diag')
+        gmm0.train(self.X)
+        logprob, posteriors = gmm0.eval(self.X)
+        logprob, posteriors = np.array(logprob), np.array(posteriors)
+
+        directory = tempfile.mkdtemp()
+        data = np.memmap(os.path.join(directory, 'data.f32'), dtype=np.float32, mode='w+', shape=self.X.shape)
+        data[:] = self.X
+        posterior_out = np.memmap(os.path.join(directory, 'posteriors.f32'), dtype=np.float32, mode='w+', shape=(self.M, self.N))
+        logprob_out, result = gmm0.eval_blocks(data, os.path.join(directory, 'logprob.f32'), posterior_out, block_size=77)
+        self.assertTrue(result is posterior_out)
+        self.assertTrue(isinstance(logprob_out, np.memmap))
+        self.assertTrue(np.allclose(logprob_out, logprob, atol=1e-4))
+        self.assertTrue(np.allclose(posterior_out, posteriors, atol=1e-4))
+
+        logprob_only, none = gmm0.eval_blocks(self.X, block_size=self.N)
+        self.assertTrue(none is None)
+        self.assertTrue(np.allclose(logprob_only, logprob, atol=1e-4))
+        self.assertRaises(RuntimeError, gmm0.eval_blocks, self.X, np.zeros(self.N - 1, dtype=np.float32))
+
+    def test_output_buffers(self):
+        for backend in ['numpy', GMM.default_native_backend]:
+            gmm0 = GMM(self.M, self.D, cvtype='diag', backend=backend)
+            gmm0.train(self.X)
+            logprob, posteriors = gmm0.eval(self.X)
+            logprob, posteriors = np.array(logprob), np.array(posteriors)
+            logprob_out = np.zeros(self.N, dtype=np.float32)
+            posterior_out = np.zeros((self.M, self.N), dtype=np.float32)
+            result = gmm0.eval(self.X, logprob_out=logprob_out, posterior_out=posterior_out)
+            self.assertTrue(result[0] is logprob_out and result[1] is posterior_out)
+            self.assertTrue(np.allclose(logprob_out, logprob, atol=1e-4))
+            self.assertTrue(np.allclose(posterior_out, posteriors, atol=1e-4))
+
+            # The next call without outputs goes back to the eval_data buffers and leaves the caller's arrays alone
+            other = self.X[:50] + 1.0
+            self.assertFalse(np.allclose(gmm0.score(other), logprob_out[:50]))
+            self.assertTrue(np.allclose(logprob_out, logprob, atol=1e-4))
+
+            self.assertTrue(gmm0.score(self.X, out=logprob_out) is logprob_out)
+            indexes = np.zeros(self.N, dtype=np.intp)
+            self.assertTrue(gmm0.predict(self.X, out=indexes) is indexes)
+            self.assertTrue(np.array_equal(indexes, posteriors.argmax(axis=0)))
+            decoded = gmm0.decode(self.X, logprob_out=logprob_out, out=indexes)
+            self.assertTrue(decoded[0] is logprob_out and decoded[1] is indexes)
+
+            self.assertRaises(RuntimeError, gmm0.score, self.X, np.zeros(self.N, dtype=np.float64))
+            self.assertRaises(RuntimeError, gmm0.score, self.X, np.zeros(2*self.N, dtype=np.float32)[::2])
+            self.assertRaises(RuntimeError, gmm0.eval, self.X, None, np.zeros((self.N, self.M), dtype=np.float32))
+
+    def test_input_layouts(self):
+        gmm1 = GMM(self.M, self.D, cvtype='diag', means=np.array(self.X[:self.M], dtype=np.float64), covars=np.ones((self.M, self.D)), weights=np.ones(self.M)/self.M)
+        self.assertEqual(gmm1.components.means.dtype, np.float32)
+        self.assertTrue(gmm1.components.means.flags.c_contiguous)
+
+        # The copy counters are kept by the native event loading
+        if GMM.default_native_backend is None: return
+        gmm0 = GMM(self.M, self.D, cvtype='full', backend=GMM.default_native_backend)
+        gmm0.train(self.X)
+        expected = np.array(gmm0.score(self.X))
+        wide = np.zeros((self.N, 2*self.D), dtype=np.float32)
+        wide[:, ::2] = self.X
+        layouts = [np.asfortranarray(self.X), self.X.astype(np.float64), wide[:, ::2], np.asfortranarray(self.X, dtype=np.float64)]
+        for X in layouts:
+            input_copies, event_data_copies = GMM.input_copies, GMM.event_data_copies
+            self.assertTrue(np.allclose(gmm0.score(X), expected, atol=1e-4))
+            self.assertEqual(GMM.input_copies, input_copies)
+            self.assertEqual(GMM.event_data_copies, event_data_copies + 1)
+
+        # C-contiguous float32 is used in place; other dtypes are converted once in Python
+        input_copies, event_data_copies = GMM.input_copies, GMM.event_data_copies
+        gmm0.score(self.X)
+        self.assertEqual((GMM.input_copies, GMM.event_data_copies), (input_copies, event_data_copies))
+        gmm0.score(self.X.astype(np.int64))
+        self.assertEqual((GMM.input_copies, GMM.event_data_copies), (input_copies + 1, event_data_copies))
+
+
+    def test_accelerated_train(self):
+        for backend in ['numpy', GMM.default_native_backend]:
+            for cvtype in GMM.cvtype_name_list:
+                plain = GMM(self.M, self.D, cvtype=cvtype, backend=backend)
+                plain_likelihood = plain.train(self.X, max_em_iters=100)
+                accelerated = GMM(self.M, self.D, cvtype=cvtype, backend=backend)
+                likelihood = accelerated.train(self.X, max_em_iters=100, accelerate=True)
+                self.assertTrue(likelihood > plain_likelihood - 1e-3*abs(plain_likelihood))
+                self.assertTrue(1 <= accelerated.eval_data.iters <= 100)
+                self.assertAlmostEqual(np.sum(accelerated.components.weights), 1.0, places=5)
+                self.assertTrue(np.allclose(accelerated.score(self.X).sum(), likelihood, rtol=1e-3))
+        # Resumed native steps reuse the loaded posteriors and take the same steps as one train call
+        init = {'weights': np.ones(self.M, dtype=np.float32)/self.M, 'means': np.array(self.X[[0, self.N//2, self.N-1]]),
+                'covars': np.ones((self.M, self.D), dtype=np.float32)}
+        plain, stepped = [GMM(self.M, self.D, cvtype='diag', backend=GMM.default_native_backend, **copy.deepcopy(init)) for i in range(2)]
+        plain_likelihood = plain.train(self.X, min_em_iters=3, max_em_iters=3)
+        stepped.train(self.X, min_em_iters=1, max_em_iters=1)
+        stepped.internal_em_step(self.X, GMM.default_native_backend, 2)
+        likelihood = stepped.internal_em_step(self.X, GMM.default_native_backend, 2)
+        self.assertTrue(abs(likelihood - plain_likelihood) < 1e-5*abs(plain_likelihood))
+        self.assertTrue(np.allclose(stepped.components.means, plain.components.means, atol=1e-4))
+
+    def test_hard_train(self):
+        for backend in ['numpy', GMM.default_native_backend]:
+            for cvtype in GMM.cvtype_name_list:
+                gmm0 = GMM(self.M, self.D, cvtype=cvtype, backend=backend)
+                gmm0.train(self.X, max_em_iters=50, mode='hard')
+                self.assertTrue(gmm0.eval_data.iters <= 50)
+                logprob, log_joint = gmm0.eval(self.X)
+                assignments = np.array(log_joint).argmax(axis=0)
+                # At convergence each component is the mean of the events assigned to it
+                for m in range(self.M):
+                    if np.any(assignments == m):
+                        self.assertTrue(np.allclose(gmm0.components.means[m], self.X[assignments == m].mean(axis=0), atol=1e-3))
+                self.assertAlmostEqual(np.sum(gmm0.components.weights), 1.0, places=5)
+                # Soft EM started from the hard solution only improves it
+                hard_likelihood = np.sum(gmm0.score(self.X), dtype=np.float64)
+                self.assertTrue(gmm0.train(self.X, max_em_iters=5) >= hard_likelihood - 1e-2)
+        self.assertRaises(RuntimeError, gmm0.train, self.X, 1, 10, False, 'viterbi')
+        # The native classification EM takes the same steps as the Python one
+        init = {'weights': np.ones(self.M, dtype=np.float32)/self.M, 'means': np.array(self.X[[0, self.N//2, self.N-1]]),
+                'covars': np.ones((self.M, self.D), dtype=np.float32)}
+        hard = [GMM(self.M, self.D, cvtype='diag', backend=backend, **copy.deepcopy(init)) for backend in ['numpy', GMM.default_native_backend]]
+        likelihoods = [gmm.train(self.X, max_em_iters=50, mode='hard') for gmm in hard]
+        self.assertEqual(hard[0].eval_data.iters, hard[1].eval_data.iters)
+        self.assertTrue(abs(likelihoods[0] - likelihoods[1]) < 1e-4*abs(likelihoods[0]))
+        self.assertTrue(np.allclose(hard[0].components.means, hard[1].components.means, atol=1e-3))
+
+    def test_sparse_train(self):
+        for cvtype in GMM.cvtype_name_list:
+            identity = {'spherical': np.ones(self.M), 'diag': np.ones((self.M, self.D)), 'tied': np.eye(self.D),
+                        'full': pack_covars(np.tile(np.eye(self.D), (self.M, 1, 1)))}
+            init = {'weights': np.ones(self.M, dtype=np.float32)/self.M, 'means': np.array(self.X[[0, self.N//2, self.N-1]]),
+                    'covars': identity[cvtype].astype(np.float32)}
+            dense = GMM(self.M, self.D, cvtype=cvtype, backend='numpy', **copy.deepcopy(init))
+            dense.train(self.X, min_em_iters=5, max_em_iters=5)
+            for backend in ['numpy', GMM.default_native_backend]:
+                sparse = GMM(self.M, self.D, cvtype=cvtype, backend=backend, **copy.deepcopy(init))
+                sparse.train(self.X, min_em_iters=5, max_em_iters=5, sparse_threshold=1e-6)
+                self.assertEqual(sparse.eval_data.iters, 5)
+                self.assertEqual(sparse.eval_data.sparse_fallbacks, 0)
+                self.assertTrue(np.allclose(sparse.components.means, dense.components.means, atol=1e-3))
+                self.assertTrue(np.allclose(sparse.components.covars, dense.components.covars, atol=1e-3))
+
+            # Dropping too much mass falls back to the exact M-step
+            for backend in ['numpy', GMM.default_native_backend]:
+                exact = GMM(self.M, self.D, cvtype=cvtype, backend=backend, **copy.deepcopy(init))
+                exact.train(self.X, min_em_iters=5, max_em_iters=5, sparse_threshold=0.4, sparse_tolerance=0.0)
+                self.assertEqual(exact.eval_data.sparse_fallbacks, 5)
+                self.assertTrue(np.allclose(exact.components.means, dense.components.means, atol=1e-3))
+        self.assertRaises(RuntimeError, exact.train, self.X, 1, 10, False, 'hard', 1e-3)
+
+    def test_train_restarts(self):
+        for backend in ['numpy', GMM.default_native_backend]:
+            single = GMM(self.M, self.D, cvtype='diag', backend=backend)
+            single_likelihood = single.train(self.X)
+            gmm0 = GMM(self.M, self.D, cvtype='diag', backend=backend)
+            releases = GMM.native_state_releases
+            likelihood = gmm0.train(self.X, n_init=4, seed=0)
+            # The pool threads free their native buffers as they exit
+            self.assertTrue(backend == 'numpy' or GMM.native_state_releases > releases)
+            outcomes = gmm0.eval_data.restart_likelihoods
+            self.assertEqual(len(outcomes), 4)
+            self.assertEqual(likelihood, max(outcomes))
+            # Restart 0 is the usual seeding, so the best restart is at least as good as a single run
+            self.assertAlmostEqual(outcomes[0], single_likelihood, places=1)
+            self.assertTrue(abs(np.sum(gmm0.score(self.X), dtype=np.float64) - likelihood) < 1e-3*abs(likelihood))
+            gmm1 = GMM(self.M, self.D, cvtype='diag', backend=backend)
+            gmm1.train(self.X, n_init=4, seed=0)
+            self.assertEqual(gmm1.eval_data.restart_likelihoods, outcomes)
+
+    def test_select_num_components(self):
+        gmm0 = GMM(2, self.D, cvtype='full')
+        gmm0.train(self.X)
+        split = gmm0.split_components(4)
+        self.assertEqual(split.M, 4)
+        self.assertAlmostEqual(np.sum(split.components.weights), 1.0, places=5)
+        self.assertTrue(np.allclose(np.dot(split.components.weights, split.components.means.reshape(4, self.D)),
+                                    np.dot(gmm0.components.weights, gmm0.components.means.reshape(2, self.D)), atol=1e-4))
+
+        for criterion in ['bic', 'aic']:
+            releases = GMM.native_state_releases
+            best, sweep = select_num_components(self.X, [4, 1, 2, 3], criterion=criterion, cvtype='full', max_em_iters=50)
+            # The pool threads free their native buffers as they exit
+            self.assertTrue(GMM.default_native_backend is None or GMM.native_state_releases > releases)
+            self.assertEqual([entry[0] for entry in sweep], [1, 2, 3, 4])
+            self.assertTrue(best is min(sweep, key=lambda entry: entry[1])[3])
+            # The data has three clusters
+            self.assertTrue(best.M >= 2)
+            self.assertTrue(sweep[2][2] > sweep[0][2])
+        self.assertRaises(RuntimeError, select_num_components, self.X, [1, 2], 'mdl')
+
+    def test_reduce_components(self):
+        for cvtype in ['diag', 'full']:
+            gmm0 = GMM(6, self.D, cvtype=cvtype)
+            gmm0.train(self.X)
+            gmm1 = GMM(6, self.D, cvtype=cvtype)
+            gmm1.train(self.X)
+            # The same greedy reduction, one pair at a time
+            while gmm1.M > 3:
+                pairs = [(c1, c2) for c1 in range(gmm1.M) for c2 in range(c1+1, gmm1.M)]
+                c1, c2 = min(pairs, key=lambda pair: gmm1.compute_distance_rissanen(pair[0], pair[1])[1])
+                new_component, dist = gmm1.compute_distance_rissanen(c1, c2)
+                gmm1.merge_components(c1, c2, new_component)
+            self.assertEqual(gmm0.reduce_components(3), 3)
+            self.assertEqual(gmm0.M, 3)
+            self.assertEqual(gmm0.components.M, 3)
+            self.assertAlmostEqual(np.sum(gmm0.components.weights), 1.0, places=5)
+            self.assertTrue(np.allclose(gmm0.components.means, gmm1.components.means, atol=1e-4))
+            self.assertTrue(np.allclose(gmm0.components.covars, gmm1.components.covars, atol=1e-4))
+            self.assertTrue(np.all(np.isfinite(gmm0.score(self.X))))
+            # The native constants step must write the live comp_probs of the shrunken models
+            for gmm in [gmm0, gmm1]:
+                self.assertTrue(np.isfinite(gmm.train(self.X, max_em_iters=5)))
+                self.assertTrue(np.allclose(gmm.components.comp_probs, 2.0*gmm.components.constant, atol=1e-4))
+            self.assertEqual(gmm0.reduce_components(3), 0)
+            self.assertRaises(RuntimeError, gmm0.reduce_components, 0)
+        self.assertRaises(RuntimeError, GMM(self.M, self.D, cvtype='tied').reduce_components, 2)
+
+    def test_cost_model(self):
+        model = GMMCostModel()
+        for N in [100, 1000, 10000, 100000]:
+            model.record('cuda', 'eval', N, 16, 16, 'diag', 1e-3 + 1e-11*N*16*16)
+            model.record('tbb', 'eval', N, 16, 16, 'diag', 1e-5 + 1e-9*N*16*16)
+        overhead, rate = model.coefficients('cuda', 'eval', 'diag')
+        self.assertAlmostEqual(overhead/1e-3, 1.0, places=2)
+        self.assertAlmostEqual(rate/1e-11, 1.0, places=2)
+        self.assertEqual(model.choose(['tbb', 'cuda'], 'eval', 100, 16, 16, 'diag'), 'tbb')
+        self.assertEqual(model.choose(['tbb', 'cuda'], 'eval', 1000000, 16, 16, 'diag'), 'cuda')
+        self.assertRaises(RuntimeError, GMM, self.M, self.D, backend='no_such_backend')
+
 class SpeechDataTests(unittest.TestCase):
     def setUp(self):
         self.X = np.ndfromtxt('./tests/speech_data.csv', delimiter=',', dtype=np.float32)